@@ -0,0 +1,297 @@
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+import pyarrow as pa
+from app.exporters import EXPORT_BATCH_SIZE, iter_record_batches
+from app.metrics import ANALYTICS_QUERIES
+from app.result_cache import is_read_query, referenced_tables
+from app.sql_rewriter import tokenize
+
+logger = logging.getLogger(__name__)
+
+# "postgres" runs every query on PostgreSQL; "duckdb" serves read queries from in-process snapshots.
+ANALYTICS_BACKEND = os.getenv("ANALYTICS_BACKEND", "postgres").lower()
+# ":memory:" keeps snapshots in RAM; a file path lets DuckDB page them to disk.
+ANALYTICS_DUCKDB_PATH = os.getenv("ANALYTICS_DUCKDB_PATH", ":memory:")
+ANALYTICS_MEMORY_LIMIT = os.getenv("ANALYTICS_MEMORY_LIMIT")
+ANALYTICS_THREADS = os.getenv("ANALYTICS_THREADS")
+# Seconds a snapshot is served for before it is re-copied (0 disables the limit).
+ANALYTICS_SNAPSHOT_TTL = float(os.getenv("ANALYTICS_SNAPSHOT_TTL", "300"))
+
+_CTE_NAME = re.compile(
+    r'(?:\bWITH(?:\s+RECURSIVE)?|,)\s*("[^"]+"|\w+)\s*(?:\([^)]*\)\s*)?AS\s*(?:NOT\s+)?(?:MATERIALIZED\s*)?\(',
+    re.IGNORECASE,
+)
+_CAST = re.compile(r"^CAST\((.*) AS [^()]+\)$", re.IGNORECASE)
+_FUNCTION = re.compile(r"^(\w+)\(")
+
+
+def divides_sum(sql):
+    """True when a statement both divides and calls SUM.
+
+    PostgreSQL's SUM of a bigint is numeric, so SUM(x) / COUNT(*) divides
+    exactly, while DuckDB's is an integer that integer_division truncates.
+    """
+    tokens = [(kind, value) for kind, value in tokenize(sql) if kind not in ("space", "comment")]
+    if ("punct", "/") not in tokens:
+        return False
+    return any(
+        kind == "word" and value.upper() == "SUM" and following[1] == "("
+        for (kind, value), following in zip(tokens, tokens[1:])
+    )
+
+
+def cte_names(sql):
+    """Return the lowercase names a statement defines in its WITH clause."""
+    return frozenset(name.strip('"').lower() for name in _CTE_NAME.findall(sql))
+
+
+def postgres_column_name(name):
+    """Map a DuckDB result column name to the one PostgreSQL gives the same expression.
+
+    DuckDB names unaliased expressions after their text ("sum(saleprice)",
+    "count_star()") and keeps the case of identifiers; PostgreSQL uses the
+    function name, "?column?" for other expressions, and folds identifiers to
+    lowercase, so results keep the same keys whichever backend served them.
+    """
+    cast = _CAST.match(name)
+    if cast:
+        return postgres_column_name(cast.group(1))
+    if name == "count_star()":
+        return "count"
+    function = _FUNCTION.match(name)
+    if function:
+        return function.group(1).lower()
+    if not re.fullmatch(r"\w+", name):
+        return "?column?"
+    return name.lower()
+
+
+class AnalyticsBackend:
+    """Run read-only queries against columnar DuckDB snapshots of PostgreSQL tables.
+
+    PostgreSQL stays the source of truth: every write goes there, and each
+    snapshot remembers the TableVersions version it was copied at. A SELECT is
+    served in-process only when every table it reads has a snapshot at the
+    current version; otherwise it runs on PostgreSQL and the stale snapshots
+    are refreshed in the background. Uploads refresh their table's snapshot
+    straight away. TableVersions only counts writes made through this
+    process, so writes by other workers or processes (or straight to
+    PostgreSQL) are only picked up once a snapshot is older than
+    ANALYTICS_SNAPSHOT_TTL seconds: it is then treated as stale. Queries DuckDB cannot parse or bind (PostgreSQL-only syntax)
+    also fall back to PostgreSQL; integer division truncates as it does in
+    PostgreSQL. A failed refresh is listed in stats(). The policy's statement
+    classification, row caps and timeout apply to both backends; the EXPLAIN
+    cost gate is PostgreSQL's own and is skipped here.
+    """
+
+    def __init__(self, engine, table_versions, policy, backend=ANALYTICS_BACKEND, path=ANALYTICS_DUCKDB_PATH,
+                 memory_limit=ANALYTICS_MEMORY_LIMIT, threads=ANALYTICS_THREADS, snapshot_ttl=ANALYTICS_SNAPSHOT_TTL):
+        if backend not in ("postgres", "duckdb"):
+            raise ValueError(f"Unknown ANALYTICS_BACKEND '{backend}'. Use 'postgres' or 'duckdb'.")
+        self.engine = engine
+        self.table_versions = table_versions
+        self.policy = policy
+        self.enabled = backend == "duckdb"
+        self.path = path
+        self.snapshot_ttl = snapshot_ttl
+        # PostgreSQL divides integers with truncation (7 / 2 = 3); DuckDB's default would return 3.5.
+        self._config = {"integer_division": True}
+        if memory_limit:
+            self._config["memory_limit"] = memory_limit
+        if threads:
+            self._config["threads"] = int(threads)
+        self._database = None
+        self._snapshots = {}
+        self._failed = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.served = 0
+        self.fallbacks = {}
+
+    def _connect(self):
+        """A new DuckDB connection (cursor) to the shared database; connections are not shared across threads."""
+        with self._lock:
+            if self._database is None:
+                import duckdb
+
+                self._database = duckdb.connect(self.path, config=self._config)
+            return self._database.cursor()
+
+    def refresh(self, table_name):
+        """Copy a PostgreSQL table into its DuckDB snapshot; returns the snapshot info.
+
+        A failure is recorded (see stats()) and re-raised; the table is not
+        retried in the background until it is written again or the TTL passes.
+        """
+        key = table_name.lower()
+        # Read the version first: a write that commits during the copy leaves the snapshot stale, never wrong.
+        version = dict(self.table_versions.snapshot([key])).get(key, 0)
+        try:
+            return self._copy(table_name, key, version)
+        except Exception as e:
+            with self._lock:
+                self._failed[key] = {"version": version, "error": str(e), "failed_at": time.time()}
+            raise
+
+    def _copy(self, table_name, key, version):
+        start = time.perf_counter()
+        quoted = self.engine.dialect.identifier_preparer.quote(table_name)
+        batches = iter_record_batches(self.engine, f"SELECT * FROM {quoted}")
+        try:
+            first = next(batches)
+            reader = pa.RecordBatchReader.from_batches(first.schema, itertools.chain([first], batches))
+            with self._write_lock:
+                connection = self._connect()
+                try:
+                    connection.register("snapshot_source", reader)
+                    # Replacing the table is transactional: running queries keep reading the old snapshot.
+                    connection.execute(f'CREATE OR REPLACE TABLE "{key}" AS SELECT * FROM snapshot_source')
+                    connection.unregister("snapshot_source")
+                    rows = connection.execute(f'SELECT COUNT(*) FROM "{key}"').fetchone()[0]
+                finally:
+                    connection.close()
+        finally:
+            batches.close()
+        info = {
+            "version": version,
+            "rows": rows,
+            "seconds": round(time.perf_counter() - start, 3),
+            "refreshed_at": time.time(),
+        }
+        with self._lock:
+            self._snapshots[key] = info
+            self._failed.pop(key, None)
+        logger.info("DuckDB snapshot of %s refreshed: %s rows in %ss", table_name, info["rows"], info["seconds"])
+        return info
+
+    def _refresh_in_background(self, tables):
+        with self._lock:
+            tables = [table for table in tables if table not in self._refreshing]
+            self._refreshing.update(tables)
+
+        def run(table_name):
+            try:
+                self.refresh(table_name)
+            except Exception as e:
+                # Not retried until the table is written again or the TTL passes (e.g. a view or a missing table).
+                logger.warning("DuckDB snapshot of %s not refreshed: %s", table_name, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(table_name)
+
+        for table_name in tables:
+            threading.Thread(target=run, args=(table_name,), name=f"duckdb-refresh-{table_name}", daemon=True).start()
+
+    def _servable(self, sql):
+        """True when every table the SELECT reads has a current, unexpired snapshot; schedules refreshes otherwise."""
+        if not self.enabled or not is_read_query(sql):
+            return False
+        if divides_sum(sql):
+            self._fallback("division")
+            return False
+        tables = referenced_tables(sql) - cte_names(sql)
+        if not tables:
+            return False
+        current = dict(self.table_versions.snapshot(tables))
+        now = time.time()
+        expired = lambda record, at: self.snapshot_ttl and now - record[at] > self.snapshot_ttl
+        with self._lock:
+            stale = [
+                table for table in tables
+                if self._snapshots.get(table, {}).get("version") != current[table]
+                or expired(self._snapshots[table], "refreshed_at")
+            ]
+            to_refresh = [
+                table for table in stale
+                if self._failed.get(table, {}).get("version") != current[table]
+                or expired(self._failed[table], "failed_at")
+            ]
+        if to_refresh:
+            self._refresh_in_background(to_refresh)
+        if stale:
+            self._fallback("stale")
+            return False
+        return True
+
+    def fetch(self, sql, max_rows):
+        """Return (columns, rows) of a read query from the snapshots, at most max_rows rows, or None to use PostgreSQL."""
+        if not self._servable(sql):
+            return None
+        return self._run(sql, lambda result: (
+            [postgres_column_name(column[0]) for column in result.description],
+            [tuple(row) for row in result.fetchmany(max_rows)],
+        ))
+
+    def fetch_arrow(self, sql):
+        """Return a read query's result as an Arrow table capped by the policy, or None to use PostgreSQL."""
+        if not self._servable(sql):
+            return None
+
+        def collect(result):
+            reader = result.fetch_record_batch(EXPORT_BATCH_SIZE)
+            table = pa.Table.from_batches(list(self.policy.capped(reader)), schema=reader.schema)
+            return table.rename_columns([postgres_column_name(name) for name in table.column_names])
+
+        return self._run(sql, collect)
+
+    def _run(self, sql, collect):
+        import duckdb
+
+        self.policy.classify(sql)
+        connection = self._connect()
+        timer = None
+        if self.policy.timeout_ms:
+            timer = threading.Timer(self.policy.timeout_ms / 1000, connection.interrupt)
+            timer.start()
+        try:
+            result = collect(connection.execute(sql))
+        except duckdb.InterruptException as e:
+            self.policy.raise_timeout(e)
+        except (duckdb.ParserException, duckdb.BinderException, duckdb.CatalogException,
+                duckdb.NotImplementedException) as e:
+            # Syntax DuckDB does not share with PostgreSQL.
+            logger.debug("DuckDB cannot run the query, using PostgreSQL: %s", e)
+            self._fallback("unsupported")
+            return None
+        except duckdb.Error as e:
+            logger.warning("DuckDB query failed, using PostgreSQL: %s", e)
+            self._fallback("error")
+            return None
+        finally:
+            if timer is not None:
+                timer.cancel()
+            connection.close()
+        with self._lock:
+            self.served += 1
+        ANALYTICS_QUERIES.labels("served").inc()
+        return result
+
+    def _fallback(self, reason):
+        with self._lock:
+            self.fallbacks[reason] = self.fallbacks.get(reason, 0) + 1
+        ANALYTICS_QUERIES.labels(reason).inc()
+
+    def stats(self):
+        with self._lock:
+            snapshots = {table: dict(info) for table, info in self._snapshots.items()}
+            failed = {table: dict(info) for table, info in self._failed.items()}
+            served, fallbacks = self.served, dict(self.fallbacks)
+            refreshing = sorted(self._refreshing)
+        current = dict(self.table_versions.snapshot(snapshots))
+        for table, info in snapshots.items():
+            info["fresh"] = info["version"] == current[table]
+        return {
+            "backend": "duckdb" if self.enabled else "postgres",
+            "path": self.path if self.enabled else None,
+            "served": served,
+            "fallbacks": fallbacks,
+            "refreshing": refreshing,
+            "snapshots": snapshots,
+            # Tables whose last refresh failed; their queries run on PostgreSQL.
+            "failed": failed,
+        }
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from app.database import DB_POOL_SIZE
+from app.metrics import LLM_RATE_LIMIT_RETRIES
+from app.prompt_cache import normalize_prompt
+from app.query_policy import QueryRejected
+from app.result_cache import is_read_query
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_PROMPTS = int(os.getenv("BATCH_MAX_PROMPTS", "100"))
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "8"))
+BATCH_QUERY_CONCURRENCY = int(os.getenv("BATCH_QUERY_CONCURRENCY", str(max(1, DB_POOL_SIZE // 2))))
+BATCH_RATE_LIMIT_RETRIES = int(os.getenv("BATCH_RATE_LIMIT_RETRIES", "5"))
+BATCH_BACKOFF_SECONDS = float(os.getenv("BATCH_BACKOFF_SECONDS", "1"))
+BATCH_BACKOFF_MAX_SECONDS = float(os.getenv("BATCH_BACKOFF_MAX_SECONDS", "30"))
+
+
+def rate_limit_delay(error):
+    """Seconds the provider asked us to wait when an error (or its cause) is a 429, 0 when it advised none, else None."""
+    while error is not None:
+        if getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError":
+            response = getattr(error, "response", None)
+            retry_after = response.headers.get("retry-after") if response is not None else None
+            try:
+                return float(retry_after) if retry_after else 0.0
+            except ValueError:
+                return 0.0
+        error = error.__cause__ or error.__context__
+    return None
+
+
+class BatchRunner:
+    """Answer many questions at once, streaming each result as soon as it is ready.
+
+    SQL is generated for at most BATCH_LLM_CONCURRENCY questions at a time;
+    rate-limited LLM calls are retried with jittered exponential backoff
+    (honouring Retry-After). Repeated questions share one generation, and
+    questions whose generated SQL is identical share one execution. Distinct
+    SELECTs run in parallel, at most BATCH_QUERY_CONCURRENCY at a time so a
+    batch never holds the whole connection pool. Data-modifying statements
+    are not executed in a batch.
+    """
+
+    def __init__(self, llm_service, llm_concurrency=BATCH_LLM_CONCURRENCY, query_concurrency=BATCH_QUERY_CONCURRENCY,
+                 retries=BATCH_RATE_LIMIT_RETRIES, backoff_seconds=BATCH_BACKOFF_SECONDS,
+                 backoff_max_seconds=BATCH_BACKOFF_MAX_SECONDS):
+        self.llm_service = llm_service
+        self.llm_concurrency = llm_concurrency
+        self.query_concurrency = query_concurrency
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+
+    async def run(self, prompts, dataset_name=None, page_size=100):
+        """Yield one result dict per prompt in completion order, then a summary dict."""
+        llm_slots = asyncio.Semaphore(self.llm_concurrency)
+        query_slots = asyncio.Semaphore(self.query_concurrency)
+        generations, executions = {}, {}
+        start = time.perf_counter()
+
+        async def generate(prompt):
+            async with llm_slots:
+                return await self._generate(prompt, dataset_name)
+
+        async def execute(sql):
+            async with query_slots:
+                return await self.llm_service.aexecute_query_page(sql, page_size)
+
+        async def answer(index, prompt):
+            result = {"index": index, "prompt": prompt}
+            try:
+                key = normalize_prompt(prompt)
+                if key not in generations:
+                    generations[key] = asyncio.ensure_future(generate(prompt))
+                sql = await asyncio.shield(generations[key])
+                result["generated_sql"] = sql
+                if not is_read_query(sql):
+                    raise ValueError("Only SELECT queries are executed in a batch; use /etl/execute/ instead.")
+                sql_key = " ".join(sql.split())
+                result["shared"] = sql_key in executions
+                if not result["shared"]:
+                    executions[sql_key] = asyncio.ensure_future(execute(sql))
+                page = await asyncio.shield(executions[sql_key])
+                result.update(columns=page["columns"], rows=page["rows"], has_more=page["has_more"])
+            except QueryRejected as e:
+                result["error"] = e.to_dict()
+            except Exception as e:
+                result["error"] = {"error": "failed", "message": str(e)}
+            result["seconds"] = round(time.perf_counter() - start, 3)
+            return result
+
+        tasks = [asyncio.ensure_future(answer(index, prompt)) for index, prompt in enumerate(prompts)]
+        errors = 0
+        try:
+            for finished in asyncio.as_completed(tasks):
+                result = await finished
+                errors += "error" in result
+                yield result
+        finally:
+            # A client that disconnects mid-stream cancels whatever is still pending.
+            for task in tasks + list(generations.values()) + list(executions.values()):
+                task.cancel()
+        yield {
+            "summary": {
+                "questions": len(prompts),
+                "generations": len(generations),
+                "distinct_queries": len(executions),
+                "errors": errors,
+                "seconds": round(time.perf_counter() - start, 3),
+            }
+        }
+
+    async def _generate(self, prompt, dataset_name):
+        """Generate SQL for one question, backing off and retrying while the LLM is rate limited."""
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.llm_service.agenerate_sql_for_question(prompt, dataset_name)
+            except Exception as e:
+                delay = rate_limit_delay(e)
+                if delay is None or attempt == self.retries:
+                    raise
+                backoff = min(self.backoff_max_seconds, self.backoff_seconds * 2 ** attempt)
+                delay = max(delay, backoff * random.uniform(0.5, 1.0))
+                LLM_RATE_LIMIT_RETRIES.inc()
+                logger.warning("LLM rate limited; retrying in %.1fs (attempt %s)", delay, attempt + 1)
+                await asyncio.sleep(delay)
@@ -1,7 +1,189 @@
-from sqlalchemy import create_engine
+import logging
 import os
+import threading
+import time
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
+
+# Pool sizing is per process: keep workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+# below the server's max_connections.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "300000"))
+DB_COMPILED_CACHE_SIZE = int(os.getenv("DB_COMPILED_CACHE_SIZE", "1000"))
+DB_PREPARED_STATEMENT_CACHE_SIZE = int(os.getenv("DB_PREPARED_STATEMENT_CACHE_SIZE", "256"))
+
+_engines = {}
+_async_engines = {}
+_mongo_clients = {}
+_registry_lock = threading.Lock()
+
+
+class PoolWaitMetrics:
+    """Counters for how long callers waited to check a connection out of a pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, seconds, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.total_wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": round(self.total_wait_seconds / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                "max_wait_ms": round(self.max_wait_seconds * 1000, 3),
+            }
+
+
+class _TimedPoolMixin:
+    """Time every checkout; the metrics object survives pool recreation on dispose()."""
+
+    def __init__(self, *args, wait_metrics=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_metrics = wait_metrics or PoolWaitMetrics()
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.wait_metrics = self.wait_metrics
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.wait_metrics.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.wait_metrics.record(time.perf_counter() - start)
+        return connection
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def _pool_options(url, poolclass):
+    if url.get_backend_name() == "sqlite":
+        # SQLite picks its own pool per file/memory database.
+        return {"pool_pre_ping": True}
+    return {
+        "poolclass": poolclass,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+        "query_cache_size": DB_COMPILED_CACHE_SIZE,
+    }
+
+
+def get_engine(db_url=None):
+    """Return the shared engine for a database URL, creating it on first use."""
+    url = make_url(db_url or DATABASE_URL)
+    key = url.render_as_string(hide_password=False)
+    with _registry_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            options = _pool_options(url, TimedQueuePool)
+            if url.get_backend_name() == "postgresql" and DB_STATEMENT_TIMEOUT_MS:
+                options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+            engine = _engines[key] = create_engine(url, **options)
+        return engine
+
+
+def get_async_engine(db_url=None):
+    """Return the shared asyncpg engine for a PostgreSQL URL; None when unavailable."""
+    url = make_url(db_url or DATABASE_URL)
+    if url.get_backend_name() != "postgresql":
+        return None
+    url = url.set(drivername="postgresql+asyncpg")
+    key = url.render_as_string(hide_password=False)
+    with _registry_lock:
+        engine = _async_engines.get(key)
+        if engine is None:
+            try:
+                from sqlalchemy.ext.asyncio import create_async_engine
+                options = _pool_options(url, TimedAsyncQueuePool)
+                # asyncpg prepares every statement; keep the per-connection cache bounded.
+                options["connect_args"] = {"prepared_statement_cache_size": DB_PREPARED_STATEMENT_CACHE_SIZE}
+                if DB_STATEMENT_TIMEOUT_MS:
+                    options["connect_args"]["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+                engine = _async_engines[key] = create_async_engine(url, **options)
+            except ImportError:
+                logger.warning("asyncpg is not installed; async queries will run on the worker pool.")
+                return None
+        return engine
+
+
+def get_sql_engine():
+    """Return the shared engine for DATABASE_URL."""
+    return get_engine()
+
+
+def get_mongo_client(mongo_url=None):
+    """Return the shared MongoDB client for a URL (pymongo pools connections internally)."""
+    from pymongo import MongoClient
+
+    mongo_url = mongo_url or MONGO_URL
+    with _registry_lock:
+        client = _mongo_clients.get(mongo_url)
+        if client is None:
+            client = _mongo_clients[mongo_url] = MongoClient(
+                mongo_url, maxPoolSize=DB_POOL_SIZE + DB_MAX_OVERFLOW
+            )
+        return client
+
+
+def _pool_status(engine):
+    pool = engine.pool
+    status = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+        })
+    metrics = getattr(pool, "wait_metrics", None)
+    if metrics is not None:
+        status["wait"] = metrics.snapshot()
+    return status
 
-DATABASE_URL = os.getenv('DATABASE_URL')
-engine = create_engine(DATABASE_URL)
 
-print(f"DEBUG: Using connection string: {DATABASE_URL}")
\ No newline at end of file
+def pool_stats():
+    """Report pool occupancy and checkout wait times for every registered engine."""
+    with _registry_lock:
+        engines = list(_engines.values())
+        async_engines = list(_async_engines.values())
+    stats = {}
+    for engine in engines:
+        stats[engine.url.render_as_string(hide_password=True)] = _pool_status(engine)
+    for engine in async_engines:
+        stats[engine.url.render_as_string(hide_password=True)] = _pool_status(engine.sync_engine)
+    return stats
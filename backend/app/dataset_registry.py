@@ -0,0 +1,247 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from sqlalchemy import Column, DateTime, MetaData, String, Table, delete, inspect, insert, select
+from sqlalchemy.exc import IntegrityError
+from app.metadata_llm import MetadataManager
+from app.prompt_builder import dataset_list, lexical_terms
+from app.sql_rewriter import SQLRewriter
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_DB_CHECK_SECONDS = float(os.getenv("REGISTRY_DB_CHECK_SECONDS", "30"))
+
+# Routing weights: a question term matching the table name counts most, then column names, then descriptions.
+_NAME_WEIGHT, _COLUMN_WEIGHT, _DESCRIPTION_WEIGHT = 3, 2, 1
+_TIME_TYPES = ("DATE", "TIMESTAMP", "DATETIME")
+
+registry_metadata = MetaData()
+etl_datasets = Table(
+    "etl_datasets",
+    registry_metadata,
+    Column("table_name", String(63), primary_key=True),
+    Column("registered_at", DateTime(timezone=True), nullable=False),
+)
+
+
+class DatasetRegistry:
+    """In-memory registry of every queryable dataset, keyed by table name.
+
+    Datasets come from the metadata JSON (one dataset or {"datasets": [...]})
+    and from tables registered after an upload, whose columns are introspected
+    from the database; declared metadata wins and introspection only adds the
+    columns the file does not describe. Registered tables are recorded in the
+    etl_datasets table so other processes and restarts pick them up.
+
+    Table names, column names and descriptions are kept in an inverted term
+    index, so routing a question costs one lookup per question term however
+    many datasets exist. refresh() reloads the file when its mtime changes and
+    re-reads the database at most every REGISTRY_DB_CHECK_SECONDS; a change
+    bumps `version` and drops only the affected datasets' SQL rewriters.
+    """
+
+    def __init__(self, metadata_path, engine, db_check_seconds=REGISTRY_DB_CHECK_SECONDS):
+        self.metadata_manager = MetadataManager(metadata_path)
+        self.engine = engine
+        self.db_check_seconds = db_check_seconds
+        self.declared = {}
+        self.introspected = {}
+        self.datasets = {}
+        self.index = {}
+        self.default_name = None
+        self.version = 0
+        self.hash = None
+        self._rewriters = {}
+        self._lock = threading.RLock()
+        self._db_checked_at = None
+        self.metadata_manager.load_metadata()
+        self._load_declared()
+        self._rebuild(set(self.declared))
+
+    def refresh(self):
+        """Pick up metadata file edits and tables registered elsewhere; returns True when anything changed."""
+        with self._lock:
+            changed = set()
+            if self.metadata_manager.reload_if_changed():
+                previous = self.declared
+                self._load_declared()
+                changed |= {
+                    name for name in set(previous) | set(self.declared)
+                    if previous.get(name) != self.declared.get(name)
+                }
+            now = time.monotonic()
+            if self._db_checked_at is None or now - self._db_checked_at >= self.db_check_seconds:
+                self._db_checked_at = now
+                changed |= self._check_database()
+            if changed:
+                self._rebuild(changed)
+            return bool(changed)
+
+    def refresh_due(self):
+        """True when refresh() would read the metadata file or the database rather than return straight away."""
+        try:
+            mtime = os.path.getmtime(self.metadata_manager.metadata_path)
+        except OSError:
+            mtime = self.metadata_manager.metadata_mtime
+        return mtime != self.metadata_manager.metadata_mtime or self._db_checked_at is None \
+            or time.monotonic() - self._db_checked_at >= self.db_check_seconds
+
+    def register_table(self, table_name):
+        """Record and introspect a table written by an upload; returns True when its schema changed."""
+        with self._lock:
+            try:
+                registry_metadata.create_all(self.engine)
+                with self.engine.begin() as connection:
+                    connection.execute(insert(etl_datasets).values(
+                        table_name=table_name, registered_at=datetime.now(timezone.utc)
+                    ))
+            except IntegrityError:
+                pass
+            columns = self._introspect(table_name)
+            if columns is None or columns == self.introspected.get(table_name):
+                return False
+            self.introspected[table_name] = columns
+            self._rebuild({table_name})
+            return True
+
+    def route(self, question):
+        """Return the name of the dataset a question is most likely about (the default on no match)."""
+        scores = {}
+        for term in lexical_terms(question):
+            for name, weight in self.index.get(term, {}).items():
+                scores[name] = scores.get(name, 0) + weight
+        if not scores:
+            return self.default_name
+        # Ties go to the default dataset, then to the first declared.
+        order = list(self.datasets)
+        return max(scores, key=lambda name: (scores[name], name == self.default_name, -order.index(name)))
+
+    def get(self, dataset_name=None):
+        """Metadata of a dataset (the default one when no name is given)."""
+        dataset = self.find(dataset_name or self.default_name)
+        if dataset is None:
+            raise ValueError(f"Unknown dataset '{dataset_name}'.")
+        return dataset
+
+    def find(self, dataset_name):
+        """Metadata of a dataset, matching the name case-insensitively; None when unknown."""
+        dataset = self.datasets.get(dataset_name)
+        if dataset is None and dataset_name:
+            dataset = next(
+                (value for name, value in self.datasets.items() if name.lower() == dataset_name.lower()), None
+            )
+        return dataset
+
+    def metadata(self):
+        """All datasets as a {"datasets": [...]} document, default dataset first."""
+        return {"datasets": list(self.datasets.values())}
+
+    def rewriter(self, dataset_name=None):
+        """The compiled SQLRewriter of a dataset, built on first use."""
+        dataset = self.get(dataset_name)
+        name = dataset["dataset_name"]
+        with self._lock:
+            rewriter = self._rewriters.get(name)
+            if rewriter is None:
+                rewriter = self._rewriters[name] = SQLRewriter(dataset)
+            return rewriter
+
+    def describe(self):
+        return {
+            "version": self.version,
+            "default": self.default_name,
+            "datasets": {
+                name: {
+                    "columns": list(dataset["columns"]),
+                    "time_filter_column": dataset.get("time_filter_column"),
+                    "declared": name in self.declared,
+                    "introspected": name in self.introspected,
+                }
+                for name, dataset in self.datasets.items()
+            },
+        }
+
+    def _load_declared(self):
+        datasets = dataset_list(self.metadata_manager.get_metadata())
+        self.declared = {dataset["dataset_name"]: dataset for dataset in datasets}
+        self.default_name = datasets[0]["dataset_name"] if datasets else None
+
+    def _check_database(self):
+        """Re-introspect registered tables; returns the names whose schema appeared, changed or vanished."""
+        try:
+            with self.engine.connect() as connection:
+                if not inspect(connection).has_table(etl_datasets.name):
+                    return set()
+                registered = connection.execute(select(etl_datasets.c.table_name)).scalars().all()
+        except Exception as e:
+            logger.warning("Registered datasets not read from the database: %s", e)
+            return set()
+        changed = set()
+        for table_name in registered:
+            columns = self._introspect(table_name)
+            if columns is None:
+                # The table was dropped; forget it everywhere.
+                with self.engine.begin() as connection:
+                    connection.execute(delete(etl_datasets).where(etl_datasets.c.table_name == table_name))
+            if columns != self.introspected.get(table_name):
+                changed.add(table_name)
+                if columns is None:
+                    self.introspected.pop(table_name, None)
+                else:
+                    self.introspected[table_name] = columns
+        return changed
+
+    def _introspect(self, table_name):
+        """{column: SQL type} of a table in column order, or None when it does not exist."""
+        try:
+            columns = inspect(self.engine).get_columns(table_name)
+        except Exception:
+            return None
+        return {column["name"]: str(column["type"]) for column in columns} or None
+
+    def _merge(self, name):
+        declared = self.declared.get(name)
+        columns = self.introspected.get(name, {})
+        if declared is None:
+            dataset = {
+                "dataset_name": name,
+                "columns": {column: f"{sql_type.lower()} column" for column, sql_type in columns.items()},
+                "purpose": f"Analyze the data uploaded into the {name} table.",
+            }
+            time_column = next(
+                (column for column, sql_type in columns.items() if sql_type.upper().startswith(_TIME_TYPES)), None
+            )
+            if time_column is not None:
+                dataset["time_filter_column"] = time_column
+            return dataset
+        dataset = copy.deepcopy(declared)
+        known = {column.lower() for column in dataset["columns"]}
+        for column, sql_type in columns.items():
+            if column.lower() not in known:
+                dataset["columns"][column] = f"{sql_type.lower()} column"
+        return dataset
+
+    def _rebuild(self, changed):
+        names = list(self.declared) + [name for name in self.introspected if name not in self.declared]
+        self.datasets = {name: self._merge(name) for name in names}
+        index = {}
+        for name, dataset in self.datasets.items():
+            weighted = [(lexical_terms(name), _NAME_WEIGHT)]
+            for column, description in dataset["columns"].items():
+                weighted.append((lexical_terms(column), _COLUMN_WEIGHT))
+                weighted.append((lexical_terms(description), _DESCRIPTION_WEIGHT))
+            for terms, weight in weighted:
+                for term in terms:
+                    postings = index.setdefault(term, {})
+                    postings[name] = max(postings.get(name, 0), weight)
+        self.index = index
+        for name in changed:
+            self._rewriters.pop(name, None)
+        self.version += 1
+        self.hash = hashlib.sha256(json.dumps(self.datasets, sort_keys=True).encode("utf-8")).hexdigest()
+        logger.info("Dataset registry v%s: %s dataset(s), changed: %s", self.version, len(names), sorted(changed))
@@ -0,0 +1,242 @@
+import csv
+import io
+import json
+import tempfile
+from decimal import Decimal
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl import Workbook
+from sqlalchemy import text
+
+EXPORT_BATCH_SIZE = 5000
+STREAM_CHUNK_BYTES = 64 * 1024
+
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+# Arrow types for PostgreSQL type OIDs; other types are exported as their text form.
+_PG_ARROW_TYPES = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    26: pa.int64(),
+    700: pa.float32(),
+    701: pa.float64(),
+    18: pa.string(),
+    19: pa.string(),
+    25: pa.string(),
+    1042: pa.string(),
+    1043: pa.string(),
+    1082: pa.date32(),
+    1083: pa.time64("us"),
+    1114: pa.timestamp("us"),
+    1184: pa.timestamp("us", tz="UTC"),
+    17: pa.binary(),
+}
+_PG_NUMERIC = 1700
+_PG_JSON = (114, 3802)
+# Scale for NUMERIC columns without a declared one (e.g. SUM and AVG results).
+NUMERIC_DEFAULT_SCALE = 18
+
+
+def _query_batches(engine, sql, batch_size, prepare):
+    """Yield (cursor description, rows) batches of a query through a server-side cursor."""
+    with engine.connect() as connection:
+        if prepare is not None:
+            prepare(connection)
+        result = connection.execution_options(stream_results=True, max_row_buffer=batch_size).execute(
+            text(sql)
+        )
+        # A named (server-side) cursor only has a description once rows are fetched,
+        # while a result exhausted by that fetch has already closed its cursor.
+        cursor = result.cursor
+        description = getattr(cursor, "description", None)
+        rows = result.fetchmany(batch_size)
+        description = description or getattr(cursor, "description", None) or [(name, None) for name in result.keys()]
+        # Always yield the first batch so empty tables still produce a header.
+        yield description, rows
+        while rows:
+            rows = result.fetchmany(batch_size)
+            if rows:
+                yield description, rows
+
+
+def iter_query_batches(engine, sql, batch_size=EXPORT_BATCH_SIZE, prepare=None):
+    """Yield (columns, rows) batches of a query through a server-side cursor.
+
+    prepare, when given, is called with the connection before the query runs
+    (in the same transaction), e.g. to set a statement timeout.
+    """
+    for description, rows in _query_batches(engine, sql, batch_size, prepare):
+        yield [column[0] for column in description], rows
+
+
+def iter_table_batches(engine, table_name, batch_size=EXPORT_BATCH_SIZE):
+    """Yield (columns, rows) batches from a table through a server-side cursor."""
+    quoted_table = engine.dialect.identifier_preparer.quote(table_name)
+    return iter_query_batches(engine, f"SELECT * FROM {quoted_table}", batch_size)
+
+
+def arrow_schema(engine, description):
+    """Arrow schema of a result from its cursor description (the database's column types).
+
+    Types come from the columns rather than from the values of a first batch,
+    so a column that is NULL throughout that batch still gets its real type.
+    Returns None for databases other than PostgreSQL, whose types are then
+    inferred from the values.
+    """
+    if engine.dialect.name != "postgresql":
+        return None
+    fields = []
+    for column in description:
+        name, type_code = column[0], column[1]
+        if type_code == _PG_NUMERIC:
+            precision, scale = (column[4], column[5]) if len(column) > 5 else (None, None)
+            if precision is None or scale is None or precision > 38:
+                precision, scale = 38, NUMERIC_DEFAULT_SCALE
+            field_type = pa.decimal128(precision, scale)
+        else:
+            field_type = _PG_ARROW_TYPES.get(type_code, pa.string())
+        fields.append(pa.field(name, field_type))
+    return pa.schema(fields)
+
+
+def _arrow_values(values, field_type, type_code):
+    """Convert one column of DB values to what pyarrow accepts for the column's Arrow type."""
+    if pa.types.is_decimal(field_type):
+        quantum = Decimal(1).scaleb(-field_type.scale)
+        return [
+            None if value is None or not value.is_finite()
+            else value if value.as_tuple().exponent >= -field_type.scale else value.quantize(quantum)
+            for value in values
+        ]
+    if pa.types.is_binary(field_type):
+        return [None if value is None else bytes(value) for value in values]
+    if pa.types.is_string(field_type) and type_code not in (18, 19, 25, 1042, 1043):
+        dump = json.dumps if type_code in _PG_JSON else str
+        return [None if value is None else dump(value) for value in values]
+    return values
+
+
+def rows_to_record_batch(columns, rows, schema=None, type_codes=None):
+    """Transpose a batch of DB rows into an Arrow record batch (optionally cast to a schema)."""
+    arrays = []
+    for idx, values in enumerate(zip(*rows) if rows else [[] for _ in columns]):
+        field_type = schema.field(idx).type if schema is not None else None
+        if field_type is not None and type_codes is not None:
+            values = _arrow_values(values, field_type, type_codes[idx])
+        array = pa.array(values, type=field_type)
+        if field_type is None and pa.types.is_decimal(array.type):
+            # Precision inferred from one batch is too narrow for the rest; widen it.
+            array = array.cast(pa.decimal128(38, max(array.type.scale, 9)))
+        arrays.append(array)
+    return pa.RecordBatch.from_arrays(arrays, names=columns)
+
+
+def iter_record_batches(engine, sql, batch_size=EXPORT_BATCH_SIZE, prepare=None):
+    """Yield Arrow record batches for a query, typed from the result's column types.
+
+    Without column types (other databases) later batches use the first batch's schema.
+    """
+    schema = type_codes = None
+    for batch_number, (description, rows) in enumerate(_query_batches(engine, sql, batch_size, prepare)):
+        if batch_number == 0:
+            schema = arrow_schema(engine, description)
+            type_codes = [column[1] for column in description]
+        batch = rows_to_record_batch([column[0] for column in description], rows, schema, type_codes)
+        schema = batch.schema
+        yield batch
+
+
+def fetch_arrow_table(engine, sql, batch_size=EXPORT_BATCH_SIZE, prepare=None, wrap=None):
+    """Fetch a query result as an Arrow table without building Python dicts per row.
+
+    wrap, when given, wraps the record batch iterator (e.g. to cap the row count).
+    """
+    batches = iter_record_batches(engine, sql, batch_size, prepare)
+    return pa.Table.from_batches(list(wrap(batches) if wrap is not None else batches))
+
+
+def iter_arrow_ipc(engine, sql, batch_size=EXPORT_BATCH_SIZE, prepare=None):
+    """Stream a query result in the Arrow IPC streaming format, one record batch at a time."""
+    sink = io.BytesIO()
+    writer = None
+    for batch in iter_record_batches(engine, sql, batch_size, prepare):
+        if writer is None:
+            writer = pa.ipc.new_stream(sink, batch.schema)
+        writer.write_batch(batch)
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate(0)
+    writer.close()
+    yield sink.getvalue()
+
+
+def iter_csv(engine, table_name, batch_size=EXPORT_BATCH_SIZE):
+    """Stream a table as CSV, encoding one batch of rows at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for batch_number, (columns, rows) in enumerate(iter_table_batches(engine, table_name, batch_size)):
+        if batch_number == 0:
+            writer.writerow(columns)
+        writer.writerows(rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate(0)
+
+
+def iter_xlsx(engine, table_name, batch_size=EXPORT_BATCH_SIZE):
+    """Stream a table as XLSX built with a write-only (constant memory) workbook.
+
+    The zip container needs its directory written last, so the workbook is
+    spooled to an anonymous temporary file that is removed on close.
+    """
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(title=table_name[:31])
+    for batch_number, (columns, rows) in enumerate(iter_table_batches(engine, table_name, batch_size)):
+        if batch_number == 0:
+            worksheet.append(columns)
+        for row in rows:
+            worksheet.append(list(row))
+    with tempfile.TemporaryFile() as spool:
+        workbook.save(spool)
+        spool.seek(0)
+        while True:
+            data = spool.read(STREAM_CHUNK_BYTES)
+            if not data:
+                break
+            yield data
+
+
+def iter_parquet(engine, table_name, batch_size=EXPORT_BATCH_SIZE):
+    """Stream a table as Parquet, writing one row group per batch of Arrow records."""
+    quoted_table = engine.dialect.identifier_preparer.quote(table_name)
+    with tempfile.TemporaryFile() as spool:
+        writer = None
+        try:
+            for batch in iter_record_batches(engine, f"SELECT * FROM {quoted_table}", batch_size):
+                if writer is None:
+                    writer = pq.ParquetWriter(spool, batch.schema)
+                writer.write_batch(batch)
+        finally:
+            if writer is not None:
+                writer.close()
+        spool.seek(0)
+        while True:
+            data = spool.read(STREAM_CHUNK_BYTES)
+            if not data:
+                break
+            yield data
+
+
+EXPORTERS = {
+    "csv": iter_csv,
+    "xlsx": iter_xlsx,
+    "parquet": iter_parquet,
+}
@@ -0,0 +1,322 @@
+import csv
+import hashlib
+import io
+import json
+import logging
+import time
+import pandas as pd
+from psycopg2.errors import UniqueViolation
+from app.metrics import INGEST_ROWS, timed
+
+logger = logging.getLogger(__name__)
+
+# Hashes of chunks already merged into a table, so re-uploads skip them.
+CHUNK_HASH_TABLE = "etl_chunk_hashes"
+
+
+def prepare_chunk(chunk, date_columns=("Date",)):
+    """Normalize a raw CSV chunk before it is written to the database."""
+    for column in date_columns:
+        if column in chunk.columns:
+            chunk[column] = pd.to_datetime(chunk[column], format="%m/%d/%Y", errors="coerce").dt.date
+    chunk.columns = [col.lower() for col in chunk.columns]
+    return chunk
+
+
+def chunk_digest(chunk, key_columns=()):
+    """Content hash of a prepared chunk: its columns, the merge key and every value."""
+    digest = hashlib.sha256(json.dumps([list(chunk.columns), list(key_columns)]).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(chunk, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+class CopyIngestor:
+    """Stream DataFrame chunks into a table using PostgreSQL COPY FROM STDIN."""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def supports_copy(self):
+        """Return True when the engine's driver exposes COPY (psycopg2)."""
+        return self.engine.dialect.name == "postgresql" and self.engine.dialect.driver == "psycopg2"
+
+    def table_ddl(self, table_name, sample_chunk, column_types=None):
+        """Infer the CREATE TABLE statement for a chunk's columns and dtypes (column_types override)."""
+        ddl = pd.io.sql.get_schema(sample_chunk, table_name, con=self.engine, dtype=column_types)
+        return ddl.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1)
+
+    def create_table(self, cursor, table_name, sample_chunk, if_exists="append", column_types=None):
+        """Create the target table once, up front, from the first chunk."""
+        if if_exists == "replace":
+            cursor.execute(f"DROP TABLE IF EXISTS {self.engine.dialect.identifier_preparer.quote(table_name)}")
+            self.forget_chunks(cursor, table_name)
+        cursor.execute(self.table_ddl(table_name, sample_chunk, column_types))
+
+    @staticmethod
+    def integer_columns(cursor, table_name):
+        """Names of a table's integer columns."""
+        cursor.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() "
+            "AND table_name = %s AND data_type IN ('smallint', 'integer', 'bigint')",
+            (table_name,),
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+    def widen_columns(self, cursor, tables, chunk, integer_columns):
+        """Switch integer columns to DOUBLE PRECISION when a chunk carries fractional values for them.
+
+        integer_columns is updated in place; tables are altered together (e.g. a target and its staging table).
+        """
+        quote = self.engine.dialect.identifier_preparer.quote
+        for column in sorted(col for col in integer_columns if col in chunk.columns):
+            if pd.api.types.is_float_dtype(chunk[column]):
+                for table in tables:
+                    cursor.execute(f"ALTER TABLE {quote(table)} ALTER COLUMN {quote(column)} TYPE DOUBLE PRECISION")
+                integer_columns.discard(column)
+                logger.info("Column %s of %s widened to DOUBLE PRECISION for fractional values.", column, tables[0])
+
+    @staticmethod
+    def copy_chunk(cursor, copy_sql, chunk):
+        buffer = io.StringIO()
+        chunk.to_csv(buffer, index=False, header=False, quoting=csv.QUOTE_MINIMAL)
+        buffer.seek(0)
+        cursor.copy_expert(copy_sql, buffer)
+
+    def copy_chunks(self, chunks, table_name, if_exists="append", column_types=None):
+        """Write every chunk with COPY inside one transaction and return load statistics."""
+        start = time.perf_counter()
+        total_rows = 0
+        preparer = self.engine.dialect.identifier_preparer
+        raw_connection = self.engine.raw_connection()
+        try:
+            cursor = raw_connection.cursor()
+            copy_sql = None
+            for idx, chunk in enumerate(chunks):
+                if copy_sql is None:
+                    self.create_table(cursor, table_name, chunk, if_exists=if_exists, column_types=column_types)
+                    column_list = ", ".join(preparer.quote(col) for col in chunk.columns)
+                    copy_sql = (
+                        f"COPY {preparer.quote(table_name)} ({column_list}) "
+                        f"FROM STDIN WITH (FORMAT csv)"
+                    )
+                    integer_columns = self.integer_columns(cursor, table_name)
+                with timed("ingest_chunk"):
+                    self.widen_columns(cursor, [table_name], chunk, integer_columns)
+                    self.copy_chunk(cursor, copy_sql, chunk)
+                total_rows += len(chunk)
+                INGEST_ROWS.labels(table_name).inc(len(chunk))
+                logger.info("Chunk %s: %s rows copied to %s. Total so far: %s rows.", idx + 1, len(chunk), table_name, total_rows)
+            raw_connection.commit()
+        except Exception:
+            raw_connection.rollback()
+            raise
+        finally:
+            raw_connection.close()
+        return self._stats(table_name, total_rows, start)
+
+    def insert_chunks(self, chunks, table_name, if_exists="append", column_types=None):
+        """Fallback for engines without COPY: multi-row INSERTs through DataFrame.to_sql."""
+        start = time.perf_counter()
+        total_rows = 0
+        for idx, chunk in enumerate(chunks):
+            with timed("ingest_chunk"):
+                chunk.to_sql(
+                    table_name,
+                    con=self.engine,
+                    if_exists=if_exists if idx == 0 else "append",
+                    index=False,
+                    method="multi",
+                    dtype=column_types,
+                )
+            total_rows += len(chunk)
+            INGEST_ROWS.labels(table_name).inc(len(chunk))
+            logger.info("Chunk %s: %s rows written to %s. Total so far: %s rows.", idx + 1, len(chunk), table_name, total_rows)
+        return self._stats(table_name, total_rows, start)
+
+    def merge_chunks(self, chunks, table_name, key_columns, column_types=None):
+        """Upsert chunks on a natural key through a staging table, skipping chunks loaded before.
+
+        Each new chunk is de-duplicated on the key, COPYed into a temporary
+        staging table and merged with INSERT ... ON CONFLICT DO UPDATE; rows
+        whose values did not change are left untouched. A chunk whose content
+        hash was already merged into the table is skipped without touching the
+        database, so a re-upload costs roughly the size of what changed.
+        A stored hash means the chunk's rows are all still in the table: when a
+        merge updates existing rows, the hashes of chunks from earlier uploads
+        are dropped, so re-uploading an older version of a file merges it again.
+        Rows with a NULL key column cannot be matched and are rejected.
+        """
+        start = time.perf_counter()
+        key_columns = [col.lower() for col in key_columns]
+        preparer = self.engine.dialect.identifier_preparer
+        counts = dict.fromkeys(
+            ("inserted", "updated", "skipped_rows", "skipped_chunks", "rejected_rows"), 0
+        )
+        total_rows = 0
+        raw_connection = self.engine.raw_connection()
+        try:
+            cursor = raw_connection.cursor()
+            self.ensure_chunk_hash_table(cursor)
+            cursor.execute(f"SELECT chunk_hash FROM {CHUNK_HASH_TABLE} WHERE table_name = %s", (table_name,))
+            seen = {row[0] for row in cursor.fetchall()}
+            merged = set()
+            copy_sql = merge_sql = None
+            for idx, chunk in enumerate(chunks):
+                total_rows += len(chunk)
+                digest = chunk_digest(chunk, key_columns)
+                if digest in seen:
+                    counts["skipped_chunks"] += 1
+                    counts["skipped_rows"] += len(chunk)
+                    logger.info("Chunk %s: unchanged, skipped %s rows for %s.", idx + 1, len(chunk), table_name)
+                    continue
+                if merge_sql is None:
+                    missing = [col for col in key_columns if col not in chunk.columns]
+                    if missing:
+                        raise ValueError(f"Natural key columns missing from the upload: {', '.join(missing)}")
+                    staging = self.prepare_merge(cursor, table_name, chunk, key_columns, column_types)
+                    columns = list(chunk.columns)
+                    copy_sql = (
+                        f"COPY {preparer.quote(staging)} ({', '.join(preparer.quote(col) for col in columns)}) "
+                        f"FROM STDIN WITH (FORMAT csv)"
+                    )
+                    merge_sql = self.merge_sql(table_name, staging, columns, key_columns)
+                    integer_columns = self.integer_columns(cursor, table_name)
+
+                with timed("ingest_chunk"):
+                    self.widen_columns(cursor, [table_name, staging], chunk, integer_columns)
+                    keyed = chunk.dropna(subset=key_columns)
+                    counts["rejected_rows"] += len(chunk) - len(keyed)
+                    keyed = keyed.drop_duplicates(subset=key_columns, keep="last")
+                    self.copy_chunk(cursor, copy_sql, keyed)
+                    cursor.execute(merge_sql)
+                    inserted, updated = cursor.fetchone()
+                    cursor.execute(f"TRUNCATE {preparer.quote(staging)}")
+                    merged.add(digest)
+                    if updated:
+                        # Rows of earlier uploads' chunks may have changed; only this upload's stay valid.
+                        cursor.execute(
+                            f"DELETE FROM {CHUNK_HASH_TABLE} WHERE table_name = %s AND chunk_hash <> ALL(%s)",
+                            (table_name, sorted(merged)),
+                        )
+                        seen &= merged
+                    cursor.execute(
+                        f"INSERT INTO {CHUNK_HASH_TABLE} (table_name, chunk_hash, rows, loaded_at) "
+                        f"VALUES (%s, %s, %s, now()) ON CONFLICT DO NOTHING",
+                        (table_name, digest, len(chunk)),
+                    )
+                seen.add(digest)
+                counts["inserted"] += inserted
+                counts["updated"] += updated
+                INGEST_ROWS.labels(table_name).inc(inserted + updated)
+                logger.info(
+                    "Chunk %s: %s rows merged into %s (%s inserted, %s updated).",
+                    idx + 1, len(keyed), table_name, inserted, updated,
+                )
+            raw_connection.commit()
+        except UniqueViolation:
+            raw_connection.rollback()
+            raise ValueError(
+                f"Table '{table_name}' already holds duplicate rows for the natural key "
+                f"({', '.join(key_columns)}); remove them before the first incremental load."
+            )
+        except Exception:
+            raw_connection.rollback()
+            raise
+        finally:
+            raw_connection.close()
+        stats = self._stats(table_name, total_rows, start)
+        stats.update(counts, rows_changed=counts["inserted"] + counts["updated"])
+        return stats
+
+    def prepare_merge(self, cursor, table_name, sample_chunk, key_columns, column_types=None):
+        """Create the target table and its natural-key unique index, and a staging table; returns its name."""
+        preparer = self.engine.dialect.identifier_preparer
+        self.create_table(cursor, table_name, sample_chunk, column_types=column_types)
+        index_name = f"ux_{table_name}_natural_key"[:63]
+        cursor.execute(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {preparer.quote(index_name)} ON {preparer.quote(table_name)} "
+            f"({', '.join(preparer.quote(col) for col in key_columns)})"
+        )
+        staging = f"staging_{table_name}"[:63]
+        cursor.execute(
+            f"CREATE TEMP TABLE {preparer.quote(staging)} "
+            f"(LIKE {preparer.quote(table_name)} INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+        return staging
+
+    def merge_sql(self, table_name, staging, columns, key_columns):
+        """INSERT ... ON CONFLICT statement returning (inserted, updated) row counts."""
+        quote = self.engine.dialect.identifier_preparer.quote
+        column_list = ", ".join(quote(col) for col in columns)
+        value_columns = [col for col in columns if col not in key_columns]
+        if value_columns:
+            target = ", ".join(f"{quote(table_name)}.{quote(col)}" for col in value_columns)
+            excluded = ", ".join(f"EXCLUDED.{quote(col)}" for col in value_columns)
+            on_conflict = (
+                f"DO UPDATE SET {', '.join(f'{quote(col)} = EXCLUDED.{quote(col)}' for col in value_columns)} "
+                f"WHERE ROW({target}) IS DISTINCT FROM ROW({excluded})"
+            )
+        else:
+            on_conflict = "DO NOTHING"
+        # xmax is 0 only for freshly inserted row versions, which tells inserts from updates.
+        return (
+            f"WITH merged AS ("
+            f"INSERT INTO {quote(table_name)} ({column_list}) SELECT {column_list} FROM {quote(staging)} "
+            f"ON CONFLICT ({', '.join(quote(col) for col in key_columns)}) {on_conflict} "
+            f"RETURNING (xmax = 0) AS inserted) "
+            f"SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM merged"
+        )
+
+    @staticmethod
+    def ensure_chunk_hash_table(cursor):
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {CHUNK_HASH_TABLE} ("
+            f"table_name TEXT NOT NULL, chunk_hash CHAR(64) NOT NULL, rows INTEGER NOT NULL, "
+            f"loaded_at TIMESTAMPTZ NOT NULL, PRIMARY KEY (table_name, chunk_hash))"
+        )
+
+    @staticmethod
+    def forget_chunks(cursor, table_name):
+        """Drop the remembered chunk hashes of a table that is being rebuilt."""
+        cursor.execute("SELECT to_regclass(%s)", (CHUNK_HASH_TABLE,))
+        if cursor.fetchone()[0] is not None:
+            cursor.execute(f"DELETE FROM {CHUNK_HASH_TABLE} WHERE table_name = %s", (table_name,))
+
+    def forget_tables(self, table_names):
+        """Drop the remembered chunk hashes of tables changed outside the merge path."""
+        table_names = list(table_names)
+        if not table_names or not self.supports_copy():
+            return
+        raw_connection = self.engine.raw_connection()
+        try:
+            cursor = raw_connection.cursor()
+            for table_name in table_names:
+                self.forget_chunks(cursor, table_name)
+            raw_connection.commit()
+        finally:
+            raw_connection.close()
+
+    def load(self, chunks, table_name, if_exists="append", key_columns=None, column_types=None):
+        """Load chunks with COPY when available, otherwise with to_sql; upsert when a key is given.
+
+        column_types maps column names to SQLAlchemy types used instead of the
+        ones inferred from the first chunk's dtypes when the table is created.
+        """
+        if key_columns:
+            if not self.supports_copy():
+                raise ValueError("Incremental loads require PostgreSQL with the psycopg2 driver.")
+            return self.merge_chunks(chunks, table_name, key_columns, column_types=column_types)
+        if self.supports_copy():
+            return self.copy_chunks(chunks, table_name, if_exists=if_exists, column_types=column_types)
+        return self.insert_chunks(chunks, table_name, if_exists=if_exists, column_types=column_types)
+
+    @staticmethod
+    def _stats(table_name, total_rows, start):
+        elapsed = time.perf_counter() - start
+        rows_per_sec = total_rows / elapsed if elapsed > 0 else float(total_rows)
+        return {
+            "table_name": table_name,
+            "rows": total_rows,
+            "seconds": round(elapsed, 3),
+            "rows_per_sec": round(rows_per_sec, 1),
+        }
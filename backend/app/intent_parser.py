@@ -0,0 +1,507 @@
+import datetime
+import decimal
+import logging
+import os
+import re
+import threading
+import time
+from sqlalchemy import asc, column, desc, distinct, func, inspect, literal_column, select, table, text
+
+logger = logging.getLogger(__name__)
+
+INTENT_PARSER_ENABLED = os.getenv("INTENT_PARSER_ENABLED", "true").lower() == "true"
+INTENT_MIN_CONFIDENCE = float(os.getenv("INTENT_MIN_CONFIDENCE", "0.9"))
+INTENT_MAX_DISTINCT = int(os.getenv("INTENT_MAX_DISTINCT", "5000"))
+
+_TOKEN = re.compile(r"\d[\d,]*(?:\.\d+)?|[a-z]+")
+_CAMEL = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+_MONTHS = (
+    "january", "february", "march", "april", "may", "june",
+    "july", "august", "september", "october", "november", "december",
+)
+_AGGREGATES = {"count": func.count, "sum": func.sum, "avg": func.avg, "max": func.max, "min": func.min}
+_LABELS = {"sum": "total", "avg": "average", "max": "highest", "min": "lowest"}
+
+
+def _stem(word):
+    return word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+
+
+def question_tokens(text):
+    """Lowercase, lightly stemmed word and number tokens of a question (thousands separators removed)."""
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        tokens.append(token.replace(",", "") if token[0].isdigit() else _stem(token))
+    return tokens
+
+
+def _column_kind(sql_type):
+    """'int', 'float', 'date', 'text' or None for a reflected SQLAlchemy column type."""
+    try:
+        python_type = sql_type.python_type
+    except NotImplementedError:
+        return None
+    if python_type is bool:
+        return None
+    if issubclass(python_type, int):
+        return "int"
+    if issubclass(python_type, (float, decimal.Decimal)):
+        return "float"
+    if issubclass(python_type, datetime.date):
+        return "date"
+    return "text" if issubclass(python_type, str) else None
+
+
+def _phrase(text):
+    """Tokens of a column name or synonym, splitting CamelCase and snake_case."""
+    return tuple(question_tokens(" ".join(_CAMEL.findall(text))))
+
+
+# Words that carry no meaning for the supported shapes; anything else that is not recognized lowers the confidence.
+_FILLER = frozenset(_stem(word) for word in (
+    "a", "all", "amount", "an", "and", "any", "are", "bought", "by", "car", "cars", "data", "did", "do", "does",
+    "during", "for", "from", "generated", "give", "had", "has", "have", "in", "is", "made", "me", "of", "on",
+    "purchased", "records", "rows", "sale", "sales", "sold", "that", "the", "there", "to", "vehicle", "vehicles",
+    "was", "were", "what", "where", "with", "year",
+))
+_KEYWORDS = {
+    ("how", "many"): ("agg", "count"),
+    ("number", "of"): ("agg", "count"),
+    ("count",): ("agg", "count"),
+    ("total",): ("agg", "sum"),
+    ("sum",): ("agg", "sum"),
+    ("average",): ("agg", "avg"),
+    ("avg",): ("agg", "avg"),
+    ("mean",): ("agg", "avg"),
+    ("highest",): ("extreme", "max"),
+    ("maximum",): ("extreme", "max"),
+    ("max",): ("extreme", "max"),
+    ("largest",): ("extreme", "max"),
+    ("most",): ("extreme", "max"),
+    ("lowest",): ("extreme", "min"),
+    ("minimum",): ("extreme", "min"),
+    ("min",): ("extreme", "min"),
+    ("smallest",): ("extreme", "min"),
+    ("least",): ("extreme", "min"),
+    ("fewest",): ("extreme", "min"),
+    ("most", "popular"): ("top", "max"),
+    ("most", "common"): ("top", "max"),
+    ("least", "popular"): ("top", "min"),
+    ("least", "common"): ("top", "min"),
+    ("which",): ("top", None),
+    ("each",): ("each", None),
+    ("per",): ("each", None),
+    ("every",): ("each", None),
+    ("unique",): ("distinct", None),
+    ("distinct",): ("distinct", None),
+    ("different",): ("distinct", None),
+    ("list",): ("list", None),
+    ("show",): ("list", None),
+    ("greater", "than"): ("compare", ">"),
+    ("more", "than"): ("compare", ">"),
+    ("above",): ("compare", ">"),
+    ("over",): ("compare", ">"),
+    ("exceeding",): ("compare", ">"),
+    ("less", "than"): ("compare", "<"),
+    ("below",): ("compare", "<"),
+    ("under",): ("compare", "<"),
+    ("at", "least"): ("compare", ">="),
+    ("at", "most"): ("compare", "<="),
+    **{(_stem(month),): ("month", number) for number, month in enumerate(_MONTHS, start=1)},
+}
+
+
+class Intent:
+    """A question matched to a known shape: the SQLAlchemy statement with its bound parameters and the rendered SQL."""
+
+    def __init__(self, shape, statement, sql, confidence):
+        self.shape = shape
+        self.statement = statement
+        self.sql = sql
+        self.confidence = confidence
+
+    @property
+    def params(self):
+        return self.statement.compile().params
+
+
+class _Vocabulary:
+    """Phrases of one dataset: column names and synonyms, and the distinct values of its dimension columns."""
+
+    def __init__(self, dataset, columns, values):
+        self.dataset = dataset
+        self.columns = columns
+        time_column = columns.get((dataset.get("time_filter_column") or "").lower())
+        self.time_column = time_column["name"] if time_column and time_column["kind"] == "date" else None
+        phrases = {}
+        synonyms = {name.lower(): names for name, names in dataset.get("column_synonyms", {}).items()}
+        for key, info in columns.items():
+            for name in [info["declared"], info["name"], *synonyms.get(info["declared"].lower(), [])]:
+                phrases[_phrase(name)] = ("column", info["name"])
+        for name, column_values in values.items():
+            for value in column_values:
+                tokens = tuple(question_tokens(value))
+                if not tokens or all(token in _FILLER or (token,) in _KEYWORDS for token in tokens):
+                    continue
+                previous = phrases.get(tokens)
+                if previous is not None and previous[0] == "value" and previous[1] != name:
+                    # The same words name values of two columns; neither reading is safe.
+                    phrases[tokens] = ("ambiguous", None)
+                elif previous is None or previous[0] != "ambiguous":
+                    phrases[tokens] = ("value", name, value)
+        self.phrases = phrases
+        self.table = table(dataset["dataset_name"], *[column(info["name"]) for info in columns.values()])
+        self.max_phrase = max([len(phrase) for phrase in list(phrases) + list(_KEYWORDS)] or [1])
+
+    def elements(self, tokens):
+        """Greedy longest match of the tokens against dataset phrases, then keywords.
+
+        Returns (element, filler words since the previous element) pairs; filler words are dropped.
+        """
+        elements, gap, i = [], [], 0
+        while i < len(tokens):
+            for size in range(min(self.max_phrase, len(tokens) - i), 0, -1):
+                phrase = tuple(tokens[i:i + size])
+                match = self.phrases.get(phrase) or _KEYWORDS.get(phrase)
+                if match is not None:
+                    elements.append((match, gap))
+                    gap = []
+                    i += size
+                    break
+            else:
+                token = tokens[i]
+                if token[0].isdigit():
+                    number = float(token)
+                    elements.append((("number", int(number) if number.is_integer() else number), gap))
+                    gap = []
+                elif token in _FILLER:
+                    gap.append(token)
+                else:
+                    elements.append((("unknown", token), gap))
+                    gap = []
+                i += 1
+        return elements
+
+    def is_numeric(self, name):
+        return self.columns[name.lower()]["kind"] in ("int", "float")
+
+    def holds_years(self, name):
+        return self.columns[name.lower()].get("years", False)
+
+
+class IntentParser:
+    """Deterministic NL -> SQL for the common question shapes, so they skip the LLM.
+
+    Handles count / sum / average / max / min of a column, COUNT(DISTINCT),
+    "which X has the most/highest ..." and "... by each X" groupings and
+    "list ..." questions, filtered by a year or "<month> <year>" on the time
+    column, equality on dimension values (matched against the distinct values
+    of each dataset's dimension_columns, read once from the table), numeric
+    comparisons ("sale price greater than 30,000") and "<integer column> in
+    <year>" ("manufactured in 2016"). Column words come from the metadata
+    names plus optional "column_synonyms".
+
+    Confidence is the share of meaningful question words that were understood;
+    below INTENT_MIN_CONFIDENCE, or for any other shape, parse() returns None
+    and the caller falls back to the LLM. Statements are built with bound
+    parameters and rendered with literal values for the execution pipeline.
+    """
+
+    def __init__(self, engine, registry, min_confidence=INTENT_MIN_CONFIDENCE, max_distinct=INTENT_MAX_DISTINCT,
+                 enabled=INTENT_PARSER_ENABLED):
+        self.engine = engine
+        self.registry = registry
+        self.min_confidence = min_confidence
+        self.max_distinct = max_distinct
+        self.enabled = enabled
+        self._vocabularies = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.low_confidence = 0
+        self.unsupported = 0
+        self.shapes = {}
+        self.parse_seconds = 0.0
+
+    def loaded(self, dataset_name):
+        """True when the dataset's vocabulary is built and current (parse() will not touch the database)."""
+        dataset = self.registry.get(dataset_name)
+        vocabulary = self._vocabularies.get(dataset["dataset_name"])
+        return vocabulary is not None and vocabulary.dataset == dataset
+
+    def load(self, dataset_name):
+        """Build (or rebuild) a dataset's vocabulary from its metadata, schema and dimension values."""
+        dataset = self.registry.get(dataset_name)
+        name = dataset["dataset_name"]
+        try:
+            schema = inspect(self.engine).get_columns(name)
+        except Exception as e:
+            logger.warning("Intent parser disabled for %s: %s", name, e)
+            schema = []
+        declared = {declared.lower(): declared for declared in dataset["columns"]}
+        columns = {
+            info["name"].lower(): {
+                "name": info["name"],
+                "declared": declared.get(info["name"].lower(), info["name"]),
+                "kind": _column_kind(info["type"]),
+            }
+            for info in schema
+        }
+        dimensions = [col.lower() for col in dataset.get("dimension_columns", [])] or [
+            key for key, info in columns.items() if info["kind"] == "text"
+        ]
+        values = {}
+        quote = self.engine.dialect.identifier_preparer.quote
+        integers = [info for info in columns.values() if info["kind"] == "int"]
+        with self.engine.connect() as connection:
+            if integers:
+                # Integer columns whose values all look like years accept "<column> in 2016".
+                bounds = connection.execute(text("SELECT " + ", ".join(
+                    f"MIN({quote(info['name'])}), MAX({quote(info['name'])})" for info in integers
+                ) + f" FROM {quote(name)}")).one()
+                for idx, info in enumerate(integers):
+                    low, high = bounds[2 * idx], bounds[2 * idx + 1]
+                    info["years"] = low is not None and 1900 <= low and high <= 2100
+            for key in dimensions:
+                if key not in columns:
+                    continue
+                column_name = columns[key]["name"]
+                found = connection.execute(text(
+                    f"SELECT DISTINCT {quote(column_name)} FROM {quote(name)} "
+                    f"WHERE {quote(column_name)} IS NOT NULL LIMIT {self.max_distinct + 1}"
+                )).scalars().all()
+                if len(found) > self.max_distinct:
+                    logger.info("Intent parser: %s.%s has too many values for a dictionary", name, column_name)
+                    continue
+                values[column_name] = [str(value) for value in found]
+        vocabulary = _Vocabulary(dataset, columns, values)
+        with self._lock:
+            self._vocabularies[name] = vocabulary
+        logger.info(
+            "Intent parser vocabulary for %s: %s phrases (%s dimension values)",
+            name, len(vocabulary.phrases), sum(len(v) for v in values.values()),
+        )
+        return vocabulary
+
+    def invalidate(self, table_name=None):
+        """Forget vocabularies (all, or one table's) so the next parse re-reads the dimension values."""
+        with self._lock:
+            if table_name is None:
+                self._vocabularies.clear()
+            else:
+                self._vocabularies.pop(table_name, None)
+
+    def parse(self, question, dataset_name=None):
+        """Return an Intent for a question, or None when the LLM should answer it."""
+        if not self.enabled:
+            return None
+        if not self.loaded(dataset_name):
+            self.load(dataset_name)
+        start = time.perf_counter()
+        vocabulary = self._vocabularies[self.registry.get(dataset_name)["dataset_name"]]
+        intent = self._interpret(vocabulary, question)
+        with self._lock:
+            self.parse_seconds += time.perf_counter() - start
+            if intent is None:
+                self.unsupported += 1
+            elif intent.confidence < self.min_confidence:
+                self.low_confidence += 1
+                intent = None
+            else:
+                self.hits += 1
+                self.shapes[intent.shape] = self.shapes.get(intent.shape, 0) + 1
+        if intent is not None:
+            logger.debug("Intent parser answered '%s' (%s): %s", question, intent.shape, intent.sql)
+        return intent
+
+    def stats(self):
+        with self._lock:
+            questions = self.hits + self.low_confidence + self.unsupported
+            return {
+                "enabled": self.enabled,
+                "questions": questions,
+                "hits": self.hits,
+                "low_confidence": self.low_confidence,
+                "unsupported": self.unsupported,
+                "hit_rate": round(self.hits / questions, 4) if questions else 0.0,
+                "avg_parse_us": round(self.parse_seconds / questions * 1e6, 1) if questions else 0.0,
+                "shapes": dict(self.shapes),
+                "datasets": sorted(self._vocabularies),
+            }
+
+    def _interpret(self, vocabulary, question):
+        matched = vocabulary.elements(question_tokens(question))
+        if not matched:
+            return None
+        elements = [element for element, _ in matched]
+        unknown = 0
+        aggregates, extremes = set(), set()
+        mentions, filters = [], []
+        group = group_direction = None
+        grouping = listing = distinct_next = False
+        distinct_column = None
+        year_bounds = []
+        i = 0
+        while i < len(elements):
+            kind = elements[i][0]
+            following = elements[i + 1] if i + 1 < len(elements) else (None,)
+            after = elements[i + 2] if i + 2 < len(elements) else (None,)
+            if kind == "column":
+                name = elements[i][1]
+                if following[0] == "compare" and after[0] == "number" and vocabulary.is_numeric(name):
+                    filters.append((name, following[1], after[1]))
+                    i += 3
+                    continue
+                if (following[0] == "number" and vocabulary.holds_years(name) and _is_year(following[1])
+                        and set(matched[i + 1][1]) <= {"in"}):
+                    # "manufactured in 2016", "car year 2010"
+                    filters.append((name, "=", following[1]))
+                    i += 2
+                    continue
+                if distinct_next:
+                    if distinct_column is not None:
+                        return None
+                    distinct_column, distinct_next = name, False
+                else:
+                    mentions.append(name)
+            elif kind == "top" or kind == "each":
+                if following[0] != "column" or group is not None:
+                    return None
+                group, grouping = following[1], True
+                if kind == "top":
+                    group_direction = elements[i][1] or "pending"
+                    if elements[i][1] is not None:
+                        aggregates.add("count")
+                i += 2
+                continue
+            elif kind == "month":
+                if following[0] != "number" or not _is_year(following[1]):
+                    unknown += 1
+                else:
+                    year = following[1]
+                    month = elements[i][1]
+                    end = datetime.date(year + month // 12, month % 12 + 1, 1)
+                    year_bounds.append((datetime.date(year, month, 1), end))
+                    i += 2
+                    continue
+            elif kind == "number":
+                if _is_year(elements[i][1]):
+                    year = elements[i][1]
+                    year_bounds.append((datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)))
+                else:
+                    unknown += 1
+            elif kind == "value":
+                filters.append((elements[i][1], "=", elements[i][2]))
+            elif kind == "agg":
+                aggregates.add(elements[i][1])
+            elif kind == "extreme":
+                extremes.add(elements[i][1])
+            elif kind == "distinct":
+                distinct_next = True
+            elif kind == "list":
+                listing = True
+            else:
+                unknown += 1
+            i += 1
+        confidence = 1 - unknown / len(elements)
+        if len(year_bounds) > 1 or len(extremes) > 1 or distinct_next:
+            return None
+        if year_bounds and vocabulary.time_column is None:
+            return None
+        equalities = [name for name, op, _ in filters if op == "="]
+        if len(set(equalities)) < len(equalities):
+            return None
+
+        t = vocabulary.table
+        conditions = [_condition(t.c[name], op, value) for name, op, value in filters]
+        if year_bounds:
+            low, high = year_bounds[0]
+            conditions += [t.c[vocabulary.time_column] >= low, t.c[vocabulary.time_column] < high]
+        measures = [name for name in mentions if vocabulary.is_numeric(name)]
+        others = [name for name in mentions if not vocabulary.is_numeric(name)]
+
+        if listing and not grouping and not aggregates:
+            if measures and others:
+                return None
+            if mentions:
+                statement = select(*[t.c[name] for name in mentions]).distinct().order_by(*[t.c[name] for name in mentions])
+                shape = "list_distinct"
+            else:
+                statement = select(literal_column("*"))
+                shape = "list_rows"
+        elif grouping:
+            if others or len(measures) > 1 or distinct_column is not None:
+                return None
+            if group_direction == "pending":
+                if not extremes:
+                    return None
+                group_direction = extremes.pop()
+            # In "which X has the highest Y" the extreme orders the groups; it aggregates Y only if nothing else does.
+            aggregate = _aggregate(aggregates, {group_direction} if group_direction else extremes, measures)
+            if aggregate is None:
+                return None
+            label, expression = _measure_expression(t, aggregate, measures)
+            statement = select(t.c[group], expression.label(label)).group_by(t.c[group])
+            if group_direction is None:
+                statement = statement.order_by(desc(label))
+                shape = f"group_{aggregate}"
+            else:
+                statement = statement.order_by(desc(label) if group_direction == "max" else asc(label)).limit(1)
+                shape = f"top_{aggregate}"
+        elif distinct_column is not None:
+            if measures or others or aggregates - {"count"}:
+                return None
+            statement = select(func.count(distinct(t.c[distinct_column])).label(f"unique_{distinct_column.lower()}"))
+            shape = "count_distinct"
+        else:
+            if others:
+                return None
+            aggregate = _aggregate(aggregates, extremes, measures)
+            if aggregate is None:
+                return None
+            label, expression = _measure_expression(t, aggregate, measures)
+            statement = select(expression.label(label))
+            shape = aggregate
+        statement = statement.select_from(t)
+        if conditions:
+            statement = statement.where(*conditions)
+        sql = str(statement.compile(dialect=self.engine.dialect, compile_kwargs={"literal_binds": True}))
+        return Intent(shape, statement, " ".join(sql.split()), confidence)
+
+
+def _is_year(number):
+    return isinstance(number, int) and 1900 <= number <= 2100
+
+
+def _condition(column_clause, op, value):
+    if op == "=":
+        return column_clause == value
+    if op == ">":
+        return column_clause > value
+    if op == "<":
+        return column_clause < value
+    if op == ">=":
+        return column_clause >= value
+    return column_clause <= value
+
+
+def _aggregate(aggregates, extremes, measures):
+    """The one aggregate a question asks for: COUNT(*) without a measure, else AVG/SUM, else MAX/MIN."""
+    if not measures:
+        return "count" if "count" in aggregates or not aggregates else None
+    if len(measures) > 1:
+        return None
+    explicit = aggregates - {"count"}
+    if len(explicit) > 1:
+        return None
+    if explicit:
+        return explicit.pop()
+    if len(extremes) == 1 and not aggregates:
+        return next(iter(extremes))
+    return None
+
+
+def _measure_expression(t, aggregate, measures):
+    if aggregate == "count":
+        return "count", func.count()
+    name = measures[0]
+    return f"{_LABELS[aggregate]}_{name.lower()}", _AGGREGATES[aggregate](t.c[name])
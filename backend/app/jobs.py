@@ -0,0 +1,190 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import Column, DateTime, Float, Index, MetaData, String, Table, Text, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+ETL_JOB_WORKERS = int(os.getenv("ETL_JOB_WORKERS", "2"))
+# Active jobs are re-stamped every heartbeat; one not stamped for a lease belongs to a dead process.
+ETL_JOB_HEARTBEAT_SECONDS = float(os.getenv("ETL_JOB_HEARTBEAT_SECONDS", "30"))
+ETL_JOB_LEASE_SECONDS = float(os.getenv("ETL_JOB_LEASE_SECONDS", "120"))
+ACTIVE_STATUSES = ("queued", "running")
+
+job_metadata = MetaData()
+etl_jobs = Table(
+    "etl_jobs",
+    job_metadata,
+    Column("id", String(32), primary_key=True),
+    Column("kind", String(64), nullable=False),
+    Column("dedupe_key", String(64), nullable=False),
+    Column("status", String(16), nullable=False),
+    Column("progress", Float, nullable=False, default=0.0),
+    Column("message", Text),
+    Column("result", Text),
+    Column("error", Text),
+    Column("created_at", DateTime(timezone=True), nullable=False),
+    Column("updated_at", DateTime(timezone=True), nullable=False),
+)
+# At most one queued/running job per dedupe key, enforced by the database.
+Index(
+    "ix_etl_jobs_active_dedupe_key",
+    etl_jobs.c.dedupe_key,
+    unique=True,
+    postgresql_where=etl_jobs.c.status.in_(ACTIVE_STATUSES),
+    sqlite_where=etl_jobs.c.status.in_(ACTIVE_STATUSES),
+)
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def dedupe_key(kind, *parts):
+    """Hash a job kind and its identifying arguments into a de-duplication key."""
+    return hashlib.sha256(json.dumps([kind, *parts]).encode("utf-8")).hexdigest()
+
+
+class JobManager:
+    """Run long ETL work on a bounded in-process worker pool, persisting job state in the app DB.
+
+    Submitting a job whose dedupe key matches a queued or running job returns
+    the existing job id instead of starting a second copy.
+
+    Several processes may share the table. Each one re-stamps updated_at of
+    the jobs it holds every ETL_JOB_HEARTBEAT_SECONDS, and a queued or
+    running job whose stamp is older than ETL_JOB_LEASE_SECONDS is failed as
+    interrupted (its process died or restarted), so only orphans are failed
+    and their dedupe keys become free again.
+    """
+
+    def __init__(self, engine, max_workers=ETL_JOB_WORKERS, heartbeat_seconds=ETL_JOB_HEARTBEAT_SECONDS,
+                 lease_seconds=ETL_JOB_LEASE_SECONDS):
+        self.engine = engine
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="etl-job")
+        self.heartbeat_seconds = heartbeat_seconds
+        self.lease_seconds = lease_seconds
+        self._ready = False
+        self._lock = threading.Lock()
+        self._held = set()
+        self._heartbeat = None
+
+    def submit(self, kind, key, func, *args, **kwargs):
+        """Queue func(*args, report=..., **kwargs); returns (job_id, created)."""
+        self._ensure_table()
+        self._fail_orphans()
+        job_id = uuid.uuid4().hex
+        for attempt in range(2):
+            now = _now()
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(insert(etl_jobs).values(
+                        id=job_id, kind=kind, dedupe_key=key, status="queued",
+                        progress=0.0, created_at=now, updated_at=now,
+                    ))
+                break
+            except IntegrityError:
+                existing = self._active_job_id(key)
+                if existing is not None:
+                    return existing, False
+                # The conflicting job finished in between; its key is free now.
+                if attempt:
+                    raise
+        with self._lock:
+            self._held.add(job_id)
+        self.executor.submit(self._run, job_id, func, args, kwargs)
+        return job_id, True
+
+    def get(self, job_id):
+        """Return a job as a dict, or None when it does not exist."""
+        self._ensure_table()
+        self._fail_orphans()
+        with self.engine.connect() as connection:
+            row = connection.execute(select(etl_jobs).where(etl_jobs.c.id == job_id)).mappings().first()
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job.pop("dedupe_key")
+        return job
+
+    def _run(self, job_id, func, args, kwargs):
+        self._update(job_id, status="running")
+
+        def report(progress, message=None):
+            self._update(job_id, progress=round(float(progress), 4), message=message)
+
+        try:
+            result = func(*args, report=report, **kwargs)
+            self._update(job_id, status="succeeded", progress=1.0, message="Completed", result=json.dumps(result, default=str))
+        except Exception as e:
+            logger.exception("ETL job %s failed: %s", job_id, e)
+            self._update(job_id, status="failed", error=str(e))
+        finally:
+            with self._lock:
+                self._held.discard(job_id)
+
+    def _update(self, job_id, **values):
+        """Update an active job; a job already finished (or failed as an orphan) is left as it is."""
+        values = {key: value for key, value in values.items() if value is not None}
+        values["updated_at"] = _now()
+        with self.engine.begin() as connection:
+            connection.execute(
+                update(etl_jobs)
+                .where(etl_jobs.c.id == job_id, etl_jobs.c.status.in_(ACTIVE_STATUSES))
+                .values(**values)
+            )
+
+    def _fail_orphans(self):
+        """Fail active jobs whose process stopped stamping them for a whole lease."""
+        cutoff = _now() - timedelta(seconds=self.lease_seconds)
+        with self.engine.begin() as connection:
+            connection.execute(
+                update(etl_jobs)
+                .where(etl_jobs.c.status.in_(ACTIVE_STATUSES), etl_jobs.c.updated_at < cutoff)
+                .values(status="failed", error="Interrupted by a service restart.", updated_at=_now())
+            )
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat_seconds)
+            with self._lock:
+                held = list(self._held)
+            if not held:
+                continue
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(
+                        update(etl_jobs)
+                        .where(etl_jobs.c.id.in_(held), etl_jobs.c.status.in_(ACTIVE_STATUSES))
+                        .values(updated_at=_now())
+                    )
+            except Exception as e:
+                logger.warning("ETL job heartbeat failed: %s", e)
+
+    def _active_job_id(self, key):
+        with self.engine.connect() as connection:
+            return connection.execute(
+                select(etl_jobs.c.id).where(
+                    etl_jobs.c.dedupe_key == key, etl_jobs.c.status.in_(ACTIVE_STATUSES)
+                )
+            ).scalar()
+
+    def _ensure_table(self):
+        """Create the job table and start the heartbeat on first use."""
+        if self._ready:
+            return
+        with self._lock:
+            if self._ready:
+                return
+            job_metadata.create_all(self.engine)
+            self._heartbeat = threading.Thread(target=self._beat, name="etl-job-heartbeat", daemon=True)
+            self._heartbeat.start()
+            self._ready = True
@@ -0,0 +1,123 @@
+import codecs
+import json
+import os
+
+JSON_READ_CHUNK_BYTES = int(os.getenv("JSON_READ_CHUNK_BYTES", str(1024 * 1024)))
+# A single document (or top-level value) larger than this is rejected instead of buffered.
+JSON_MAX_DOCUMENT_BYTES = int(os.getenv("JSON_MAX_DOCUMENT_BYTES", str(64 * 1024 * 1024)))
+
+_WHITESPACE = " \t\n\r"
+
+
+class _Reader:
+    """Incrementally decoded text of a binary stream with a cursor, compacted as it is consumed."""
+
+    def __init__(self, stream, chunk_size, max_buffer):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.max_buffer = max_buffer
+        self.decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Read one more chunk; returns False at end of stream."""
+        if self.eof:
+            return False
+        data = self.stream.read(self.chunk_size)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.eof = not data
+        if self.pos > self.chunk_size:
+            self.buffer, self.pos = self.buffer[self.pos:], 0
+        self.buffer += self.decoder.decode(data, final=self.eof)
+        if len(self.buffer) - self.pos > self.max_buffer:
+            raise ValueError(f"A JSON value is larger than {self.max_buffer} bytes (or the file is malformed).")
+        return True
+
+    def peek(self):
+        """Next non-whitespace character (None at end of stream), without consuming it."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return None
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Malformed JSON: expected '{char}' at offset {self.pos}.")
+        self.pos += 1
+
+    def value(self, decoder):
+        """Decode the next complete JSON value, reading more input until it is complete."""
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                if self.fill():
+                    continue
+                raise ValueError(f"Malformed JSON: {e}")
+            # A number or literal ending exactly at the buffer end may continue in the next chunk.
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_documents(stream, ndjson=False, chunk_size=JSON_READ_CHUNK_BYTES, max_document_bytes=JSON_MAX_DOCUMENT_BYTES):
+    """Yield MongoDB documents from a JSON or NDJSON byte stream without loading the whole file.
+
+    - NDJSON (ndjson=True): one document per line; blank lines are skipped.
+    - A top-level array: one document per element.
+    - A top-level object: one {"key", "value"} document per member, plus a
+      {"rates": [{"currency", "rate"}]} document when it has a "rates" object.
+    Elements that are not objects are wrapped as {"value": element}. Only one
+    document is buffered at a time (at most max_document_bytes of text).
+    """
+    reader = _Reader(stream, chunk_size, max_document_bytes)
+    decoder = json.JSONDecoder()
+    first = reader.peek()
+    if ndjson:
+        while reader.peek() is not None:
+            yield _document(reader.value(decoder))
+        return
+    if first == "[":
+        reader.expect("[")
+        if reader.peek() != "]":
+            while True:
+                yield _document(reader.value(decoder))
+                if reader.peek() != ",":
+                    break
+                reader.expect(",")
+        reader.expect("]")
+    elif first == "{":
+        reader.expect("{")
+        rates = None
+        if reader.peek() != "}":
+            while True:
+                key = reader.value(decoder)
+                if not isinstance(key, str):
+                    raise ValueError(f"Malformed JSON: object key expected at offset {reader.pos}.")
+                reader.expect(":")
+                value = reader.value(decoder)
+                if key == "rates" and isinstance(value, dict):
+                    rates = [{"currency": currency, "rate": rate} for currency, rate in value.items()]
+                yield {"key": key, "value": value}
+                if reader.peek() != ",":
+                    break
+                reader.expect(",")
+        reader.expect("}")
+        if rates is not None:
+            yield {"rates": rates}
+    else:
+        raise ValueError("Unsupported JSON format")
+    if reader.peek() is not None:
+        raise ValueError("Unexpected data after the top-level JSON value; upload several documents as .ndjson.")
+
+
+def _document(value):
+    return value if isinstance(value, dict) else {"value": value}
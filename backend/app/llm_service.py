@@ -1,25 +1,69 @@
-from sqlalchemy import create_engine, Date, text
+from sqlalchemy import Date, inspect, text
 from sqlalchemy.types import String
 from langchain_openai import ChatOpenAI
 import pandas as pd
-import re
-from app.metadata_llm import MetadataManager
+import logging
+import os
+import time
+import uuid
+from app.analytics_backend import AnalyticsBackend
+from app.database import get_async_engine, get_engine
+from app.dataset_registry import DatasetRegistry
+from app.ingest import CopyIngestor
+from app.intent_parser import IntentParser
+from app.parallel_ingest import ParallelCsvIngestor
+from app.prompt_cache import PromptCache
+from app.prompt_builder import PromptBuilder
+from app.query_advisor import QueryAdvisor
+from app.query_policy import QueryPolicy, QueryRejected
+from app.schema_inference import infer_schema
+from app.concurrency import run_blocking
+from app.result_cache import ResultCache, TableVersions, is_read_query, referenced_tables
+from app.pagination import keyset_sql, page_cursor
+from app.exporters import fetch_arrow_table, iter_arrow_ipc
+from app.metrics import CACHE_LOOKUPS, INGEST_ROWS, record_token_usage, timed
+
+logger = logging.getLogger(__name__)
 
 class LLMService:
-    def __init__(self, api_key, db_url, metadata_path):
-        datasets_db_url = db_url.replace("app_db", "datasets")
+    def __init__(self, api_key, db_url, metadata_path, examples_path=None):
         self.llm = ChatOpenAI(model="gpt-4", temperature=0, openai_api_key=api_key)
-        self.engine = create_engine(db_url)
-        self.metadata_manager = MetadataManager(metadata_path)
-        self.metadata_manager.load_metadata()
-        self.dataset_metadata = self.metadata_manager.get_metadata()
+        self.engine = get_engine(db_url)
+        self.async_engine = get_async_engine(db_url)
+        self.ingestor = CopyIngestor(self.engine)
+        self.parallel_ingestor = ParallelCsvIngestor(self.ingestor)
+        self.registry = DatasetRegistry(metadata_path, self.engine)
+        self.metadata_manager = self.registry.metadata_manager
+        self.dataset_metadata = self.registry.get()
+        if examples_path is None:
+            examples_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(metadata_path))), "prompts.yaml")
+        self.prompt_examples = PromptBuilder.load_examples(examples_path)
+        self.prompt_builder = PromptBuilder(self.registry.metadata(), self.prompt_examples)
+        similarity = os.getenv("PROMPT_CACHE_SIMILARITY")
+        self.prompt_cache = PromptCache(
+            max_size=int(os.getenv("PROMPT_CACHE_SIZE", "256")),
+            ttl_seconds=int(os.getenv("PROMPT_CACHE_TTL", "3600")),
+            similarity_threshold=float(similarity) if similarity else None,
+        )
+        self.table_versions = TableVersions()
+        self.result_cache = ResultCache(
+            max_bytes=int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+            ttl_seconds=int(os.getenv("RESULT_CACHE_TTL", "300")),
+        )
+        self.advisor = QueryAdvisor(self.engine, self.dataset_metadata)
+        self.policy = QueryPolicy(self.engine)
+        self.intent_parser = IntentParser(self.engine, self.registry)
+        self.analytics = AnalyticsBackend(self.engine, self.table_versions, self.policy)
+        # Save query results with CREATE TABLE ... AS / INSERT ... SELECT instead of a client round trip.
+        self.save_pushdown = self.policy.postgres and os.getenv("ETL_SAVE_PUSHDOWN", "true").lower() == "true"
 
-    def load_dataset_in_chunks(self, file_path, chunk_size=10000):
-        """Load a dataset from a CSV file in chunks."""
+    def load_dataset_in_chunks(self, file_path, chunk_size=10000, schema=None):
+        """Load a dataset from a CSV file in chunks, with the dtypes of an inferred schema when given."""
         try:
-            return pd.read_csv(file_path, chunksize=chunk_size)
+            options = schema.read_options() if schema is not None else {}
+            return pd.read_csv(file_path, chunksize=chunk_size, **options)
         except Exception as e:
-            print(f"Error loading dataset: {e}")
+            logger.error("Error loading dataset: %s", e)
             raise ValueError(f"Error loading dataset in chunks: {e}")
 
     def load_dataset(self, file_path):
@@ -30,178 +74,316 @@ class LLMService:
         except Exception as e:
             raise ValueError(f"Error loading dataset: {e}")
 
-    def store_data_in_sql(self, file_path, table_name, chunk_size=20000):
-        """Store the dataset in the PostgreSQL database."""
+    def infer_schema(self, file_path, table_name=None):
+        """Sample a CSV once for compact dtypes; the table's metadata dimensions become categoricals."""
+        dataset = self.dataset_metadata if table_name is None else self.registry.find(table_name)
+        return infer_schema(
+            file_path,
+            category_columns=(dataset or {}).get("dimension_columns", []),
+            date_columns=[(dataset or {}).get("time_filter_column", "Date")],
+            # Tables without metadata get their date columns detected, so the registry finds a time column.
+            detect_dates=dataset is None,
+        )
+
+    def natural_key(self, mode, table_name=None):
+        """Return the merge key for an ingest mode: None to append, the metadata natural_key to upsert."""
+        if mode == "append":
+            return None
+        if mode != "incremental":
+            raise ValueError(f"Unknown ingest mode '{mode}'. Use 'append' or 'incremental'.")
+        dataset = self.dataset_metadata if table_name is None else self.registry.find(table_name) or {}
+        key_columns = dataset.get("natural_key")
+        if not key_columns:
+            raise ValueError("Incremental mode needs a 'natural_key' in the dataset metadata.")
+        return key_columns
+
+    def store_data_in_sql(self, file_path, table_name, chunk_size=20000, mode="append"):
+        """Store the dataset in the PostgreSQL database, using COPY when the engine supports it."""
         try:
-            total_rows = 0
-            for idx, chunk in enumerate(self.load_dataset_in_chunks(file_path, chunk_size)):
-                if "Date" in chunk.columns:
-                    chunk["Date"] = pd.to_datetime(chunk["Date"], format="%m/%d/%Y", errors="coerce").dt.date
-                chunk.columns = [col.lower() for col in chunk.columns]
-                # Store the dataset in PostgreSQL
-                chunk.to_sql(
-                    table_name,
-                    con=self.engine,
-                    if_exists="append",
-                    index=False,
-                    method= "multi"
-                )
-                total_rows += len(chunk)
-                print(f"Chunk {idx + 1}: {len(chunk)} rows written to {table_name}. Total so far: {total_rows} rows.")
-            print(f"Upload complete. Total rows written to {table_name}: {total_rows}.")
+            key_columns = self.natural_key(mode, table_name)
+            schema = self.infer_schema(file_path, table_name)
+            chunks = (schema.prepare(chunk) for chunk in self.load_dataset_in_chunks(file_path, chunk_size, schema))
+            stats = self.ingestor.load(chunks, table_name, key_columns=key_columns, column_types=schema.sql_types())
+            if stats.get("rows_changed", stats["rows"]):
+                self.table_versions.bump(table_name)
+                self._after_ingest(table_name)
+            logger.info(
+                "Upload complete. Total rows written to %s: %s in %ss (%s rows/sec).",
+                table_name, stats["rows"], stats["seconds"], stats["rows_per_sec"],
+            )
+            return stats
         except Exception as e:
             raise ValueError(f"Error storing data in PostgreSQL: {e}")
         
+    def store_files_in_sql(self, file_paths, table_name, progress=None, mode="append"):
+        """Store one or more CSV files in a table, parsing byte ranges in parallel worker processes."""
+        try:
+            # The first file's sample types every chunk of every file in the batch.
+            stats = self.parallel_ingestor.ingest_files(
+                file_paths, table_name, progress=progress, key_columns=self.natural_key(mode, table_name),
+                schema=self.infer_schema(file_paths[0], table_name),
+            )
+            # A re-upload that changed nothing keeps cached results valid.
+            if stats.get("rows_changed", stats["rows"]):
+                self.table_versions.bump(table_name)
+                self._after_ingest(table_name)
+            logger.info(
+                "Upload complete. Total rows written to %s from %s file(s): %s in %ss (%s rows/sec).",
+                table_name, len(file_paths), stats["rows"], stats["seconds"], stats["rows_per_sec"],
+            )
+            return stats
+        except Exception as e:
+            raise ValueError(f"Error storing data in PostgreSQL: {e}")
+
+    def _after_ingest(self, table_name):
+        """Register the loaded table's schema, index it and refresh its rollups; failures never fail an upload."""
+        self.intent_parser.invalidate(table_name)
+        try:
+            if self.registry.register_table(table_name):
+                self._sync_registry()
+        except Exception as e:
+            logger.warning("Dataset registry not updated for %s: %s", table_name, e)
+        try:
+            report = self.advisor.after_ingest(table_name)
+        except Exception as e:
+            logger.warning("Index/rollup maintenance skipped for %s: %s", table_name, e)
+            return
+        for rollup in report.get("refreshed", []) + report.get("created", []):
+            self.table_versions.bump(rollup)
+        if report:
+            logger.info("Advisor maintenance for %s: %s", table_name, report)
+        if self.analytics.enabled:
+            try:
+                self.analytics.refresh(table_name)
+            except Exception as e:
+                logger.warning("DuckDB snapshot of %s not refreshed: %s", table_name, e)
+
+    def create_rollups(self, dimensions=None):
+        """Create the rollup for a dimension list, or every recommended one; returns the rollup names."""
+        if dimensions is not None:
+            dimension_sets = [dimensions]
+        else:
+            dimension_sets = [s["dimensions"] for s in self.advisor.suggestions() if s["recommended"]]
+        names = [self.advisor.create_rollup(dims) for dims in dimension_sets]
+        for name in names:
+            self.table_versions.bump(name)
+        return names
+
     def store_dataframe_in_sql(self, dataframe, table_name):
         """Store a dataframe directly in the PostgreSQL database."""
         try:
             dataframe.columns = [col.lower() for col in dataframe.columns]
-            dataframe.to_sql(
-                table_name,
-                con=self.engine,
-                if_exists="replace",
-                index=False,
-                method= "multi"
-                )
-            print(f"Dataframe successfully stored in table {table_name}.")
+            with timed("store_dataframe"):
+                dataframe.to_sql(
+                    table_name,
+                    con=self.engine,
+                    if_exists="replace",
+                    index=False,
+                    method= "multi"
+                    )
+            INGEST_ROWS.labels(table_name).inc(len(dataframe))
+            self.table_versions.bump(table_name)
+            self.ingestor.forget_tables([table_name])
+            logger.info("Dataframe successfully stored in table %s.", table_name)
         except Exception as e:
             raise ValueError(f"Error storing dataframe in PostgreSQL: {e}")
 
+    def save_query_as_table(self, query, table_name, if_exists="replace"):
+        """Save the rows of a SELECT in a table and return {"rows", "columns", "mode"}.
+
+        With push-down (PostgreSQL, ETL_SAVE_PUSHDOWN) the rows never leave the
+        server: a replace runs CREATE TABLE <staging> (<columns>) AS <query>
+        under the execution policy and swaps the staging table in with DROP +
+        RENAME in the same transaction, so readers see the old table or the
+        new one and never a partial one; an append runs INSERT ... SELECT.
+        Otherwise the rows are fetched as Arrow and written back with to_sql.
+        Nothing is written when the query returns no rows.
+        """
+        if if_exists not in ("replace", "append"):
+            raise ValueError(f"Unsupported if_exists '{if_exists}'.")
+        if not isinstance(query, str):
+            query = str(query)
+        if not self.save_pushdown:
+            table = self.execute_query_arrow(query)
+            columns = self._save_columns(table.column_names)
+            if table.num_rows:
+                with timed("store_dataframe"):
+                    table.rename_columns(columns).to_pandas().to_sql(
+                        table_name, con=self.engine, if_exists=if_exists, index=False, method="multi"
+                    )
+                INGEST_ROWS.labels(table_name).inc(table.num_rows)
+                self.table_versions.bump(table_name)
+                self.ingestor.forget_tables([table_name])
+            return {"rows": table.num_rows, "columns": columns, "mode": "client"}
+        try:
+            routed, _, _ = self.advisor.route(query)
+            select_sql = routed.strip().rstrip(";")
+            preparer = self.engine.dialect.identifier_preparer
+            target = preparer.quote(table_name)
+            with timed("save_pushdown"), self.engine.connect() as connection, connection.begin() as transaction:
+                self.policy.check(connection, select_sql, read_only=False)
+                columns = self._save_columns(
+                    connection.execute(text(f"SELECT * FROM ({select_sql}) AS save_query LIMIT 0")).keys()
+                )
+                column_list = ", ".join(preparer.quote(col) for col in columns)
+                exists = inspect(connection).has_table(table_name)
+                if if_exists == "append" and exists:
+                    rows = connection.execute(
+                        text(f"INSERT INTO {target} ({column_list}) SELECT * FROM ({select_sql}) AS save_query")
+                    ).rowcount
+                else:
+                    staging = f"{table_name[:40]}_save_{uuid.uuid4().hex[:8]}"
+                    rows = connection.execute(
+                        text(f"CREATE TABLE {preparer.quote(staging)} ({column_list}) AS {select_sql}")
+                    ).rowcount
+                    if rows:
+                        if exists:
+                            connection.execute(text(f"DROP TABLE {target}"))
+                        connection.execute(text(f"ALTER TABLE {preparer.quote(staging)} RENAME TO {target}"))
+                if not rows:
+                    transaction.rollback()
+        except QueryRejected:
+            raise
+        except Exception as e:
+            logger.error("Push-down save into %s failed: %s", table_name, e)
+            self.policy.raise_if_timeout(e)
+            raise ValueError(f"Error saving query results to {table_name}: {e}")
+        if rows:
+            INGEST_ROWS.labels(table_name).inc(rows)
+            self.table_versions.bump(table_name)
+            self.ingestor.forget_tables([table_name])
+            logger.info("Saved %s rows into table %s in the database.", rows, table_name)
+        return {"rows": rows, "columns": columns, "mode": "pushdown"}
+
+    @staticmethod
+    def _save_columns(names):
+        """Lowercased, non-empty and unique column names for a saved result."""
+        columns = []
+        for idx, name in enumerate(names):
+            column = name.lower() if name and not name.isspace() and name != "?column?" else f"column_{idx}"
+            while column in columns:
+                column = f"{column}_{idx}"
+            columns.append(column)
+        return columns
+
+
 
+    def _sync_registry(self):
+        """Point the prompt builder and default metadata at the registry's current datasets."""
+        self.prompt_builder.update(self.registry.metadata())
+        self.dataset_metadata = self.registry.get()
 
-    def generate_dynamic_prompt(self, user_query):
-        """Generate a refined prompt dynamically based on the dataset metadata."""
-        metadata = self.dataset_metadata
-        dataset_name = metadata["dataset_name"]
-        column_info = "\n".join([f"- {col}: {desc}" for col, desc in metadata["columns"].items()])
-    
-        refined_prompt = (
-        f"You are a helpful assistant tasked with analyzing and modifying data.\n"
-        f"Dataset: '{dataset_name}'\n"
-        f"Columns:\n{column_info}\n"
-        f"Purpose: {metadata['purpose']}\n\n"
-        f"Important: You are restricted to using only the '{dataset_name}' table "
-        f"and its available columns for all operations.\n"
-        f"Important: When filtering by year, month, or day, use the '{metadata.get('time_filter_column', 'Date')}' column.\n"
-        f"Ensure string comparisons are case-insensitive and match exactly.\n"
-        f"User query: {user_query}\n\n"
-        f"Generate only the SQL query required to execute this operation. Do not include explanatory text."
+    def refresh_registry(self):
+        """Pick up metadata and registered-table changes, re-pointing the prompt builder when anything changed."""
+        if self.registry.refresh():
+            self._sync_registry()
+
+    async def arefresh_registry(self):
+        """Async variant of refresh_registry; the file and database checks run on the worker pool when due."""
+        if self.registry.refresh_due():
+            await run_blocking(self.refresh_registry)
+
+    def describe_datasets(self):
+        """Refresh the dataset registry and describe every queryable dataset."""
+        self.refresh_registry()
+        return self.registry.describe()
+
+    def generate_dynamic_prompt(self, user_query, dataset_name=None):
+        """Generate a refined prompt from the precompiled dataset prefix and the relevant columns."""
+        with timed("prompt_build"):
+            built = self.prompt_builder.build(user_query, dataset_name)
+        logger.debug(
+            "Prompt for '%s': %s tokens (%s in the static prefix, %s columns)",
+            built["dataset_name"], built["tokens"], built["prefix_tokens"], len(built["columns"]),
         )
-        return refined_prompt
+        return built["prompt"]
 
-    def generate_sql_query(self, prompt):
+    def generate_sql_query(self, prompt, dataset_name=None):
         """Generate SQL query using LLM based on the prompt."""
         try:
-            response = self.llm.invoke(prompt)
+            with timed("llm_generation"):
+                response = self.llm.invoke(prompt)
+            record_token_usage(response)
             raw_query = response.content.strip()
-            return self._clean_sql_query(raw_query)
+            return self._clean_sql_query(raw_query, dataset_name)
         except Exception as e:
             raise ValueError(f"Error generating SQL query: {e}")
 
-    def _clean_sql_query(self, query):
-        """Clean and format SQL query for PostgreSQL."""
+    async def agenerate_sql_query(self, prompt, dataset_name=None):
+        """Generate SQL query using the LLM's async API, without blocking the event loop."""
+        try:
+            with timed("llm_generation"):
+                response = await self.llm.ainvoke(prompt)
+            record_token_usage(response)
+            raw_query = response.content.strip()
+            return self._clean_sql_query(raw_query, dataset_name)
+        except Exception as e:
+            raise ValueError(f"Error generating SQL query: {e}")
 
-        print(f"DEBUG: Raw query before cleaning:\n{query}")
-        
-        # Remove SQL code block delimiters (```sql ... ```)
-        if "```sql" in query:
-            query = query.split("```sql")[-1].split("```")[0].strip()
-
-        # Quote all column names to preserve case sensitivity
-        column_names = [col.lower() for col in self.dataset_metadata["columns"].keys()]
-        for column in column_names:
-            query = re.sub(
-                rf"(?<!\")\b{column}\b(?!\")",
-                f'"{column}"',
-                query,
-                flags=re.IGNORECASE
-            )
+    def _cache_lookup(self, user_query, dataset_name=None):
+        """Return (cache key, dataset name, cached_sql) for a question from the already refreshed registry.
 
-        # Replace MySQL DATE_FORMAT with PostgreSQL TO_CHAR
-        query = re.sub(
-            r"DATE_FORMAT\((.+?),\s*'%Y/%m'\)",
-            r"TO_CHAR(\1, 'YYYY/MM')",
-            query,
-            flags=re.IGNORECASE
-        )
+        Without an explicit dataset_name the question is routed to a dataset by the registry.
+        """
+        dataset_name = self.registry.get(dataset_name)["dataset_name"] if dataset_name else self.registry.route(user_query)
+        cache_key = f"{self.registry.hash}:{dataset_name}"
+        cached_sql = self.prompt_cache.get(cache_key, user_query)
+        CACHE_LOOKUPS.labels("prompt", "miss" if cached_sql is None else "hit").inc()
+        return cache_key, dataset_name, cached_sql
 
-        # Define time_filter_column
-        time_filter_column = self.dataset_metadata.get("time_filter_column", "Date").lower()
+    def _parse_intent(self, user_query, dataset_name):
+        """SQL from the local intent parser, or None when the LLM has to answer (parser errors never fail a question)."""
+        try:
+            with timed("intent_parse"):
+                intent = self.intent_parser.parse(user_query, dataset_name)
+        except Exception as e:
+            logger.warning("Intent parser failed for '%s': %s", user_query, e)
+            intent = None
+        CACHE_LOOKUPS.labels("intent", "miss" if intent is None else "hit").inc()
+        return None if intent is None else intent.sql
 
-        # Replace LIKE patterns for dates with range comparisons
-        query = re.sub(
-            rf"\"{time_filter_column}\" LIKE '(\d{{4}})%%'",
-            rf"\"{time_filter_column}\" >= '\1-01-01' AND \"{time_filter_column}\" < '\1-01-01'::date + interval '1 year'",
-            query,
-            flags=re.IGNORECASE,
-        )
-        query = re.sub(
-            rf"\"{time_filter_column}\" LIKE '(\d{{4}})/(\d{{2}})%%'",
-            rf"\"{time_filter_column}\" >= '\1-\2-01' AND \"{time_filter_column}\" < '\1-\2-01'::date + interval '1 month'",
-            query,
-            flags=re.IGNORECASE,
-        )
-        # Catch-all for unhandled LIKE with date columns
-        query = re.sub(
-            rf"\"{time_filter_column}\" LIKE '(.+?)%'",
-            lambda match: f"TO_CHAR(\"{time_filter_column}\", 'YYYY/MM/DD') LIKE '{match.group(1)}%'",
-            query,
-            flags=re.IGNORECASE,
-        )
+    def generate_sql_for_question(self, user_query, dataset_name=None):
+        """Return SQL for a user question, consulting the prompt cache and the intent parser before the LLM."""
+        self.refresh_registry()
+        cache_key, dataset_name, cached_sql = self._cache_lookup(user_query, dataset_name)
+        if cached_sql is not None:
+            return cached_sql
+        parsed_sql = self._parse_intent(user_query, dataset_name)
+        if parsed_sql is not None:
+            return parsed_sql
+        generated_sql = self.generate_sql_query(self.generate_dynamic_prompt(user_query, dataset_name), dataset_name)
+        self.prompt_cache.put(cache_key, user_query, generated_sql)
+        return generated_sql
 
-        # Replace YEAR() with EXTRACT(YEAR FROM ...)
-        query = re.sub(
-            rf"YEAR\(\"{time_filter_column}\"\)",
-            f"EXTRACT(YEAR FROM \"{time_filter_column}\")",
-            query,
-            flags=re.IGNORECASE,
+    async def agenerate_sql_for_question(self, user_query, dataset_name=None):
+        """Async variant of generate_sql_for_question."""
+        await self.arefresh_registry()
+        cache_key, dataset_name, cached_sql = self._cache_lookup(user_query, dataset_name)
+        if cached_sql is not None:
+            return cached_sql
+        if self.intent_parser.loaded(dataset_name):
+            parsed_sql = self._parse_intent(user_query, dataset_name)
+        else:
+            # The first parse for a dataset reads its dimension values from the database.
+            parsed_sql = await run_blocking(self._parse_intent, user_query, dataset_name)
+        if parsed_sql is not None:
+            return parsed_sql
+        generated_sql = await self.agenerate_sql_query(
+            self.generate_dynamic_prompt(user_query, dataset_name), dataset_name
         )
+        self.prompt_cache.put(cache_key, user_query, generated_sql)
+        return generated_sql
 
-        # Replace redundant LOWER() calls
-        query = re.sub(r"LOWER\(LOWER\((.+?)\)\)", r"LOWER(\1)", query)
-
-        # Simplify numeric comparisons wrapped with LOWER()
-        query = re.sub(r"LOWER\((EXTRACT\(.+?\))\) = LOWER\('(\d+)'\)", r"\1 = \2", query)
-
-        # Ensure consistent capitalization for string literals
-        query = re.sub(
-            r"= '([^']*)'",
-            lambda match: f"= '{match.group(1).capitalize()}'",
-            query,
-        )
+    def _clean_sql_query(self, query, dataset_name=None):
+        """Clean and format SQL query for PostgreSQL, with the dataset's compiled rewrite rules."""
 
-        # Ensure case-insensitive string comparisons for PostgreSQL
-        query = re.sub(
-            r"WHERE (.+?) = '(.+?)'",
-            lambda match: f"WHERE LOWER({match.group(1)}) = LOWER('{match.group(2)}')",
-            query,
-            )
+        logger.debug("Raw query before cleaning:\n%s", query)
 
-        # Handle MAX with additional columns via CTE
-        if "MAX(" in query and "," in query:
-            query = re.sub(
-                rf"SELECT MAX\((.+?)\), (.+?), (.+?)\s+FROM (.+?)\s+WHERE (.+)",
-                rf"WITH ranked_commissions AS (SELECT \2, \3, \1, ROW_NUMBER() OVER (ORDER BY \1 DESC) AS r FROM \4 WHERE \5) "
-                rf"SELECT \2, \3, \1 FROM ranked_commissions WHERE r = 1",
-                query,
-                flags=re.IGNORECASE,
-            )
+        with timed("clean_sql"):
+            query = self.registry.rewriter(dataset_name).rewrite(query)
 
-        # Remove any trailing semicolon in the WITH clause
-        query = re.sub(
-            r"WITH ranked_commissions AS \((.*?);?\)",
-            r"WITH ranked_commissions AS (\1)",
-            query,
-            flags=re.IGNORECASE | re.DOTALL,
-            )
-        
-        # Remove GROUP BY when ROW_NUMBER() is used
-        if "ROW_NUMBER()" in query:
-            query = re.sub(r"GROUP BY .+?\n", "", query, flags=re.IGNORECASE)
-            query = re.sub(r"ORDER BY MAX\(.+?\)\s*DESC", "", query, flags=re.IGNORECASE)
+        logger.debug("Cleaned query:\n%s", query)
 
-        print(f"DEBUG: Cleaned query: \n{query}")
-        
         return query
 
     def execute_query(self, query):
@@ -209,16 +391,273 @@ class LLMService:
         try:
             if not isinstance(query, str):
                 query = str(query)
-            print(f"Executing SQL query: {query}")
-            with self.engine.connect() as connection:
+            routed, rollup, dimensions = self.advisor.route(query)
+            cached = self._cached_result(routed)
+            if cached is not None:
+                return cached
+            start = time.perf_counter()
+            if self.analytics.enabled:
+                with timed("execute_query"):
+                    served = self.analytics.fetch(query, self.policy.max_rows + 1)
+                if served is not None:
+                    return self._remember_result(routed, self._served_rows(query, served, start, dimensions))
+            logger.debug("Executing SQL query: %s", routed)
+            with timed("execute_query"), self.engine.connect() as connection:
                 with connection.begin():
-                    result = connection.execute(text(query))
+                    self.policy.check(connection, routed)
+                    result = connection.execute(text(routed))
                     if result.returns_rows:
-                        rows = result.fetchall()
-                        return [dict(zip(result.keys(), row)) for row in rows]
-                    return {"message": f"Query executed successfully. Rows affected: {result.rowcount}"}
+                        rows = result.fetchmany(self.policy.max_rows + 1)
+                        self.policy.check_fetched(len(rows))
+                        self.advisor.record(query, time.perf_counter() - start, len(rows), rollup, dimensions)
+                        return self._remember_result(routed, [dict(zip(result.keys(), row)) for row in rows])
+                    rowcount = result.rowcount
+            # Recorded after the commit so readers never cache pre-write results.
+            return self._record_write(query, rowcount)
+        except QueryRejected:
+            raise
+        except Exception as e:
+            logger.error("Query Execution Error: %s", e)
+            self.policy.raise_if_timeout(e)
+            raise ValueError(f"Error executing query: {e}")
+
+    def execute_query_page(self, query, page_size, cursor=None):
+        """Fetch one page of a SELECT as {"columns", "rows", "has_more", "cursor"} with a keyset window.
+
+        cursor is the "cursor" of the previous page (None for the first page).
+        """
+        try:
+            routed, rollup, dimensions = self.advisor.route(query)
+            if cursor is None:
+                cursor = page_cursor(query, self._result_columns(routed))
+            paged_query = keyset_sql(routed, cursor, page_size + 1)
+            cached = self._cached_result(paged_query)
+            if cached is not None:
+                return cached
+            start = time.perf_counter()
+            if self.analytics.enabled:
+                with timed("execute_query"):
+                    served = self.analytics.fetch(keyset_sql(query, cursor, page_size + 1), page_size + 1)
+                if served is not None:
+                    return self._remember_result(
+                        paged_query, self._served_page(query, served, start, dimensions, cursor, page_size)
+                    )
+            logger.debug("Executing SQL query page (after %s, size %s): %s", cursor["after"], page_size, query)
+            with timed("execute_query"), self.engine.connect() as connection:
+                self.policy.check(connection, paged_query)
+                result = connection.execution_options(stream_results=True).execute(text(paged_query))
+                rows = result.fetchmany(page_size + 1)
+            self.advisor.record(query, time.perf_counter() - start, len(rows), rollup, dimensions)
+            return self._remember_result(paged_query, self._page(cursor, rows, page_size))
+        except QueryRejected:
+            raise
+        except Exception as e:
+            logger.error("Query Execution Error: %s", e)
+            self.policy.raise_if_timeout(e)
+            raise ValueError(f"Error executing query: {e}")
+
+    async def aexecute_query_page(self, query, page_size, cursor=None):
+        """Async variant of execute_query_page."""
+        if self.async_engine is None:
+            return await run_blocking(self.execute_query_page, query, page_size, cursor)
+        try:
+            routed, rollup, dimensions = await self._aroute(query)
+            if cursor is None:
+                cursor = page_cursor(query, await self._aresult_columns(routed))
+            paged_query = keyset_sql(routed, cursor, page_size + 1)
+            cached = self._cached_result(paged_query)
+            if cached is not None:
+                return cached
+            start = time.perf_counter()
+            if self.analytics.enabled:
+                with timed("execute_query"):
+                    served = await run_blocking(
+                        self.analytics.fetch, keyset_sql(query, cursor, page_size + 1), page_size + 1
+                    )
+                if served is not None:
+                    return self._remember_result(
+                        paged_query, self._served_page(query, served, start, dimensions, cursor, page_size)
+                    )
+            logger.debug("Executing SQL query page (after %s, size %s): %s", cursor["after"], page_size, query)
+            with timed("execute_query"):
+                async with self.async_engine.connect() as connection:
+                    await self.policy.acheck(connection, paged_query)
+                    result = await connection.stream(text(paged_query))
+                    rows = await result.fetchmany(page_size + 1)
+                    await result.close()
+            self.advisor.record(query, time.perf_counter() - start, len(rows), rollup, dimensions)
+            return self._remember_result(paged_query, self._page(cursor, rows, page_size))
+        except QueryRejected:
+            raise
+        except Exception as e:
+            logger.error("Query Execution Error: %s", e)
+            self.policy.raise_if_timeout(e)
+            raise ValueError(f"Error executing query: {e}")
+
+    def execute_query_arrow(self, query):
+        """Execute a SELECT and return the result as an Arrow table, fetched in record batches."""
+        try:
+            if not isinstance(query, str):
+                query = str(query)
+            routed, rollup, dimensions = self.advisor.route(query)
+            start = time.perf_counter()
+            if self.analytics.enabled:
+                with timed("execute_query_arrow"):
+                    table = self.analytics.fetch_arrow(query)
+                if table is not None:
+                    self.advisor.record(query, time.perf_counter() - start, table.num_rows, None, dimensions)
+                    return table
+            logger.debug("Executing SQL query (arrow): %s", routed)
+            with timed("execute_query_arrow"):
+                table = fetch_arrow_table(
+                    self.engine, routed,
+                    prepare=lambda connection: self.policy.check(connection, routed),
+                    wrap=self.policy.capped,
+                )
+            self.advisor.record(query, time.perf_counter() - start, table.num_rows, rollup, dimensions)
+            return table
+        except QueryRejected:
+            raise
+        except Exception as e:
+            logger.error("Query Execution Error: %s", e)
+            self.policy.raise_if_timeout(e)
+            raise ValueError(f"Error executing query: {e}")
+
+    def stream_arrow_ipc(self, query):
+        """Check a SELECT against the execution policy, then return its Arrow IPC byte stream.
+
+        The plan is checked up front so rejections surface before a response
+        starts; the stream itself runs under the policy's statement timeout.
+        Its row count is not capped because the rows are never held in memory.
+        """
+        self.check_query(query)
+        return iter_arrow_ipc(self.engine, query, prepare=lambda connection: self.policy.check(connection, query))
+
+    def check_query(self, query):
+        """Classify and EXPLAIN a statement without running it; returns the plan estimate."""
+        with self.engine.connect() as connection:
+            # Closing the connection rolls back the SET LOCAL.
+            return self.policy.check(connection, query)
+
+    async def aexecute_query_arrow(self, query):
+        """Async variant of execute_query_arrow, run on the worker pool."""
+        return await run_blocking(self.execute_query_arrow, query)
+
+    @staticmethod
+    def _page(cursor, rows, page_size):
+        """Shape keyset rows (values plus the trailing page_dup counter) into a page and the next cursor."""
+        rows = [tuple(row) for row in rows]
+        has_more = len(rows) > page_size
+        return {
+            "columns": cursor["columns"],
+            "rows": [list(row[:-1]) for row in rows[:page_size]],
+            "has_more": has_more,
+            "cursor": dict(cursor, after=list(rows[page_size - 1])) if has_more else None,
+        }
+
+    @staticmethod
+    def _probe_sql(query):
+        return f"SELECT * FROM ({query.strip().rstrip(';')}\n) AS page_source LIMIT 0"
+
+    def _result_columns(self, query):
+        """Column names of a SELECT's result, from a LIMIT 0 probe (cached like any result)."""
+        probe = self._probe_sql(query)
+        cached = self._cached_result(probe)
+        if cached is not None:
+            return cached
+        self.policy.classify(query)
+        with self.engine.connect() as connection:
+            return self._remember_result(probe, list(connection.execute(text(probe)).keys()))
+
+    async def _aresult_columns(self, query):
+        probe = self._probe_sql(query)
+        cached = self._cached_result(probe)
+        if cached is not None:
+            return cached
+        self.policy.classify(query)
+        async with self.async_engine.connect() as connection:
+            return self._remember_result(probe, list((await connection.execute(text(probe))).keys()))
+
+    def _served_rows(self, query, served, start, dimensions):
+        """Shape (columns, rows) from the DuckDB backend like execute_query's result."""
+        columns, rows = served
+        self.policy.check_fetched(len(rows))
+        self.advisor.record(query, time.perf_counter() - start, len(rows), None, dimensions)
+        return [dict(zip(columns, row)) for row in rows]
+
+    def _served_page(self, query, served, start, dimensions, cursor, page_size):
+        _, rows = served
+        self.advisor.record(query, time.perf_counter() - start, len(rows), None, dimensions)
+        return self._page(cursor, rows, page_size)
+
+    def _cached_result(self, query):
+        """Return cached rows for a read query whose tables have not changed."""
+        if not is_read_query(query):
+            return None
+        cached = self.result_cache.get(query, self.table_versions)
+        CACHE_LOOKUPS.labels("result", "miss" if cached is None else "hit").inc()
+        return cached
+
+    def _remember_result(self, query, results):
+        if is_read_query(query):
+            self.result_cache.put(query, self.table_versions, results)
+        return results
+
+    def _record_write(self, query, rowcount):
+        """Bump the version of every table a non-SELECT statement touched and forget its chunk hashes."""
+        table_names = referenced_tables(query)
+        # Rows changed by hand no longer match the hashes a later merge would skip on.
+        self.ingestor.forget_tables(table_names)
+        for table_name in table_names:
+            self.table_versions.bump(table_name)
+            self.intent_parser.invalidate(table_name)
+            # Rollups of a table changed outside the ingest path are stale until the next refresh.
+            for rollup in self.advisor.mark_stale(table_name):
+                self.table_versions.bump(rollup)
+        return {"message": f"Query executed successfully. Rows affected: {rowcount}"}
+
+    async def _aroute(self, query):
+        """advisor.route() without blocking the event loop: its first call reads the schema and rollups."""
+        if self.advisor.loaded():
+            return self.advisor.route(query)
+        return await run_blocking(self.advisor.route, query)
+
+    async def aexecute_query(self, query):
+        """Execute the SQL query on the async engine, or on the worker pool without one."""
+        if self.async_engine is None:
+            return await run_blocking(self.execute_query, query)
+        try:
+            if not isinstance(query, str):
+                query = str(query)
+            routed, rollup, dimensions = await self._aroute(query)
+            cached = self._cached_result(routed)
+            if cached is not None:
+                return cached
+            start = time.perf_counter()
+            if self.analytics.enabled:
+                with timed("execute_query"):
+                    served = await run_blocking(self.analytics.fetch, query, self.policy.max_rows + 1)
+                if served is not None:
+                    return self._remember_result(routed, self._served_rows(query, served, start, dimensions))
+            logger.debug("Executing SQL query: %s", routed)
+            with timed("execute_query"):
+                async with self.async_engine.connect() as connection:
+                    async with connection.begin():
+                        await self.policy.acheck(connection, routed)
+                        result = await connection.execute(text(routed))
+                        if result.returns_rows:
+                            rows = result.fetchmany(self.policy.max_rows + 1)
+                            self.policy.check_fetched(len(rows))
+                            self.advisor.record(query, time.perf_counter() - start, len(rows), rollup, dimensions)
+                            return self._remember_result(routed, [dict(zip(result.keys(), row)) for row in rows])
+                        rowcount = result.rowcount
+            # Recorded after the commit so readers never cache pre-write results.
+            return await run_blocking(self._record_write, query, rowcount)
+        except QueryRejected:
+            raise
         except Exception as e:
-            print(f"Query Execution Error: {e}")
+            logger.error("Query Execution Error: %s", e)
+            self.policy.raise_if_timeout(e)
             raise ValueError(f"Error executing query: {e}")
 
     def main_process(self, dataset_path, table_name):
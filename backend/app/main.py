@@ -1,13 +1,43 @@
 from fastapi import FastAPI, HTTPException, Form, Query, UploadFile
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import text
+from sqlalchemy import inspect, text
+import json
+import logging
 import os
+import re
 import shutil
-import pandas as pd
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from app.batch import BATCH_MAX_PROMPTS, BatchRunner
 from app.llm_service import LLMService
-from fastapi.responses import FileResponse, JSONResponse
+from app.database import pool_stats
+from app.concurrency import run_blocking
+from app.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, decode_page_token, encode_page_token
+from app.result_cache import is_read_query
+from app.jobs import JobManager, dedupe_key
+from app.prompt_cache import normalize_prompt
+from app.exporters import EXPORTERS, MEDIA_TYPES
+from app.metrics import render_metrics, timed, timed_iter
+from app.query_policy import QueryRejected
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# Debug output (raw/cleaned SQL, per-query traces) is only formatted when LOG_LEVEL=DEBUG.
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app):
+    # The CSV parsing pool starts once, from the main thread, before any upload.
+    llm_service.parallel_ingestor.start()
+    yield
+    llm_service.parallel_ingestor.close()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,37 +58,183 @@ METADATA_PATH = os.path.join(DATASETS_FOLDER, "dataset_metadata.json")
 os.makedirs(DATASETS_FOLDER, exist_ok=True)
 
 llm_service = LLMService(api_key=API_KEY, db_url=DB_URL, metadata_path=METADATA_PATH)
+job_manager = JobManager(llm_service.engine)
+batch_runner = BatchRunner(llm_service)
 
-@app.post("/upload/")
-async def upload_file(file: UploadFile):
+
+# Per-file progress of uploads, keyed by file name.
+upload_progress = {}
+
+
+def save_upload(file, file_path):
+    """Copy an uploaded file to disk."""
+    with open(file_path, "wb") as buffer:
+        shutil.copyfileobj(file.file, buffer)
+
+
+INGEST_MODES = ("append", "incremental")
+TABLE_NAME_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]{0,62}")
+# Merge counters reported for incremental uploads.
+MERGE_STATS = ("inserted", "updated", "skipped_chunks", "skipped_rows", "rejected_rows")
+
+
+async def ingest_uploads(files, table_name, mode="append"):
+    """Save uploaded files to disk, bulk load them into a table and remove them."""
+    file_paths = [os.path.join(DATASETS_FOLDER, file.filename) for file in files]
     try:
-        file_path = os.path.join(DATASETS_FOLDER, file.filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        for file, file_path in zip(files, file_paths):
+            await run_blocking(save_upload, file, file_path)
+            upload_progress[file.filename] = {"status": "queued"}
+
+        def report(file_name, progress):
+            upload_progress[file_name] = dict(progress, status="loading")
 
-        data = llm_service.load_dataset(file_path)
-        table_name = llm_service.dataset_metadata.get("dataset_name")
+        stats = await run_blocking(
+            llm_service.store_files_in_sql, file_paths, table_name, progress=report, mode=mode
+        )
+        for file_name, progress in stats["files"].items():
+            upload_progress[file_name] = dict(progress, status="done")
+        return stats
+    except Exception:
+        for file in files:
+            upload_progress[file.filename] = {"status": "failed"}
+        raise
+    finally:
+        for file_path in file_paths:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+
+def check_upload_target(mode, table_name):
+    if mode not in INGEST_MODES:
+        raise HTTPException(status_code=400, detail="Invalid mode. Use 'append' or 'incremental'.")
+    if table_name is not None and not TABLE_NAME_PATTERN.fullmatch(table_name):
+        raise HTTPException(status_code=400, detail="Invalid table name. Use letters, digits and underscores.")
+
+
+def check_dataset(dataset):
+    if dataset is not None and llm_service.registry.find(dataset) is None:
+        raise HTTPException(status_code=400, detail=f"Unknown dataset '{dataset}'. See /datasets/.")
+
+
+@app.post("/upload/")
+async def upload_file(file: UploadFile, mode: str = Form("append"), table_name: Optional[str] = Form(None)):
+    """
+    Upload a CSV file into the dataset table.
+    - mode: 'append' adds every row; 'incremental' upserts on the metadata
+      natural_key and skips chunks that were already loaded unchanged.
+    - table_name: Target table (default: the first dataset in the metadata). New
+      tables are introspected and become queryable datasets.
+    """
+    check_upload_target(mode, table_name)
+    try:
+        table_name = table_name or llm_service.dataset_metadata.get("dataset_name")
         if not table_name:
             raise ValueError("Table name not defined in the metadata file.")
-        
-        llm_service.store_data_in_sql(file_path= file_path, table_name= table_name)
-        os.remove(file_path)
 
-        return {
+        stats = await ingest_uploads([file], table_name, mode)
+
+        response = {
             "message": f"File '{file.filename}' uploaded and stored in the database successfully.",
             "table_name": table_name,
+            "mode": mode,
+            "rows": stats["rows"],
         }
+        response.update({key: stats[key] for key in MERGE_STATS if key in stats})
+        return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"File upload and database storage failed: {str(e)}")
 
+
+@app.post("/upload/batch/")
+async def upload_files(files: List[UploadFile], mode: str = Form("append"), table_name: Optional[str] = Form(None)):
+    """
+    Upload several CSV files (or one large one) into the dataset table.
+    Files are split into byte ranges at record boundaries (quoted newlines
+    included) that are parsed in a process pool and written by a single
+    database writer. Per-file progress is
+    available from /upload/progress/ while the load runs. mode and table_name
+    work as for /upload/.
+    """
+    check_upload_target(mode, table_name)
+    try:
+        table_name = table_name or llm_service.dataset_metadata.get("dataset_name")
+        if not table_name:
+            raise ValueError("Table name not defined in the metadata file.")
+
+        stats = await ingest_uploads(files, table_name, mode)
+
+        response = {
+            "message": f"{len(files)} file(s) uploaded and stored in the database successfully.",
+            "table_name": table_name,
+            "mode": mode,
+            "rows": stats["rows"],
+            "rows_per_sec": stats["rows_per_sec"],
+            "files": stats["files"],
+        }
+        response.update({key: stats[key] for key in MERGE_STATS if key in stats})
+        return response
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"File upload and database storage failed: {str(e)}")
+
+
+@app.get("/upload/progress/")
+async def upload_progress_status():
+    """Report per-file progress of uploads that are loading or recently finished."""
+    return upload_progress
+
+
 @app.post("/etl/execute/")
-async def etl_execute_endpoint(prompt: str = Form(...)):
+async def etl_execute_endpoint(prompt: str = Form(...),
+                               page_size: int = Form(DEFAULT_PAGE_SIZE),
+                               page_token: Optional[str] = Form(None),
+                               result_format: str = Form("json"),
+                               dataset: Optional[str] = Form(None)):
+    """
+    Generate SQL for a prompt and return one page of its results.
+    - dataset: Dataset (table) to query; by default the prompt is routed to the best matching one.
+    - page_size: Rows per page (at most MAX_PAGE_SIZE).
+    - page_token: The next_page_token from the previous response, to fetch the next page.
+      It carries the SQL of the first page, so later pages are not generated again.
+    - result_format: 'json' (paged) or 'arrow' (the full result as an Arrow IPC stream).
+    Rows are returned as arrays; column names are listed once in "columns".
+    Pages follow a keyset over a total row order (the query's ORDER BY, then
+    every column), so rows never repeat or go missing between pages.
+    Statements refused by the execution policy (too costly, DDL, several
+    statements...) return 422 with a structured reason.
+    """
+    if result_format not in ("json", "arrow"):
+        raise HTTPException(status_code=400, detail="Invalid result format. Use 'json' or 'arrow'.")
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"page_size must be between 1 and {MAX_PAGE_SIZE}.")
+    check_dataset(dataset)
     try:
-        refined_prompt = llm_service.generate_dynamic_prompt(prompt)
-        generated_sql = llm_service.generate_sql_query(refined_prompt)
-        results = llm_service.execute_query(text(generated_sql))
+        cursor = None
+        if page_token:
+            try:
+                generated_sql, cursor = decode_page_token(page_token)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        else:
+            generated_sql = await llm_service.agenerate_sql_for_question(prompt, dataset)
+        if not is_read_query(generated_sql):
+            result = await llm_service.aexecute_query(generated_sql)
+            return {
+                "message": result["message"],
+                "generated_sql": generated_sql,
+            }
+
+        if result_format == "arrow":
+            stream = await run_blocking(llm_service.stream_arrow_ipc, generated_sql)
+            return StreamingResponse(
+                timed_iter("export_arrow", stream, "arrow"),
+                media_type=MEDIA_TYPES["arrow"],
+                headers={"X-Generated-SQL": " ".join(generated_sql.split())},
+            )
 
-        if not results:
+        page = await llm_service.aexecute_query_page(generated_sql, page_size, cursor)
+
+        if not page["rows"] and cursor is None:
             response = {
                 "message": "Query executed successfully but returned no data.",
                 "generated_sql": generated_sql,
@@ -69,99 +245,228 @@ async def etl_execute_endpoint(prompt: str = Form(...)):
         response = {
             "message": "Query executed successfully.",
             "generated_sql": generated_sql,
-            "results": results
+            "columns": page["columns"],
+            "rows": page["rows"],
+            "page_size": page_size,
+            "next_page_token": encode_page_token(generated_sql, page["cursor"]) if page["has_more"] else None,
         }
         return response
 
+    except HTTPException:
+        raise
+    except QueryRejected as e:
+        raise HTTPException(status_code=422, detail=e.to_dict())
     except Exception as e:
-        print(f"DEBUG: Exception: {str(e)}")
+        logger.exception("ETL execution failed: %s", e)
         raise HTTPException(status_code=500, detail=f"ETL execution failed: {str(e)}")
 
-@app.post("/etl/save/")
-async def etl_save_endpoint(prompt: str = Form(...), save_table_name: str = Form(...)):
-    try:
-        refined_prompt = llm_service.generate_dynamic_prompt(prompt)
-        generated_sql = llm_service.generate_sql_query(refined_prompt)
-        results = llm_service.execute_query(text(generated_sql))
+@app.post("/etl/batch/")
+async def etl_batch_endpoint(prompts: List[str] = Form(...),
+                             page_size: int = Form(DEFAULT_PAGE_SIZE),
+                             dataset: Optional[str] = Form(None)):
+    """
+    Generate and run SQL for many prompts at once, streaming one NDJSON line per prompt as it finishes.
+    - prompts: Repeat the field once per question (at most BATCH_MAX_PROMPTS).
+    - page_size: Rows returned per question (the first page, as in /etl/execute/).
+    - dataset: Dataset (table) to query; by default each prompt is routed to its best matching one.
+    Each line carries the prompt's index, its generated_sql and columns/rows,
+    or an "error" object; "shared" is true when an identical query already ran
+    for another prompt. The last line is a {"summary": ...} object.
+    """
+    if not 1 <= len(prompts) <= BATCH_MAX_PROMPTS:
+        raise HTTPException(status_code=400, detail=f"Send between 1 and {BATCH_MAX_PROMPTS} prompts.")
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"page_size must be between 1 and {MAX_PAGE_SIZE}.")
+    check_dataset(dataset)
 
-        if not results:
-            return {
-                "message": "Query executed successfully but returned no data.",
-                "generated_sql": generated_sql,
-                "saved_table_name": save_table_name,
-                "files": None
-            }
+    async def lines():
+        async for result in batch_runner.run(prompts, dataset, page_size):
+            yield json.dumps(jsonable_encoder(result)) + "\n"
 
-        df = pd.DataFrame(results)
-        df.columns = [f"column_{i}" if not col or col.isspace() else col for i, col in enumerate(df.columns)]
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
-        # Save the DataFrame directly to the database
-        llm_service.store_dataframe_in_sql(df, table_name=save_table_name)
 
-        output_folder = os.path.join(DATASETS_FOLDER, "output")
-        os.makedirs(output_folder, exist_ok=True)
-        csv_path = os.path.join(output_folder, f"{save_table_name}.csv")
-        xlsx_path = os.path.join(output_folder, f"{save_table_name}.xlsx")
-        pdf_path = os.path.join(output_folder, f"{save_table_name}.pdf")
+def export_table(table_name, file_format, path):
+    """Write a table to a file by streaming it from the database in batches."""
+    with open(path, "wb") as output, timed(f"serialize_{file_format}"):
+        for data in EXPORTERS[file_format](llm_service.engine, table_name):
+            output.write(data)
 
-        df.to_csv(csv_path, index=False)
-        df.to_excel(xlsx_path, index=False)
 
+def run_etl_save(prompt, save_table_name, formats, report, dataset=None, if_exists="replace"):
+    """Generate, execute, store and export one ETL save (runs on a job worker)."""
+    report(0.05, "Generating SQL")
+    generated_sql = llm_service.generate_sql_for_question(prompt, dataset)
+    if not is_read_query(generated_sql):
+        raise ValueError("Only SELECT queries can be saved to a table.")
+
+    report(0.3, f"Saving query results in {save_table_name}")
+    saved = llm_service.save_query_as_table(generated_sql, save_table_name, if_exists=if_exists)
+    if saved["rows"] == 0:
         return {
-            "message": "ETL process completed successfully.",
+            "message": "Query executed successfully but returned no data.",
             "generated_sql": generated_sql,
             "saved_table_name": save_table_name,
-            "files": {
-                "csv": csv_path,
-                "xlsx": xlsx_path,
-                "pdf": pdf_path
-            }
+            "files": None
+        }
+
+    # Exports are read back from the saved table; the downloads stream it on request instead.
+    output_folder = os.path.join(DATASETS_FOLDER, "output")
+    os.makedirs(output_folder, exist_ok=True)
+    files = {fmt: os.path.join(output_folder, f"{save_table_name}.{fmt}") for fmt in formats}
+    files["pdf"] = os.path.join(output_folder, f"{save_table_name}.pdf")
+    for idx, fmt in enumerate(formats):
+        report(0.7 + 0.3 * idx / len(formats), f"Writing {fmt}")
+        export_table(save_table_name, fmt, files[fmt])
+
+    return {
+        "message": "ETL process completed successfully.",
+        "generated_sql": generated_sql,
+        "saved_table_name": save_table_name,
+        "rows": saved["rows"],
+        "save_mode": saved["mode"],
+        "files": files,
+        "downloads": {
+            fmt: f"/download/?table_name={save_table_name}&file_format={fmt}" for fmt in EXPORTERS
+        },
+    }
+
+
+@app.post("/etl/save/", status_code=202)
+async def etl_save_endpoint(prompt: str = Form(...), save_table_name: str = Form(...),
+                            file_formats: str = Form("csv,xlsx"), dataset: Optional[str] = Form(None),
+                            if_exists: str = Form("replace")):
+    """
+    Queue an ETL save: generate SQL for a prompt, save its results to a table and export them.
+    - file_formats: Comma-separated export formats ('csv', 'xlsx', 'parquet') written to
+      Datasets/output; empty for none (the result lists /download/ links that stream the table).
+    - dataset: Dataset (table) to query; by default the prompt is routed to the best matching one.
+    - if_exists: 'replace' the table atomically (default) or 'append' the results to it.
+    On PostgreSQL the results are saved in the database (CREATE TABLE ... AS / INSERT ... SELECT)
+    without passing through the API.
+    Returns a job id immediately; poll /etl/jobs/{job_id} for progress and the result.
+    A save with the same prompt and target table that is still queued or running
+    is reused instead of being started again.
+    """
+    formats = [fmt.strip() for fmt in file_formats.split(",") if fmt.strip()]
+    if any(fmt not in EXPORTERS for fmt in formats):
+        raise HTTPException(status_code=400, detail="Invalid file format. Use 'csv', 'xlsx' or 'parquet'.")
+    if if_exists not in ("replace", "append"):
+        raise HTTPException(status_code=400, detail="Invalid if_exists. Use 'replace' or 'append'.")
+    check_dataset(dataset)
+    try:
+        key = dedupe_key(
+            "etl_save", normalize_prompt(prompt), save_table_name.lower(), (dataset or "").lower(), if_exists
+        )
+        job_id, created = await run_blocking(
+            job_manager.submit, "etl_save", key, run_etl_save, prompt, save_table_name, formats,
+            dataset=dataset, if_exists=if_exists,
+        )
+        return {
+            "message": "ETL save queued." if created else "An identical ETL save is already in progress.",
+            "job_id": job_id,
+            "status_url": f"/etl/jobs/{job_id}",
+            "saved_table_name": save_table_name,
         }
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"ETL process failed: {str(e)}")
 
 
+@app.get("/etl/jobs/{job_id}")
+async def etl_job_status(job_id: str):
+    """Report the status, progress and (once finished) the result of an ETL job."""
+    job = await run_blocking(job_manager.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' does not exist.")
+    return job
+
+
+@app.get("/etl/cache/")
+async def cache_stats():
+    """Report hit/miss counters for the prompt -> SQL and query result caches, prompt sizes and the intent parser hit rate."""
+    return {
+        "prompt_cache": llm_service.prompt_cache.stats(),
+        "result_cache": llm_service.result_cache.stats(),
+        "prompt_builder": llm_service.prompt_builder.stats(),
+        "intent_parser": llm_service.intent_parser.stats(),
+    }
+
+
+@app.get("/datasets/")
+async def list_datasets():
+    """List the queryable datasets (declared in the metadata file or registered by uploads)."""
+    return await run_blocking(llm_service.describe_datasets)
+
+
+@app.get("/db/pool/")
+async def database_pool_stats():
+    """Report connection pool occupancy and checkout wait times per database."""
+    return pool_stats()
+
+
+@app.get("/analytics/")
+async def analytics_backend_stats():
+    """Report the execution backend for read queries, its DuckDB snapshots and how many queries it served."""
+    return llm_service.analytics.stats()
+
+
+@app.get("/advisor/")
+async def advisor_report():
+    """Report the dataset table's indexes, rollups, rollup suggestions and query log."""
+    try:
+        return await run_blocking(llm_service.advisor.report)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error building advisor report: {e}")
+
+
+@app.post("/advisor/rollups/")
+async def create_rollups(dimensions: Optional[str] = Form(None)):
+    """Create the rollup for comma-separated dimension columns, or every recommended rollup."""
+    dimension_list = [col.strip() for col in dimensions.split(",") if col.strip()] if dimensions is not None else None
+    try:
+        return {"created": await run_blocking(llm_service.create_rollups, dimension_list)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/metrics")
+async def metrics():
+    """Expose stage latency histograms, token usage and ingest/export counters for Prometheus."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
 @app.get("/download/")
 async def download_table(table_name: str = Query(..., description="The name of the table to download"),
-                         file_format: str = Query("csv", description="The desired file format: 'csv' or 'xlsx'")):
+                         file_format: str = Query("csv", description="The desired file format: 'csv', 'xlsx' or 'parquet'")):
     """
-    Download a table from the database as a .csv or .xlsx file.
+    Stream a table from the database as a .csv, .xlsx or .parquet file.
     - table_name: The name of the table to download.
-    - file_format: The desired file format ('csv' or 'xlsx').
+    - file_format: The desired file format ('csv', 'xlsx' or 'parquet').
+    Rows are read through a server-side cursor in fixed-size batches, so memory
+    stays flat regardless of table size and nothing is written to Datasets/output.
     """
-    try:
-        # Validate file format
-        if file_format not in ["csv", "xlsx"]:
-            raise HTTPException(status_code=400, detail="Invalid file format. Use 'csv' or 'xlsx'.")
-
-        # Query to fetch data from the database
-        query = f"SELECT * FROM {table_name}"
-        with llm_service.engine.connect() as connection:
-            df = pd.read_sql(query, connection)
+    # Validate file format
+    if file_format not in EXPORTERS:
+        raise HTTPException(status_code=400, detail="Invalid file format. Use 'csv', 'xlsx' or 'parquet'.")
 
-        if df.empty:
-            raise HTTPException(status_code=404, detail=f"Table '{table_name}' is empty or does not exist.")
-
-        # Path to save the file
-        output_folder = os.path.join(DATASETS_FOLDER, "output")
-        os.makedirs(output_folder, exist_ok=True)
-        file_path = os.path.join(output_folder, f"{table_name}.{file_format}")
-
-        # Save the file in the requested format
-        if file_format == "csv":
-            df.to_csv(file_path, index=False)
-        elif file_format == "xlsx":
-            df.to_excel(file_path, index=False)
+    try:
+        if not await run_blocking(inspect(llm_service.engine).has_table, table_name):
+            raise HTTPException(status_code=404, detail=f"Table '{table_name}' does not exist.")
 
         # Add Content-Disposition header to set the filename
         headers = {
             "Content-Disposition": f'attachment; filename="{table_name}.{file_format}"'
         }
-
-        # Return the file as a response with the specified filename
-        return FileResponse(file_path, headers=headers)
-
+        return StreamingResponse(
+            timed_iter(f"export_{file_format}", EXPORTERS[file_format](llm_service.engine, table_name), file_format),
+            media_type=MEDIA_TYPES[file_format],
+            headers=headers,
+        )
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
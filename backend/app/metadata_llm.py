@@ -1,21 +1,46 @@
 
+import hashlib
 import json
+import os
 
 class MetadataManager:
     def __init__(self, metadata_path):
         self.metadata_path = metadata_path
         self.metadata = None
+        self.metadata_hash = None
+        self.metadata_mtime = None
 
     def load_metadata(self):
         """Load dataset metadata from a JSON file."""
         try:
+            self.metadata_mtime = os.path.getmtime(self.metadata_path)
             with open(self.metadata_path, "r") as file:
                 self.metadata = json.load(file)
+            self.metadata_hash = hashlib.sha256(
+                json.dumps(self.metadata, sort_keys=True).encode("utf-8")
+            ).hexdigest()
         except Exception as e:
             raise ValueError(f"Error loading metadata: {e}")
 
+    def reload_if_changed(self):
+        """Reload the metadata when the JSON file changed on disk. Returns True if reloaded."""
+        try:
+            mtime = os.path.getmtime(self.metadata_path)
+        except OSError:
+            return False
+        if mtime == self.metadata_mtime:
+            return False
+        self.load_metadata()
+        return True
+
     def get_metadata(self):
         """Retrieve the loaded metadata."""
         if not self.metadata:
             raise ValueError("Metadata not loaded. Call load_metadata first.")
-        return self.metadata
\ No newline at end of file
+        return self.metadata
+
+    def get_metadata_hash(self):
+        """Retrieve a stable hash of the loaded metadata."""
+        if not self.metadata_hash:
+            raise ValueError("Metadata not loaded. Call load_metadata first.")
+        return self.metadata_hash
\ No newline at end of file
@@ -0,0 +1,77 @@
+import time
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+# Buckets span sub-millisecond SQL rewriting up to multi-minute loads and LLM calls.
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram(
+    "etl_stage_duration_seconds",
+    "Time spent in each stage of the prompt -> SQL -> result pipeline.",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+STAGE_ERRORS = Counter("etl_stage_errors_total", "Stages that raised an exception.", ["stage"])
+LLM_TOKENS = Counter("etl_llm_tokens_total", "Tokens reported by the LLM provider.", ["kind"])
+INGEST_ROWS = Counter("etl_ingest_rows_total", "Rows written to database tables by uploads and saves.", ["table"])
+EXPORT_BYTES = Counter("etl_export_bytes_total", "Bytes produced by file exports.", ["format"])
+CACHE_LOOKUPS = Counter("etl_cache_lookups_total", "Prompt and result cache lookups.", ["cache", "outcome"])
+QUERY_REJECTIONS = Counter("etl_query_rejections_total", "Statements refused by the execution policy.", ["reason"])
+LLM_RATE_LIMIT_RETRIES = Counter("etl_llm_rate_limit_retries_total", "LLM calls retried after a rate-limit response.")
+ANALYTICS_QUERIES = Counter(
+    "etl_analytics_queries_total", "Read queries offered to the DuckDB backend, by outcome.", ["outcome"]
+)
+
+
+@contextmanager
+def timed(stage):
+    """Record the duration of a block in the stage histogram (and count it as an error if it raises)."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+def timed_iter(stage, chunks, export_format=None):
+    """Wrap a streaming generator, timing only the work spent producing its chunks."""
+    elapsed = 0.0
+    iterator = iter(chunks)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            except Exception:
+                STAGE_ERRORS.labels(stage).inc()
+                raise
+            finally:
+                elapsed += time.perf_counter() - start
+            if export_format is not None:
+                EXPORT_BYTES.labels(export_format).inc(len(chunk))
+            yield chunk
+    finally:
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+
+
+def record_token_usage(response):
+    """Count prompt/completion tokens from a LangChain chat response, when the provider reports them."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        LLM_TOKENS.labels("prompt").inc(usage.get("input_tokens", 0))
+        LLM_TOKENS.labels("completion").inc(usage.get("output_tokens", 0))
+        return
+    token_usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+    if token_usage:
+        LLM_TOKENS.labels("prompt").inc(token_usage.get("prompt_tokens", 0))
+        LLM_TOKENS.labels("completion").inc(token_usage.get("completion_tokens", 0))
+
+
+def render_metrics():
+    """Return (body, content type) for the Prometheus text exposition format."""
+    return generate_latest(), CONTENT_TYPE_LATEST
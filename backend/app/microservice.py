@@ -1,10 +1,23 @@
 from sqlalchemy.exc import SQLAlchemyError
 from app.database import get_sql_engine, get_mongo_client
+from app.concurrency import run_blocking
+from app.ingest import CopyIngestor
+from app.json_stream import iter_json_documents
+from app.parallel_ingest import INGEST_START_METHOD
+from app.schema_inference import infer_schema
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from sqlalchemy import BigInteger, Boolean, Date, DateTime, Float, Text
 import pandas as pd
 import pdfplumber
-import json
 import os
 import logging
+import multiprocessing
+import queue
+import shutil
+import tempfile
+import threading
 from fastapi import HTTPException
 
 
@@ -15,6 +28,15 @@ logger = logging.getLogger(__name__)
 OUTPUT_DIR = "./output"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+SQL_CHUNK_ROWS = int(os.getenv("SQL_CHUNK_ROWS", "20000"))
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 2)))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+# Pages without ruled tables are retried with whitespace-aligned column detection.
+PDF_TEXT_TABLE_SETTINGS = {"vertical_strategy": "text", "horizontal_strategy": "text"}
+MONGO_BATCH_DOCUMENTS = int(os.getenv("MONGO_BATCH_DOCUMENTS", "1000"))
+# Parsed batches waiting for the writer; parsing pauses while the queue is full.
+MONGO_MAX_PENDING_BATCHES = int(os.getenv("MONGO_MAX_PENDING_BATCHES", "4"))
+
 
 def process_dataset(file):
     file_ext = file.filename.split('.')[-1].lower()
@@ -31,40 +53,212 @@ def process_dataset(file):
     raise ValueError("Unsupported file type.")
 
 
-async def store_in_sql(file, file_ext):
+def iter_xlsx_rows(source):
     """
-    Process and store a dataset (CSV, Excel, or PDF) into the SQL database.
+    Stream the first worksheet of an XLSX file: yields the column names, then one tuple per non-empty row.
+    Rows are read with openpyxl's read-only reader, so the sheet is never fully in memory.
     """
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(source, read_only=True, data_only=True)
     try:
-        engine = get_sql_engine()
-        logger.info(f"Database engine initialized for SQL")
-
-        # Load file into a pandas DataFrame based on file type
-        if file_ext == 'csv':
-            logger.info(f"Reading CSV file: {file.filename}")
-            df = pd.read_csv(file.file)
-        elif file_ext == 'xlsx':
-            logger.info(f"Reading Excel file: {file.filename}")
-            df = pd.read_excel(file.file)
-        elif file_ext == 'pdf':
-            logger.info(f"Processing PDF file: {file.filename}")
-            try:
-                with pdfplumber.open(file.file) as pdf:
-                    text = ''.join([page.extract_text() for page in pdf.pages])
-                df = parse_pdf_to_csv(text)
-            except Exception as e:
-                logger.error(f"Error parsing PDF: {e}")
-                raise HTTPException(status_code=500, detail=f"Failed to parse PDF: {str(e)}")
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            raise ValueError("The Excel file is empty.")
+        columns = [str(name).strip() if name is not None else f"column_{idx}" for idx, name in enumerate(header)]
+        width = len(columns)
+        yield columns
+        truncated = 0
+        for row in rows:
+            if all(value is None for value in row):
+                continue
+            if len(row) != width:
+                # Sheets without stored dimensions drop trailing empty cells; values past the header are ignored.
+                truncated += any(value is not None for value in row[width:])
+                row = tuple(row[:width]) + (None,) * (width - len(row))
+            yield row
+        if truncated:
+            logger.warning(f"Ignored values beyond the {width} header columns in {truncated} Excel rows")
+    finally:
+        workbook.close()
+
+
+def _xlsx_value_kind(value):
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, datetime):
+        return "datetime"
+    if isinstance(value, date):
+        return "date"
+    return "text"
+
+
+def xlsx_column_types(source):
+    """
+    SQL types for the columns of the first worksheet, chosen over every row (one extra streaming pass).
+    A column mixing numbers, dates or booleans with text (e.g. "N/A") becomes TEXT; empty columns are left out.
+    """
+    rows = iter_xlsx_rows(source)
+    columns = next(rows)
+    kinds = [set() for _ in columns]
+    for row in rows:
+        for seen, value in zip(kinds, row):
+            if value is not None:
+                seen.add(_xlsx_value_kind(value))
+    types = {}
+    for column, seen in zip(columns, kinds):
+        if not seen:
+            continue
+        if seen == {"int"}:
+            types[column] = BigInteger()
+        elif seen <= {"int", "float"}:
+            types[column] = Float(precision=53)
+        elif seen == {"bool"}:
+            types[column] = Boolean()
+        elif seen == {"date"}:
+            types[column] = Date()
+        elif seen <= {"date", "datetime"}:
+            types[column] = DateTime()
         else:
-            raise ValueError("Unsupported file type for SQL storage")
+            types[column] = Text()
+    return types
+
+
+def iter_xlsx_chunks(source, chunk_rows=SQL_CHUNK_ROWS, column_types=None):
+    """
+    Stream the first worksheet of an XLSX file as DataFrame chunks.
+    With column_types (see xlsx_column_types), BIGINT columns stay integers in chunks with
+    missing values and TEXT columns hold every value as a string, whatever a chunk holds.
+    """
+    rows = iter_xlsx_rows(source)
+    columns = next(rows)
+    column_types = column_types or {}
+    integer_columns = [col for col in columns if isinstance(column_types.get(col), BigInteger)]
+    text_columns = [idx for idx, col in enumerate(columns) if isinstance(column_types.get(col), Text)]
+
+    def to_frame(batch):
+        frame = pd.DataFrame(batch, columns=columns)
+        for col in integer_columns:
+            frame[col] = frame[col].astype("Int64")
+        for idx in text_columns:
+            frame.isetitem(idx, [None if row[idx] is None else str(row[idx]) for row in batch])
+        return frame
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= chunk_rows:
+            yield to_frame(batch)
+            batch = []
+    if batch:
+        yield to_frame(batch)
+
+
+def extract_pdf_tables(pdf_path, page_numbers):
+    """
+    Extract the table rows of some PDF pages (runs in a worker process).
+    Returns the rows in page order; cells are stripped strings.
+    """
+    rows = []
+    with pdfplumber.open(pdf_path) as pdf:
+        for number in page_numbers:
+            page = pdf.pages[number]
+            tables = page.extract_tables() or page.extract_tables(PDF_TEXT_TABLE_SETTINGS)
+            for table in tables:
+                for row in table:
+                    cells = [(cell or "").strip() for cell in row]
+                    if any(cells):
+                        rows.append(cells)
+            page.flush_cache()
+    return rows
+
+
+def iter_pdf_chunks(pdf_path, workers=PDF_WORKERS, pages_per_task=PDF_PAGES_PER_TASK):
+    """
+    Stream the tables of a PDF as DataFrame chunks, extracting page ranges in a process pool.
+    The first extracted row is the header; repeated headers on later pages are dropped and
+    rows with a different number of cells are skipped.
+    """
+    with pdfplumber.open(pdf_path) as pdf:
+        page_count = len(pdf.pages)
+    tasks = [range(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+    header = None
+    # Never fork: this runs on a worker thread of the server, next to its other threads and connections.
+    context = multiprocessing.get_context(INGEST_START_METHOD)
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(tasks))), mp_context=context) as executor:
+        # Keep a bounded window of page ranges in flight and consume them in page order.
+        pending = deque()
+        queued = iter(tasks)
+        while True:
+            for pages in queued:
+                pending.append(executor.submit(extract_pdf_tables, pdf_path, list(pages)))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            rows = pending.popleft().result()
+            if header is None and rows:
+                header, rows = rows[0], rows[1:]
+            # Tables that continue across pages repeat their header row.
+            rows = [row for row in rows if row != header]
+            matching = [row for row in rows if len(row) == len(header)]
+            if len(matching) < len(rows):
+                logger.warning(f"Skipped {len(rows) - len(matching)} malformed rows in {pdf_path}")
+            if matching:
+                yield pd.DataFrame(matching, columns=header)
+    if header is None:
+        raise ValueError("No tables found in the PDF.")
+
+
+def load_chunks_to_sql(chunks, table_name, column_types=None):
+    """Replace a table with the given chunks through the bulk (COPY) load path used for CSV uploads."""
+    return CopyIngestor(get_sql_engine()).load(chunks, table_name, if_exists="replace", column_types=column_types)
+
+
+def _store_file_in_sql(file, file_ext, table_name):
+    if file_ext == 'csv':
+        logger.info(f"Reading CSV file: {file.filename}")
+        # One sample types every chunk (and the table), as for /upload/; the spooled upload is read twice.
+        schema = infer_schema(file.file, date_columns=(), detect_dates=True)
+        file.file.seek(0)
+        chunks = pd.read_csv(file.file, chunksize=SQL_CHUNK_ROWS, **schema.read_options())
+        return load_chunks_to_sql((schema.prepare(chunk) for chunk in chunks), table_name, schema.sql_types())
+    if file_ext == 'xlsx':
+        logger.info(f"Reading Excel file: {file.filename}")
+        # Typed over the whole sheet so text further down cannot break the COPY into a numeric column.
+        column_types = xlsx_column_types(file.file)
+        file.file.seek(0)
+        return load_chunks_to_sql(iter_xlsx_chunks(file.file, column_types=column_types), table_name, column_types)
+    if file_ext == 'pdf':
+        logger.info(f"Processing PDF file: {file.filename}")
+        # Worker processes open the PDF by path, so spool the upload to disk first.
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as spool:
+            shutil.copyfileobj(file.file, spool)
+        try:
+            return load_chunks_to_sql(iter_pdf_chunks(spool.name), table_name)
+        finally:
+            os.remove(spool.name)
+    raise ValueError("Unsupported file type for SQL storage")
+
 
-        # Save DataFrame to the database
+async def store_in_sql(file, file_ext):
+    """
+    Process and store a dataset (CSV, Excel, or PDF) into the SQL database.
+    Files are read in chunks (XLSX through a streaming reader, PDF tables page
+    range by page range in a process pool) and bulk loaded with COPY.
+    """
+    try:
         table_name = file.filename.split('.')[0].replace(" ", "_")
         logger.info(f"Saving data to SQL table: {table_name}")
-        df.to_sql(table_name, engine, if_exists='replace', index=False)
-        logger.info(f"Data saved to table {table_name}, row count: {len(df)}")
+        stats = await run_blocking(_store_file_in_sql, file, file_ext, table_name)
+        logger.info(f"Data saved to table {table_name}, row count: {stats['rows']}")
 
-        return {"table_name": table_name, "row_count": len(df)}
+        return {"table_name": table_name, "row_count": stats["rows"]}
     except SQLAlchemyError as e:
         logger.error(f"Database error: {e}")
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
@@ -73,69 +267,90 @@ async def store_in_sql(file, file_ext):
         raise HTTPException(status_code=500, detail=f"Error saving to SQL: {str(e)}")
 
 
+def write_documents(collection, documents, batch_size=MONGO_BATCH_DOCUMENTS, max_pending=MONGO_MAX_PENDING_BATCHES):
+    """
+    Insert documents in unordered insert_many batches from a writer thread.
+    The caller's thread produces batches into a bounded queue, so parsing never runs
+    more than max_pending batches ahead of the database. Documents rejected by the
+    server (e.g. duplicate _id) are counted and the rest of the batch is still written.
+    """
+    from pymongo.errors import BulkWriteError
+
+    pending = queue.Queue(maxsize=max_pending)
+    stats = {"documents": 0, "inserted": 0, "write_errors": 0, "batches": 0}
+    failure = []
+
+    def writer():
+        while True:
+            batch = pending.get()
+            if batch is None:
+                return
+            if failure:
+                continue
+            try:
+                result = collection.insert_many(batch, ordered=False)
+                stats["inserted"] += len(result.inserted_ids)
+            except BulkWriteError as e:
+                stats["inserted"] += e.details.get("nInserted", 0)
+                stats["write_errors"] += len(e.details.get("writeErrors", []))
+            except Exception as e:
+                failure.append(e)
+            stats["batches"] += 1
+
+    thread = threading.Thread(target=writer, name="mongo-writer", daemon=True)
+    thread.start()
+    try:
+        batch = []
+        for document in documents:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                if failure:
+                    break
+                pending.put(batch)
+                stats["documents"] += len(batch)
+                batch = []
+        if batch and not failure:
+            pending.put(batch)
+            stats["documents"] += len(batch)
+    finally:
+        pending.put(None)
+        thread.join()
+    if failure:
+        raise failure[0]
+    return stats
+
+
+def _store_json_in_mongodb(file, collection):
+    ndjson = file.filename.lower().endswith((".ndjson", ".jsonl"))
+    stats = write_documents(collection, iter_json_documents(file.file, ndjson=ndjson))
+    if not stats["documents"]:
+        raise ValueError("JSON file did not contain any documents to insert")
+    return stats
+
+
 async def store_in_mongodb(file):
+    """
+    Stream a JSON or NDJSON (.ndjson/.jsonl) upload into a MongoDB collection.
+    Documents are parsed incrementally and written in bounded, unordered batches
+    off the event loop.
+    """
     try:
         # Initialize MongoDB client
         client = get_mongo_client()
         db = client['datasets']
         collection_name = file.filename.split('.')[0]
 
-        # Read and parse JSON file
-        logging.info(f"Reading JSON file: {file.filename}")
-        data = json.load(file.file)
-
-        # Process the JSON structure
-        if isinstance(data, dict):
-            # Convert the dictionary into a list of documents for MongoDB
-            documents = [{"key": key, "value": value} for key, value in data.items()]
-            # Special handling for nested dictionaries (e.g., "rates")
-            if "rates" in data:
-                rates = [{"currency": k, "rate": v} for k, v in data["rates"].items()]
-                documents.append({"rates": rates})
-        elif isinstance(data, list):
-            # Data is already a list of documents
-            documents = data
-        else:
-            raise ValueError("Unsupported JSON format")
-
-        # Insert documents into MongoDB
-        logging.info(f"Inserting data into MongoDB collection: {collection_name}")
-        if documents:
-            db[collection_name].insert_many(documents)
-        else:
-            raise ValueError("JSON file did not contain any documents to insert")
+        logging.info(f"Inserting data from {file.filename} into MongoDB collection: {collection_name}")
+        stats = await run_blocking(_store_json_in_mongodb, file, db[collection_name])
+        logging.info(f"Inserted {stats['inserted']} documents in {stats['batches']} batches into {collection_name}")
 
-        return {"collection_name": collection_name, "document_count": len(documents)}
+        return {
+            "collection_name": collection_name,
+            "document_count": stats["documents"],
+            "inserted_count": stats["inserted"],
+            "write_errors": stats["write_errors"],
+        }
 
     except Exception as e:
         logging.error(f"Error in store_in_mongodb: {e}")
         raise HTTPException(status_code=500, detail=f"Error saving to MongoDB: {e}")
-
-
-def parse_pdf_to_csv(pdf_text):
-    """
-    Parse the text extracted from a PDF into a DataFrame.
-    Handles tabular data found in the PDF text.
-    """
-    try:
-        lines = pdf_text.split('\n')
-        headers = None
-        rows = []
-        for line in lines:
-            if not line.strip():
-                continue
-            if headers is None and ('County' in line and 'Registered Vehicles' in line):
-                headers = line.split()
-                continue
-            if headers:
-                row = line.split()
-                if len(row) == len(headers):
-                    rows.append(row)
-                else:
-                    logger.warning(f"Skipping malformed row: {row}")
-        if headers is None or not rows:
-            raise ValueError("No valid headers or rows found in the PDF.")
-        return pd.DataFrame(rows, columns=headers)
-    except Exception as e:
-        logger.error(f"Error parsing PDF to CSV: {e}")
-        raise ValueError("Failed to parse the PDF into a structured DataFrame.")
@@ -0,0 +1,207 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+from datetime import date, datetime, time
+from decimal import Decimal
+from app.sql_rewriter import tokenize
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Signs page tokens so the SQL and cursor they carry cannot be altered; set it when several workers serve the API.
+PAGE_TOKEN_SECRET = os.getenv("PAGE_TOKEN_SECRET", "").encode("utf-8") or os.urandom(32)
+
+_DIRECTIONS = {"ASC": False, "DESC": True}
+_CLAUSE_END = frozenset({"LIMIT", "OFFSET", "FETCH", "FOR"})
+
+
+def _significant(sql):
+    return [(kind, value) for kind, value in tokenize(sql) if kind not in ("space", "comment")]
+
+
+def _top_level_order_by(tokens):
+    """Return the items of a statement's top-level ORDER BY, each as a list of tokens."""
+    depth, start = 0, None
+    for idx, (kind, value) in enumerate(tokens):
+        if value == "(":
+            depth += 1
+        elif value == ")":
+            depth -= 1
+        elif depth == 0 and kind == "word" and value.upper() == "ORDER" \
+                and idx + 1 < len(tokens) and tokens[idx + 1][1].upper() == "BY":
+            start = idx + 2
+    if start is None:
+        return []
+    items, current, depth = [], [], 0
+    for kind, value in tokens[start:]:
+        if value == "(":
+            depth += 1
+        elif value == ")":
+            depth -= 1
+        if depth == 0 and (value == ";" or (kind == "word" and value.upper() in _CLAUSE_END)):
+            break
+        if depth == 0 and value == ",":
+            items.append(current)
+            current = []
+        else:
+            current.append((kind, value))
+    return items + [current] if current else items
+
+
+def _order_column(item, columns):
+    """Map one ORDER BY item to (column index, descending), or None when it is not an output column."""
+    words = [value.upper() for _, value in item]
+    descending = False
+    if words and words[-1] in _DIRECTIONS:
+        descending = _DIRECTIONS[words[-1]]
+        item = item[:-1]
+    if any(value.upper() == "NULLS" for _, value in item):
+        # Explicit NULL placement may differ from the keyset's (NULL sorts as the largest value).
+        return None
+    if len(item) >= 3 and item[-2][1] == ".":
+        item = item[-1:]
+    if len(item) != 1:
+        return None
+    kind, value = item[0]
+    if kind == "number" and value.isdigit() and 1 <= int(value) <= len(columns):
+        return int(value) - 1, descending
+    if kind == "quoted":
+        name = value[1:-1].replace('""', '"')
+    elif kind == "word":
+        name = value.lower()
+    else:
+        return None
+    matches = [idx for idx, column in enumerate(columns) if column == name]
+    return (matches[0], descending) if len(matches) == 1 else None
+
+
+def page_cursor(sql, columns):
+    """The cursor for the first page of a query whose result has these column names.
+
+    Rows are ordered by the query's own ORDER BY items as far as they name
+    output columns (by name or position), then by every other column, then by
+    a counter that tells identical rows apart, so the order is total and pages
+    never repeat or skip a row.
+    """
+    keys = []
+    for item in _top_level_order_by(_significant(sql)):
+        key = _order_column(item, columns)
+        if key is None or any(key[0] == index for index, _ in keys):
+            break
+        keys.append(key)
+    ordered = {index for index, _ in keys}
+    keys += [(index, False) for index in range(len(columns)) if index not in ordered]
+    return {"columns": list(columns), "keys": keys, "after": None}
+
+
+def sql_literal(value):
+    """Render a key value as a SQL literal that PostgreSQL and DuckDB both parse."""
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, Decimal)):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value) if value == value and value not in (float("inf"), float("-inf")) \
+            else f"CAST('{value}' AS DOUBLE PRECISION)"
+    if isinstance(value, datetime):
+        kind = "TIMESTAMP WITH TIME ZONE" if value.tzinfo is not None else "TIMESTAMP"
+        return f"{kind} '{value.isoformat(sep=' ')}'"
+    if isinstance(value, date):
+        return f"DATE '{value.isoformat()}'"
+    if isinstance(value, time):
+        return f"TIME '{value.isoformat()}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _after(name, descending, value):
+    """Predicate for rows strictly after `value` on one key (NULL sorts as the largest value)."""
+    if value is None:
+        return f"{name} IS NOT NULL" if descending else None
+    literal = sql_literal(value)
+    return f"{name} < {literal}" if descending else f"({name} > {literal} OR {name} IS NULL)"
+
+
+def keyset_sql(sql, cursor, limit):
+    """Wrap a SELECT so the database returns at most `limit` rows after the cursor, in the cursor's order.
+
+    Columns are renamed positionally (page_c0, page_c1...) so duplicate or
+    unnamed output columns are still addressable; every row carries a trailing
+    page_dup counter that the caller drops.
+    """
+    names = [f"page_c{index}" for index in range(len(cursor["columns"]))]
+    keys = [(names[index], descending) for index, descending in cursor["keys"]] + [("page_dup", False)]
+    order = ", ".join(f"{name} {'DESC NULLS FIRST' if descending else 'ASC NULLS LAST'}" for name, descending in keys)
+    where = ""
+    if cursor["after"] is not None:
+        values = dict(zip(names + ["page_dup"], cursor["after"]))
+        terms = []
+        for position, (name, descending) in enumerate(keys):
+            after = _after(name, descending, values[name])
+            if after is None:
+                continue
+            equal = [
+                f"{key} IS NULL" if values[key] is None else f"{key} = {sql_literal(values[key])}"
+                for key, _ in keys[:position]
+            ]
+            terms.append("(" + " AND ".join(equal + [after]) + ")")
+        where = f" WHERE {' OR '.join(terms) or 'FALSE'}"
+    columns = ", ".join(names)
+    # The newline keeps a trailing -- comment in the query from swallowing the closing parenthesis.
+    return (
+        f"SELECT {columns}, page_dup FROM (SELECT page_source.*, ROW_NUMBER() OVER (PARTITION BY {columns}) AS page_dup "
+        f"FROM ({sql.strip().rstrip(';')}\n) AS page_source({columns})) AS page_rows{where} "
+        f"ORDER BY {order} LIMIT {int(limit)}"
+    )
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"t": value.isoformat()}
+    if isinstance(value, date):
+        return {"d": value.isoformat()}
+    if isinstance(value, time):
+        return {"h": value.isoformat()}
+    if isinstance(value, Decimal):
+        return {"n": str(value)}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def _decode_value(value):
+    if not isinstance(value, dict):
+        return value
+    (tag, text), = value.items()
+    return {"t": datetime.fromisoformat, "d": date.fromisoformat, "h": time.fromisoformat, "n": Decimal}[tag](text)
+
+
+def _signature(payload):
+    return hmac.new(PAGE_TOKEN_SECRET, payload, hashlib.sha256).hexdigest()[:32]
+
+
+def encode_page_token(sql, cursor):
+    """Encode a signed, opaque token carrying the query and the cursor of the next page."""
+    state = dict(cursor, after=[_encode_value(value) for value in cursor["after"]])
+    payload = base64.urlsafe_b64encode(json.dumps({"q": sql, "c": state}).encode("utf-8"))
+    return f"{payload.decode('ascii')}.{_signature(payload)}"
+
+
+def decode_page_token(token):
+    """Return (sql, cursor) from a page token, rejecting tokens that were not issued by this service."""
+    try:
+        payload, signature = token.encode("ascii").rsplit(b".", 1)
+    except (UnicodeEncodeError, ValueError):
+        raise ValueError("Malformed page token.")
+    if not hmac.compare_digest(signature.decode("ascii"), _signature(payload)):
+        raise ValueError("Page token is invalid or was issued by another server; restart from the first page.")
+    try:
+        state = json.loads(base64.urlsafe_b64decode(payload))
+        cursor = state["c"]
+        cursor["keys"] = [(int(index), bool(descending)) for index, descending in cursor["keys"]]
+        cursor["after"] = [_decode_value(value) for value in cursor["after"]]
+        return state["q"], cursor
+    except Exception:
+        raise ValueError("Malformed page token.")
@@ -0,0 +1,194 @@
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import pandas as pd
+from app.ingest import prepare_chunk
+
+logger = logging.getLogger(__name__)
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 2)))
+INGEST_CHUNK_BYTES = int(os.getenv("INGEST_CHUNK_BYTES", str(16 * 1024 * 1024)))
+# Workers never fork the (multi-threaded) server process: "forkserver" or "spawn".
+INGEST_START_METHOD = os.getenv("INGEST_START_METHOD", "forkserver")
+SCAN_BLOCK_BYTES = 1024 * 1024
+
+
+def read_header(file_path):
+    """Return (column names, byte offset where the data rows start)."""
+    with open(file_path, "rb") as file:
+        header_line = file.readline()
+        data_start = file.tell()
+    columns = pd.read_csv(io.BytesIO(header_line), nrows=0).columns.tolist()
+    return columns, data_start
+
+
+def split_csv_ranges(file_path, data_start, chunk_bytes=INGEST_CHUNK_BYTES):
+    """Split a CSV into (start, end) byte ranges that end at record boundaries.
+
+    A newline ends a record only outside a quoted field, i.e. after an even
+    number of quote characters (an escaped "" counts twice), so the file is
+    scanned once to track quote parity and ranges are cut at the first
+    newline past chunk_bytes where it is even. A file whose quotes do not
+    balance is not split at all.
+    """
+    size = os.path.getsize(file_path)
+    ranges = []
+    quoted = False
+    with open(file_path, "rb") as file:
+        file.seek(data_start)
+        start = position = data_start
+        while position < size:
+            block = file.read(SCAN_BLOCK_BYTES)
+            if not block:
+                break
+            offset = 0
+            while True:
+                target = start + chunk_bytes - position
+                if target >= len(block):
+                    quoted ^= block.count(b'"', offset) % 2 == 1
+                    break
+                if target > offset:
+                    quoted ^= block.count(b'"', offset, target) % 2 == 1
+                    offset = target
+                newline = block.find(b"\n", offset)
+                if newline == -1:
+                    quoted ^= block.count(b'"', offset) % 2 == 1
+                    break
+                quoted ^= block.count(b'"', offset, newline) % 2 == 1
+                offset = newline + 1
+                if not quoted:
+                    ranges.append((start, position + offset))
+                    start = position + offset
+            position += len(block)
+    if start < size:
+        ranges.append((start, size))
+    if quoted:
+        logger.warning("Unbalanced quotes in %s; parsing it as a single range.", file_path)
+        return [(data_start, size)] if size > data_start else []
+    return ranges
+
+
+def parse_csv_range(file_path, start, end, columns, schema=None):
+    """Parse and type-convert one byte range of a CSV (runs in a worker process)."""
+    with open(file_path, "rb") as file:
+        file.seek(start)
+        data = file.read(end - start)
+    if schema is None:
+        return prepare_chunk(pd.read_csv(io.BytesIO(data), header=None, names=columns))
+    chunk = pd.read_csv(io.BytesIO(data), header=None, names=columns, **schema.read_options(columns))
+    return schema.prepare(chunk)
+
+
+class ParallelCsvIngestor:
+    """Parse CSV byte ranges in a process pool and feed them to a single database writer."""
+
+    def __init__(self, ingestor, max_workers=INGEST_WORKERS, chunk_bytes=INGEST_CHUNK_BYTES,
+                 start_method=INGEST_START_METHOD):
+        self.ingestor = ingestor
+        self.max_workers = max_workers
+        self.chunk_bytes = chunk_bytes
+        self.start_method = start_method
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Create the shared worker pool (once); call it at application startup.
+
+        Workers come from a forkserver or spawn context, so they never inherit
+        the server's threads or open connections. Without an explicit start
+        the pool is created by the first upload.
+        """
+        with self._lock:
+            if self._executor is None:
+                context = multiprocessing.get_context(self.start_method)
+                if self.start_method == "forkserver":
+                    # Workers fork from a server that already imported pandas and the parser.
+                    context.set_forkserver_preload([__name__])
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+            return self._executor
+
+    def close(self):
+        """Shut the worker pool down; a later upload starts a new one."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    def ingest_files(self, file_paths, table_name, progress=None, if_exists="append", key_columns=None,
+                     schema=None):
+        """Load every file into one table and return load stats with per-file progress.
+
+        progress, when given, is called as progress(file_name, file_progress)
+        after every chunk is written. With key_columns the chunks are upserted
+        on that natural key instead of appended. A CsvSchema, when given, sets
+        the dtypes of every chunk in every worker and the table's column types.
+        """
+        files = {}
+        tasks = []
+        for file_path in file_paths:
+            columns, data_start = read_header(file_path)
+            ranges = split_csv_ranges(file_path, data_start, self.chunk_bytes)
+            name = os.path.basename(file_path)
+            files[name] = {
+                "chunks_total": len(ranges),
+                "chunks_done": 0,
+                "rows": 0,
+                "bytes_total": os.path.getsize(file_path),
+                "bytes_done": data_start,
+            }
+            tasks.extend((name, file_path, start, end, columns, schema) for start, end in ranges)
+
+        executor = self.start()
+        try:
+            chunks = self._parsed_chunks(executor, tasks, files, progress)
+            stats = self.ingestor.load(
+                chunks, table_name, if_exists=if_exists, key_columns=key_columns,
+                column_types=schema.sql_types() if schema is not None else None,
+            )
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory); replace the pool for the next upload.
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        stats["files"] = files
+        return stats
+
+    def _parsed_chunks(self, executor, tasks, files, progress):
+        """Yield parsed chunks as workers finish, keeping a bounded number in flight."""
+        pending = {}
+        queued = iter(tasks)
+        columns = None
+        max_in_flight = self.max_workers * 2
+        try:
+            while True:
+                for name, file_path, start, end, file_columns, schema in queued:
+                    future = executor.submit(parse_csv_range, file_path, start, end, file_columns, schema)
+                    pending[future] = (name, end - start)
+                    if len(pending) >= max_in_flight:
+                        break
+                if not pending:
+                    return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, size = pending.pop(future)
+                    chunk = future.result()
+                    # Every file writes through the first chunk's column order.
+                    if columns is None:
+                        columns = list(chunk.columns)
+                    yield chunk[columns]
+                    file_progress = files[name]
+                    file_progress["chunks_done"] += 1
+                    file_progress["rows"] += len(chunk)
+                    file_progress["bytes_done"] += size
+                    if progress:
+                        progress(name, dict(file_progress))
+        finally:
+            # The pool is shared: drop this upload's queued ranges when it stops early.
+            for future in pending:
+                future.cancel()
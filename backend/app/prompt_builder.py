@@ -0,0 +1,239 @@
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+PROMPT_FULL_SCHEMA_COLUMNS = int(os.getenv("PROMPT_FULL_SCHEMA_COLUMNS", "12"))
+PROMPT_FEW_SHOT_EXAMPLES = int(os.getenv("PROMPT_FEW_SHOT_EXAMPLES", "4"))
+
+_WORD = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+_STOP_WORDS = frozenset({
+    "a", "an", "and", "are", "at", "by", "data", "each", "for", "from", "how", "in", "is", "it",
+    "many", "me", "of", "on", "or", "show", "the", "their", "this", "to", "was", "were", "what", "which",
+    "who", "with",
+})
+_NUMERIC_HINTS = frozenset({
+    "amount", "count", "number", "percentage", "price", "quantity", "rate", "total", "value", "year",
+})
+
+
+def lexical_terms(text):
+    """Split text (including CamelCase/snake_case names) into lowercase, lightly stemmed terms."""
+    terms = set()
+    for word in _WORD.findall(text or ""):
+        word = word.lower()
+        if word in _STOP_WORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.add(word)
+    return terms
+
+
+def dataset_list(metadata):
+    """Return the datasets described by a metadata document (single dataset or {"datasets": [...]})."""
+    if "datasets" in metadata:
+        return list(metadata["datasets"])
+    return [metadata]
+
+
+def column_category(dataset, column):
+    """Classify a column as 'datetime', 'numeric' or 'string' for example selection."""
+    declared = dataset.get("column_types", {}).get(column)
+    if declared:
+        return declared
+    if column == dataset.get("time_filter_column"):
+        return "datetime"
+    if lexical_terms(f"{column} {dataset['columns'][column]}") & _NUMERIC_HINTS:
+        return "numeric"
+    return "string"
+
+
+def _token_counter():
+    try:
+        import tiktoken
+        encoding = tiktoken.encoding_for_model("gpt-4")
+        return lambda text: len(encoding.encode(text))
+    except Exception:
+        # Without tiktoken (or its encoding files) fall back to ~4 characters per token.
+        return lambda text: max(1, len(text) // 4)
+
+
+class PromptBuilder:
+    """Build SQL-generation prompts from dataset metadata.
+
+    Everything that does not depend on the question (instructions, purpose,
+    few-shot examples and, for narrow tables, the full column list) is compiled
+    once per dataset into a static prefix, so repeated requests share a
+    byte-identical prompt head that provider-side prompt caching can reuse.
+    Tables wider than PROMPT_FULL_SCHEMA_COLUMNS only list the columns that
+    lexically match the question, plus the time filter column.
+    """
+
+    def __init__(self, metadata, examples=None, full_schema_columns=PROMPT_FULL_SCHEMA_COLUMNS,
+                 few_shot_examples=PROMPT_FEW_SHOT_EXAMPLES):
+        self.datasets = {dataset["dataset_name"]: dataset for dataset in dataset_list(metadata)}
+        self.examples = examples or {}
+        self.full_schema_columns = full_schema_columns
+        self.few_shot_examples = few_shot_examples
+        self.count_tokens = _token_counter()
+        self._prefixes = {}
+        self._column_terms = {}
+        self._lock = threading.Lock()
+        self.prompts_built = 0
+        self.total_tokens = 0
+        self.total_prefix_tokens = 0
+
+    def update(self, metadata):
+        """Swap in new dataset metadata, keeping the compiled prefixes of unchanged datasets."""
+        datasets = {dataset["dataset_name"]: dataset for dataset in dataset_list(metadata)}
+        with self._lock:
+            for name in set(self.datasets) | set(datasets):
+                if self.datasets.get(name) != datasets.get(name):
+                    self._prefixes.pop(name, None)
+                    self._column_terms.pop(name, None)
+            self.datasets = datasets
+
+    @staticmethod
+    def load_examples(path):
+        """Read the question/SQL example templates from prompts.yaml; empty when unavailable."""
+        try:
+            import yaml
+            with open(path, "r") as file:
+                return (yaml.safe_load(file) or {}).get("examples", {})
+        except (ImportError, OSError) as e:
+            logger.warning("Few-shot examples not loaded from %s: %s", path, e)
+            return {}
+
+    def build(self, user_query, dataset_name=None):
+        """Return the prompt for a question with its selected columns and token counts."""
+        dataset = self._dataset(dataset_name)
+        name = dataset["dataset_name"]
+        prefix, prefix_tokens = self._prefix(name)
+        columns = self.relevant_columns(user_query, name)
+
+        tail = ""
+        if len(dataset["columns"]) > self.full_schema_columns:
+            tail += f"Relevant columns:\n{self._column_lines(dataset, columns)}\n\n"
+        tail += (
+            f"User query: {user_query}\n\n"
+            f"Generate only the SQL query required to execute this operation. Do not include explanatory text."
+        )
+        prompt = prefix + tail
+        tokens = prefix_tokens + self.count_tokens(tail)
+        with self._lock:
+            self.prompts_built += 1
+            self.total_tokens += tokens
+            self.total_prefix_tokens += prefix_tokens
+        return {
+            "prompt": prompt,
+            "dataset_name": name,
+            "columns": columns,
+            "tokens": tokens,
+            "prefix_tokens": prefix_tokens,
+        }
+
+    def relevant_columns(self, user_query, dataset_name=None):
+        """Columns whose name or description shares terms with the question, best matches first."""
+        dataset = self._dataset(dataset_name)
+        columns = list(dataset["columns"])
+        if len(columns) <= self.full_schema_columns:
+            return columns
+        query_terms = lexical_terms(user_query)
+        scored = []
+        for position, (column, (name_terms, description_terms)) in enumerate(
+            self._terms(dataset["dataset_name"]).items()
+        ):
+            score = 2 * len(query_terms & name_terms) + len(query_terms & description_terms)
+            if score:
+                scored.append((-score, position, column))
+        if not scored:
+            # Nothing matched: the question is too vague to prune, send everything.
+            return columns
+        selected = [column for _, _, column in sorted(scored)]
+        time_column = dataset.get("time_filter_column")
+        if time_column in dataset["columns"] and time_column not in selected:
+            selected.append(time_column)
+        return selected
+
+    def stats(self):
+        with self._lock:
+            built = self.prompts_built
+            return {
+                "datasets": len(self.datasets),
+                "prompts_built": built,
+                "avg_tokens": round(self.total_tokens / built, 1) if built else 0.0,
+                "avg_prefix_tokens": round(self.total_prefix_tokens / built, 1) if built else 0.0,
+            }
+
+    def _dataset(self, dataset_name):
+        if dataset_name is None:
+            return next(iter(self.datasets.values()))
+        try:
+            return self.datasets[dataset_name]
+        except KeyError:
+            raise ValueError(f"Unknown dataset '{dataset_name}'.")
+
+    def _terms(self, dataset_name):
+        terms = self._column_terms.get(dataset_name)
+        if terms is None:
+            dataset = self.datasets[dataset_name]
+            terms = {
+                column: (lexical_terms(column), lexical_terms(description))
+                for column, description in dataset["columns"].items()
+            }
+            self._column_terms[dataset_name] = terms
+        return terms
+
+    def _prefix(self, dataset_name):
+        cached = self._prefixes.get(dataset_name)
+        if cached is None:
+            prefix = self._compile_prefix(self.datasets[dataset_name])
+            cached = self._prefixes[dataset_name] = (prefix, self.count_tokens(prefix))
+        return cached
+
+    def _compile_prefix(self, dataset):
+        name = dataset["dataset_name"]
+        prefix = (
+            f"You are a helpful assistant tasked with analyzing and modifying data.\n"
+            f"Dataset: '{name}'\n"
+        )
+        if len(dataset["columns"]) <= self.full_schema_columns:
+            prefix += f"Columns:\n{self._column_lines(dataset, dataset['columns'])}\n"
+        prefix += (
+            f"Purpose: {dataset.get('purpose', '')}\n\n"
+            f"Important: You are restricted to using only the '{name}' table "
+            f"and its available columns for all operations.\n"
+            f"Important: When filtering by year, month, or day, use the '{dataset.get('time_filter_column', 'Date')}' column.\n"
+            f"Ensure string comparisons are case-insensitive and match exactly.\n\n"
+        )
+        examples = self._render_examples(dataset)
+        if examples:
+            prefix += f"Examples:\n{examples}\n\n"
+        return prefix
+
+    def _render_examples(self, dataset):
+        """Fill the example templates with the first column of each matching category."""
+        by_category = {}
+        for column in dataset["columns"]:
+            by_category.setdefault(column_category(dataset, column), column)
+        lines = []
+        for category, templates in self.examples.items():
+            column = by_category.get(category)
+            if column is None and category != "general":
+                continue
+            for template in templates:
+                if len(lines) >= self.few_shot_examples:
+                    return "\n".join(lines)
+                values = {"table": dataset["dataset_name"], "column": column}
+                lines.append(
+                    f"Q: {template['question'].format(**values)}\n"
+                    f"SQL: {template['sql'].format(**values)}"
+                )
+        return "\n".join(lines)
+
+    @staticmethod
+    def _column_lines(dataset, columns):
+        return "\n".join(f"- {column}: {dataset['columns'][column]}" for column in columns)
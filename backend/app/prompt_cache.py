@@ -0,0 +1,122 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+_FILLER_WORDS = frozenset({
+    "a", "an", "the", "is", "are", "was", "were", "be", "been", "have", "has",
+    "do", "does", "did", "what", "please", "me", "can", "could", "would", "you", "tell",
+    "i", "want", "know", "of", "for",
+})
+
+
+def normalize_prompt(prompt):
+    """Lowercase a prompt, drop punctuation and collapse whitespace."""
+    return " ".join(_WORD_PATTERN.findall(prompt.lower()))
+
+
+def prompt_shingles(normalized_prompt):
+    """Return the word unigrams and bigrams of a normalized prompt, ignoring filler words."""
+    words = [word for word in normalized_prompt.split() if word not in _FILLER_WORDS]
+    return frozenset(words) | frozenset(zip(words, words[1:]))
+
+
+def prompt_terms(normalized_prompt):
+    """Return the set of non-filler words of a normalized prompt."""
+    return frozenset(word for word in normalized_prompt.split() if word not in _FILLER_WORDS)
+
+
+class PromptCache:
+    """Two-tier prompt -> SQL cache with LRU and TTL eviction.
+
+    Tier one is an exact lookup on the normalized prompt. Tier two, enabled by
+    setting similarity_threshold, compares word shingles (Jaccard similarity)
+    against the cached prompts. Every non-filler word (numbers, names,
+    dimension values) must match exactly, so only phrasing and word order may
+    differ: "Toyota sales in 2022" never reuses the SQL generated for "Honda
+    sales in 2022" or "Toyota sales in 2023".
+    Entries are keyed by the dataset metadata hash.
+    """
+
+    def __init__(self, max_size=256, ttl_seconds=3600, similarity_threshold=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    def get(self, metadata_hash, prompt):
+        """Return the cached SQL for a prompt, or None on a miss."""
+        normalized = normalize_prompt(prompt)
+        key = (metadata_hash, normalized)
+        with self._lock:
+            self._evict_expired()
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]["sql"]
+            if self.similarity_threshold is not None:
+                match = self._find_similar(metadata_hash, normalized)
+                if match is not None:
+                    self._entries.move_to_end(match)
+                    self.similar_hits += 1
+                    return self._entries[match]["sql"]
+            self.misses += 1
+            return None
+
+    def put(self, metadata_hash, prompt, sql):
+        """Cache the SQL generated for a prompt."""
+        normalized = normalize_prompt(prompt)
+        key = (metadata_hash, normalized)
+        with self._lock:
+            self._entries[key] = {
+                "sql": sql,
+                "shingles": prompt_shingles(normalized),
+                "terms": prompt_terms(normalized),
+                "expires_at": time.monotonic() + self.ttl_seconds,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every cached entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return hit/miss counters and the current cache size."""
+        with self._lock:
+            lookups = self.hits + self.similar_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.similar_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+    def _find_similar(self, metadata_hash, normalized):
+        shingles = prompt_shingles(normalized)
+        terms = prompt_terms(normalized)
+        best_key, best_score = None, self.similarity_threshold
+        for key, entry in self._entries.items():
+            if key[0] != metadata_hash or entry["terms"] != terms:
+                continue
+            union = len(shingles | entry["shingles"])
+            score = len(shingles & entry["shingles"]) / union if union else 0.0
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = [key for key, entry in self._entries.items() if entry["expires_at"] <= now]
+        for key in expired:
+            del self._entries[key]
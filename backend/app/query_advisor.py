@@ -0,0 +1,555 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter, deque
+from sqlalchemy import text
+from app.result_cache import is_read_query, normalize_sql
+from app.sql_rewriter import _match_parens, tokenize
+
+logger = logging.getLogger(__name__)
+
+ADVISOR_AUTO_INDEX = os.getenv("ADVISOR_AUTO_INDEX", "true").lower() == "true"
+ADVISOR_AUTO_ROLLUPS = os.getenv("ADVISOR_AUTO_ROLLUPS", "false").lower() == "true"
+ROLLUP_MIN_REDUCTION = float(os.getenv("ROLLUP_MIN_REDUCTION", "10"))
+ROLLUP_MIN_QUERIES = int(os.getenv("ROLLUP_MIN_QUERIES", "3"))
+DIMENSION_MAX_DISTINCT = int(os.getenv("DIMENSION_MAX_DISTINCT", "500"))
+QUERY_LOG_SIZE = int(os.getenv("QUERY_LOG_SIZE", "1000"))
+
+_ROLLUP_AGGREGATES = frozenset({"COUNT", "SUM", "AVG", "MIN", "MAX"})
+# Shapes a monthly rollup cannot answer (or that this router does not attempt).
+_ROUTE_BLOCKERS = frozenset({"JOIN", "WITH", "UNION", "INTERSECT", "EXCEPT", "OVER", "DISTINCT", "BETWEEN"})
+_CLAUSES = frozenset({"SELECT", "FROM", "WHERE", "GROUP", "HAVING", "ORDER", "LIMIT", "OFFSET"})
+_TIME_PARTS = frozenset({"YEAR", "QUARTER", "MONTH"})
+_BOUND_END = frozenset({"AND", "OR", "GROUP", "HAVING", "ORDER", "LIMIT", "OFFSET"})
+# A month-aligned bound as the SQL rewriter emits it: '2023-05-01'[::date + interval '1 month'].
+_MONTH_BOUND = re.compile(
+    r"'\d{4}-\d{2}-01'(?:\s*::\s*date)?(?:\s*\+\s*interval\s*'\d+\s+(?:month|months|year|years)')?",
+    re.IGNORECASE,
+)
+_COARSE_TIME_FORMAT = re.compile(r"'(?:YYYY|MM|Q|Mon|Month|[/\- ])+'")
+_INTEGER_TYPES = frozenset({"smallint", "integer", "bigint"})
+_NUMERIC_TYPES = _INTEGER_TYPES | {"numeric", "real", "double precision"}
+_TABLE_PLACEHOLDER = "\x00rollup\x00"
+
+
+class QueryLog:
+    """Bounded log of executed queries plus counts of the rollup-shaped aggregates among them."""
+
+    def __init__(self, max_entries=QUERY_LOG_SIZE):
+        self.entries = deque(maxlen=max_entries)
+        self.shapes = Counter()
+        self.total = 0
+        self.routed = 0
+        self._lock = threading.Lock()
+
+    def record(self, sql, seconds, rows, routed_to=None, dimensions=None):
+        with self._lock:
+            self.total += 1
+            self.routed += routed_to is not None
+            if dimensions is not None:
+                self.shapes[dimensions] += 1
+            self.entries.append({
+                "sql": normalize_sql(sql),
+                "ms": round(seconds * 1000, 3),
+                "rows": rows,
+                "routed_to": routed_to,
+                "at": time.time(),
+            })
+
+    def stats(self):
+        with self._lock:
+            slowest = sorted(self.entries, key=lambda entry: entry["ms"], reverse=True)[:5]
+            return {
+                "queries": self.total,
+                "routed_to_rollups": self.routed,
+                "logged": len(self.entries),
+                "aggregate_shapes": {", ".join(sorted(dims)) or "(none)": count for dims, count in self.shapes.items()},
+                "slowest": slowest,
+            }
+
+
+class QueryAdvisor:
+    """Index and monthly-rollup advisor for one PostgreSQL dataset table.
+
+    After every ingest it indexes the time filter column and LOWER() of the
+    dimension columns (declared as dimension_columns in the metadata, else
+    text columns with few distinct values), re-ANALYZEs the table and
+    refreshes its rollups. Rollups are materialized views grouped by month
+    and a set of dimensions, carrying row counts and SUM/COUNT/MIN/MAX of
+    every numeric column. Aggregate queries whose filters and groups only
+    use month-aligned time ranges and rollup dimensions are routed to the
+    smallest fresh rollup that covers them. Candidate rollups come from the
+    metadata dimensions and the dimension sets seen in the query log; they
+    are created automatically only when ADVISOR_AUTO_ROLLUPS is enabled.
+    """
+
+    def __init__(self, engine, dataset_metadata, auto_index=ADVISOR_AUTO_INDEX, auto_rollups=ADVISOR_AUTO_ROLLUPS):
+        self.engine = engine
+        self.enabled = engine.dialect.name == "postgresql"
+        self.table_name = dataset_metadata["dataset_name"]
+        self.time_column = dataset_metadata.get("time_filter_column", "Date").lower()
+        self.declared_dimensions = [col.lower() for col in dataset_metadata.get("dimension_columns", [])]
+        self.auto_index = auto_index
+        self.auto_rollups = auto_rollups
+        self.query_log = QueryLog()
+        self.rollups = {}
+        self._schema = None
+        self._discovered = False
+        self._lock = threading.RLock()
+        self.quote = engine.dialect.identifier_preparer.quote
+
+    def after_ingest(self, table_name):
+        """Index, analyze and refresh rollups of the dataset table; returns what was done."""
+        if not self.enabled or table_name.lower() != self.table_name.lower():
+            return {}
+        with self._lock:
+            self._schema = None
+            report = {"indexes": self.ensure_indexes() if self.auto_index else []}
+            report["refreshed"] = self.refresh_rollups()
+            report["created"] = []
+            if self.auto_rollups:
+                for suggestion in self.suggestions():
+                    if suggestion["recommended"]:
+                        report["created"].append(self.create_rollup(suggestion["dimensions"]))
+        return report
+
+    def ensure_indexes(self):
+        """Create the time column and dimension indexes (if missing) and refresh planner statistics."""
+        schema = self._load_schema()
+        table = self.quote(self.table_name)
+        statements = {}
+        if self.time_column in schema:
+            statements[f"ix_{self.table_name}_{self.time_column}"] = f"({self.quote(self.time_column)})"
+        for column in self.dimensions():
+            # Generated SQL compares dimensions as LOWER(col) = LOWER('x').
+            statements[f"ix_{self.table_name}_{column}_lower"] = f"(LOWER({self.quote(column)}))"
+        with self.engine.begin() as connection:
+            for name, columns in statements.items():
+                connection.execute(text(f"CREATE INDEX IF NOT EXISTS {self.quote(name[:63])} ON {table} {columns}"))
+            connection.execute(text(f"ANALYZE {table}"))
+        return [name[:63] for name in statements]
+
+    def dimensions(self):
+        """Declared dimension columns, or text columns whose planner estimate of distinct values is small."""
+        schema = self._load_schema()
+        if self.declared_dimensions:
+            return [col for col in self.declared_dimensions if col in schema]
+        _, distinct = self._statistics()
+        return sorted(
+            column for column, count in distinct.items()
+            if schema.get(column) in ("text", "character varying", "character") and column != self.time_column
+            and 0 < count <= DIMENSION_MAX_DISTINCT
+        )
+
+    def measures(self):
+        """Numeric columns (other than dimensions) aggregated into every rollup, with their types."""
+        schema = self._load_schema()
+        dimensions = set(self.dimensions())
+        return {
+            column: data_type for column, data_type in schema.items()
+            if data_type in _NUMERIC_TYPES and column not in dimensions and column != self.time_column
+        }
+
+    def suggestions(self):
+        """Rollups worth creating: metadata dimensions and frequently queried dimension sets.
+
+        Row and group counts are planner estimates (pg_class.reltuples,
+        pg_stats.n_distinct and the time column's sampled range), so the
+        report never scans the table. Groups are estimated as if dimensions
+        were independent, which overstates them and errs towards not
+        recommending a rollup.
+        """
+        if not self.enabled:
+            return []
+        self._discover()
+        dimensions = self.dimensions()
+        candidates = Counter({tuple(dimensions): 0})
+        for shape, count in self.query_log.shapes.items():
+            candidates[tuple(sorted(shape))] += count
+        existing = {rollup["dimensions"] for rollup in self.rollups.values()}
+        table_rows, distinct = self._statistics()
+        months = self._month_span()
+        suggestions = []
+        for dims, queries in candidates.items():
+            if dims in existing or (queries < ROLLUP_MIN_QUERIES and dims != tuple(dimensions)):
+                continue
+            groups = months
+            for column in dims:
+                groups *= max(distinct.get(column, 1), 1)
+            groups = min(groups, table_rows)
+            reduction = table_rows / groups if groups else 0.0
+            suggestions.append({
+                "dimensions": dims,
+                "queries": queries,
+                "table_rows": table_rows,
+                "estimated_rows": groups,
+                "reduction": round(reduction, 1),
+                "recommended": reduction >= ROLLUP_MIN_REDUCTION,
+            })
+        return sorted(suggestions, key=lambda s: (-s["queries"], s["estimated_rows"]))
+
+    def create_rollup(self, dimensions):
+        """Create (or reuse) the monthly rollup for a set of dimensions and return its name."""
+        if not self.enabled:
+            raise ValueError("Rollups need a PostgreSQL database.")
+        dimensions = tuple(sorted(col.lower() for col in dimensions))
+        unknown = set(dimensions) - set(self.dimensions())
+        if unknown:
+            raise ValueError(f"Not dimension columns of {self.table_name}: {', '.join(sorted(unknown))}")
+        measures = self.measures()
+        name = self._rollup_name(dimensions)
+        q = self.quote
+        month = q(f"{self.time_column}_month")
+        select = [f"date_trunc('month', {q(self.time_column)})::date AS {month}"]
+        select += [q(col) for col in dimensions]
+        select.append('COUNT(*) AS "row_count"')
+        for column in measures:
+            for function in ("sum", "count", "min", "max"):
+                select.append(f"{function.upper()}({q(column)}) AS {q(f'{function}_{column}')}")
+        definition = {
+            "rollup_of": self.table_name,
+            "dimensions": list(dimensions),
+            "measures": measures,
+        }
+        with self._lock, self.engine.begin() as connection:
+            connection.execute(text(
+                f"CREATE MATERIALIZED VIEW IF NOT EXISTS {q(name)} AS SELECT {', '.join(select)} "
+                f"FROM {q(self.table_name)} GROUP BY {', '.join(str(i + 1) for i in range(len(dimensions) + 1))}"
+            ))
+            connection.execute(text(f"CREATE INDEX IF NOT EXISTS {q((name + '_month')[:63])} ON {q(name)} ({month})"))
+            connection.execute(text(f"COMMENT ON MATERIALIZED VIEW {q(name)} IS :definition").bindparams(
+                definition=json.dumps(definition)
+            ))
+            self.rollups[name] = {"dimensions": dimensions, "measures": measures, "fresh": True}
+        logger.info("Created rollup %s of %s by month, %s.", name, self.table_name, ", ".join(dimensions) or "no dimensions")
+        return name
+
+    def refresh_rollups(self):
+        """Recompute every rollup of the table; returns the refreshed names."""
+        self._discover()
+        refreshed = []
+        for name, rollup in self.rollups.items():
+            with self.engine.begin() as connection:
+                connection.execute(text(f"REFRESH MATERIALIZED VIEW {self.quote(name)}"))
+            rollup["fresh"] = True
+            refreshed.append(name)
+        return refreshed
+
+    def mark_stale(self, table_name):
+        """Stop routing to a table's rollups after a write outside the ingest path; returns their names."""
+        if table_name.lower() != self.table_name.lower():
+            return []
+        for rollup in self.rollups.values():
+            rollup["fresh"] = False
+        return list(self.rollups)
+
+    def loaded(self):
+        """True when route() will not touch the database (rollups discovered and the table schema read)."""
+        return not self.enabled or (self._discovered and self._schema is not None)
+
+    def route(self, sql):
+        """Return (sql to run, rollup name or None, dimension set or None) for a query."""
+        if not self.enabled or not is_read_query(sql):
+            return sql, None, None
+        try:
+            self._discover()
+            translated = self._translate(sql)
+        except Exception as e:
+            logger.warning("Rollup routing skipped: %s", e)
+            return sql, None, None
+        if translated is None:
+            return sql, None, None
+        dimensions, measures, template = translated
+        covering = [
+            (len(rollup["dimensions"]), name) for name, rollup in self.rollups.items()
+            if rollup["fresh"] and dimensions <= set(rollup["dimensions"]) and measures <= set(rollup["measures"])
+        ]
+        if not covering:
+            return sql, None, dimensions
+        name = min(covering)[1]
+        return template.replace(_TABLE_PLACEHOLDER, self.quote(name)), name, dimensions
+
+    def record(self, sql, seconds, rows, routed_to=None, dimensions=None):
+        self.query_log.record(sql, seconds, rows, routed_to, dimensions)
+
+    def report(self):
+        """Indexes, rollups, suggestions and query-log statistics for the dataset table."""
+        if not self.enabled:
+            return {"enabled": False}
+        self._discover()
+        with self.engine.connect() as connection:
+            indexes = connection.execute(
+                text("SELECT indexname, indexdef FROM pg_indexes WHERE tablename = :table AND schemaname = current_schema()"),
+                {"table": self.table_name},
+            ).all()
+        return {
+            "enabled": True,
+            "table_name": self.table_name,
+            "dimensions": self.dimensions(),
+            "indexes": {name: definition for name, definition in indexes},
+            "rollups": {
+                name: {"dimensions": list(rollup["dimensions"]), "fresh": rollup["fresh"]}
+                for name, rollup in self.rollups.items()
+            },
+            "suggestions": self.suggestions(),
+            "query_log": self.query_log.stats(),
+        }
+
+    def _translate(self, sql):
+        """Rewrite a rollup-shaped aggregate against a placeholder table; None when it is not one."""
+        schema = self._load_schema()
+        if not schema:
+            return None
+        tokens = tokenize(sql)
+        words = [value.upper() for kind, value in tokens if kind == "word"]
+        if (
+            not words or words[0] != "SELECT" or words.count("SELECT") != 1
+            or _ROUTE_BLOCKERS.intersection(words) or not _ROLLUP_AGGREGATES.intersection(words)
+        ):
+            return None
+        dimensions = set(self.dimensions())
+        measures = self.measures()
+        matches = _match_parens(tokens)
+        month = self.quote(f"{self.time_column}_month")
+        out, used_dimensions, used_measures = [], set(), set()
+        clause, previous, found_table = None, "", False
+        idx = 0
+        while idx < len(tokens):
+            kind, value = tokens[idx]
+            upper = value.upper()
+            if kind in ("space", "comment"):
+                out.append(value)
+                idx += 1
+                continue
+            if kind == "punct" and value in (".", ";"):
+                return None
+            if kind == "word" and upper in _CLAUSES:
+                clause = upper
+            elif clause == "FROM" and kind in ("word", "quoted"):
+                table = value[1:-1] if kind == "quoted" else value
+                if found_table or table.lower() != self.table_name.lower():
+                    return None
+                found_table = True
+                out.append(_TABLE_PLACEHOLDER)
+                previous = value
+                idx += 1
+                continue
+            following = self._next_significant(tokens, idx + 1)
+            if kind == "word" and following is not None and tokens[following][1] == "(" and following in matches:
+                close = matches[following]
+                inner = [token for token in tokens[following + 1:close] if token[0] not in ("space", "comment")]
+                expression = None
+                if upper in _ROLLUP_AGGREGATES:
+                    expression = self._rollup_aggregate(upper, inner, schema, dimensions, measures,
+                                                        used_dimensions, used_measures)
+                    if expression is None:
+                        return None
+                    if clause == "SELECT" and not self._aliased(tokens, close + 1):
+                        # Keep the column name PostgreSQL gives the original aggregate.
+                        expression += f' AS "{upper.lower()}"'
+                else:
+                    expression = self._time_function(upper, inner, schema, month)
+                if expression is not None:
+                    out.append(expression)
+                    previous = ")"
+                    idx = close + 1
+                    continue
+            column = self._column(kind, value, schema)
+            if column is not None and previous.upper() != "AS":
+                if column == self.time_column:
+                    end = self._month_aligned_bound(tokens, idx, matches)
+                    if end is None:
+                        return None
+                    # The bound itself (e.g. '2023-05-01'::date) is copied verbatim.
+                    out.append(month + "".join(value for _, value in tokens[idx + 1:end]))
+                    previous = tokens[end - 1][1]
+                    idx = end
+                    continue
+                elif column in dimensions:
+                    used_dimensions.add(column)
+                    out.append(value)
+                else:
+                    return None
+            else:
+                out.append(value)
+            previous = value
+            idx += 1
+        if not found_table:
+            return None
+        return frozenset(used_dimensions), frozenset(used_measures), "".join(out)
+
+    def _rollup_aggregate(self, function, inner, schema, dimensions, measures, used_dimensions, used_measures):
+        if function == "COUNT" and len(inner) == 1 and inner[0][1] == "*":
+            return 'COALESCE(SUM("row_count"), 0)::bigint'
+        if len(inner) != 1:
+            return None
+        column = self._column(inner[0][0], inner[0][1], schema)
+        if column in dimensions and function in ("MIN", "MAX"):
+            used_dimensions.add(column)
+            return f"{function}({self.quote(column)})"
+        if column not in measures:
+            return None
+        used_measures.add(column)
+        q = self.quote
+        integer = measures[column] in _INTEGER_TYPES
+        if function == "COUNT":
+            return f"COALESCE(SUM({q('count_' + column)}), 0)::bigint"
+        if function == "SUM":
+            # SUM of smallint/integer is bigint; SUM of the partial sums would be numeric.
+            cast = "::bigint" if measures[column] in ("smallint", "integer") else ""
+            return f"SUM({q('sum_' + column)}){cast}"
+        if function == "AVG":
+            cast = "::numeric" if integer else ""
+            return f"SUM({q('sum_' + column)}){cast} / NULLIF(SUM({q('count_' + column)}), 0)"
+        return f"{function}({q(function.lower() + '_' + column)})"
+
+    def _time_function(self, function, inner, schema, month):
+        """Month-or-coarser functions of the time column, rewritten onto the rollup's month column."""
+        if len(inner) != 3:
+            return None
+        if function == "EXTRACT" and inner[0][1].upper() in _TIME_PARTS and inner[1][1].upper() == "FROM" \
+                and self._column(*inner[2], schema) == self.time_column:
+            return f"EXTRACT({inner[0][1].upper()} FROM {month})"
+        if function == "DATE_TRUNC" and inner[0][0] == "string" and inner[1][1] == "," \
+                and inner[0][1].strip("'").lower() in ("month", "quarter", "year") \
+                and self._column(*inner[2], schema) == self.time_column:
+            return f"DATE_TRUNC({inner[0][1]}, {month})"
+        if function == "TO_CHAR" and inner[1][1] == "," and inner[2][0] == "string" \
+                and _COARSE_TIME_FORMAT.fullmatch(inner[2][1]) \
+                and self._column(*inner[0], schema) == self.time_column:
+            return f"TO_CHAR({month}, {inner[2][1]})"
+        return None
+
+    def _month_aligned_bound(self, tokens, idx, matches):
+        """End of a `time_column >= | < <first of month>` comparison starting at idx; None otherwise."""
+        operator = self._next_significant(tokens, idx + 1)
+        if operator is None or tokens[operator][1] not in (">=", "<"):
+            return None
+        parts, position = [], operator + 1
+        while position < len(tokens):
+            kind, value = tokens[position]
+            if value == ")" or (kind == "word" and value.upper() in _BOUND_END):
+                break
+            if value == "(" and position in matches:
+                parts.append("".join(v for _, v in tokens[position:matches[position] + 1]))
+                position = matches[position] + 1
+                continue
+            parts.append(value)
+            position += 1
+        if not _MONTH_BOUND.fullmatch("".join(parts).strip()):
+            return None
+        while position > operator + 1 and tokens[position - 1][0] in ("space", "comment"):
+            position -= 1
+        return position
+
+    @staticmethod
+    def _column(kind, value, schema):
+        if kind == "quoted":
+            name = value[1:-1].lower()
+        elif kind == "word":
+            name = value.lower()
+        else:
+            return None
+        return name if name in schema else None
+
+    @staticmethod
+    def _aliased(tokens, start):
+        following = QueryAdvisor._next_significant(tokens, start)
+        return following is not None and tokens[following][1].upper() == "AS"
+
+    @staticmethod
+    def _next_significant(tokens, start):
+        for idx in range(start, len(tokens)):
+            if tokens[idx][0] not in ("space", "comment"):
+                return idx
+        return None
+
+    def _rollup_name(self, dimensions):
+        name = f"{self.table_name}_monthly" + (f"_by_{'_'.join(dimensions)}" if dimensions else "")
+        if len(name) > 63:
+            digest = hashlib.sha1("|".join(dimensions).encode("utf-8")).hexdigest()[:8]
+            name = f"{self.table_name[:45]}_monthly_{digest}"
+        return name
+
+    def _load_schema(self):
+        if self._schema is None:
+            with self.engine.connect() as connection:
+                rows = connection.execute(
+                    text(
+                        "SELECT column_name, data_type FROM information_schema.columns "
+                        "WHERE table_name = :table AND table_schema = current_schema()"
+                    ),
+                    {"table": self.table_name},
+                ).all()
+            self._schema = {column: data_type for column, data_type in rows}
+        return self._schema
+
+    def _discover(self):
+        """Register rollups created by earlier processes; they stay unrouted until refreshed."""
+        if self._discovered:
+            return
+        with self._lock:
+            if self._discovered:
+                return
+            with self.engine.connect() as connection:
+                rows = connection.execute(text(
+                    "SELECT c.relname, obj_description(c.oid, 'pg_class') FROM pg_class c "
+                    "WHERE c.relkind = 'm' AND c.relnamespace = current_schema()::regnamespace"
+                )).all()
+            for name, comment in rows:
+                try:
+                    definition = json.loads(comment or "")
+                except ValueError:
+                    continue
+                if isinstance(definition, dict) and definition.get("rollup_of") == self.table_name:
+                    self.rollups.setdefault(name, {
+                        "dimensions": tuple(definition["dimensions"]),
+                        "measures": definition["measures"],
+                        "fresh": False,
+                    })
+            self._discovered = True
+
+    def _statistics(self):
+        """Planner estimates: (table rows, {column: distinct values}); analyzes a table that has none yet."""
+        query = text(
+            "SELECT c.reltuples, s.attname, s.n_distinct FROM pg_class c "
+            "LEFT JOIN pg_stats s ON s.tablename = c.relname AND s.schemaname = current_schema() "
+            "WHERE c.oid = to_regclass(:table)"
+        )
+        for attempt in range(2):
+            with self.engine.connect() as connection:
+                rows = connection.execute(query, {"table": self.quote(self.table_name)}).all()
+            # reltuples is -1 (or 0 with no column statistics) until the table is first analyzed.
+            if not rows or attempt or (rows[0][0] > 0 and rows[0][1] is not None):
+                break
+            with self.engine.begin() as connection:
+                connection.execute(text(f"ANALYZE {self.quote(self.table_name)}"))
+        table_rows = max(int(rows[0][0]), 0) if rows else 0
+        distinct = {}
+        for _, column, n_distinct in rows:
+            if column is not None:
+                # Negative n_distinct is a fraction of the row count.
+                distinct[column] = round(n_distinct if n_distinct >= 0 else -n_distinct * table_rows)
+        return table_rows, distinct
+
+    def _month_span(self):
+        """Estimated number of months the time column covers, from its sampled statistics."""
+        if not str(self._load_schema().get(self.time_column, "")).startswith(("date", "timestamp")):
+            return 1
+        with self.engine.connect() as connection:
+            first, last = connection.execute(
+                text(
+                    "SELECT min(v), max(v) FROM pg_stats s, unnest("
+                    "COALESCE(s.histogram_bounds::text::timestamp[], '{}') || "
+                    "COALESCE(s.most_common_vals::text::timestamp[], '{}')) AS v "
+                    "WHERE s.tablename = :table AND s.schemaname = current_schema() AND s.attname = :column"
+                ),
+                {"table": self.table_name, "column": self.time_column},
+            ).one()
+        if first is None:
+            return 1
+        return (last.year - first.year) * 12 + last.month - first.month + 1
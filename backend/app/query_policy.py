@@ -0,0 +1,257 @@
+import json
+import logging
+import os
+from sqlalchemy import text
+from app.metrics import QUERY_REJECTIONS
+from app.sql_rewriter import tokenize
+
+logger = logging.getLogger(__name__)
+
+QUERY_MAX_COST = float(os.getenv("QUERY_MAX_COST", "10000000"))
+QUERY_MAX_PLAN_ROWS = float(os.getenv("QUERY_MAX_PLAN_ROWS", "10000000"))
+QUERY_TIMEOUT_MS = int(os.getenv("QUERY_TIMEOUT_MS", "30000"))
+QUERY_MAX_ROWS = int(os.getenv("QUERY_MAX_ROWS", "100000"))
+QUERY_EXPORT_MAX_ROWS = int(os.getenv("QUERY_EXPORT_MAX_ROWS", "5000000"))
+QUERY_ALLOW_WRITES = os.getenv("QUERY_ALLOW_WRITES", "true").lower() == "true"
+QUERY_ALLOW_DDL = os.getenv("QUERY_ALLOW_DDL", "false").lower() == "true"
+
+_WRITE_KEYWORDS = frozenset({"INSERT", "UPDATE", "DELETE", "MERGE"})
+_DDL_KEYWORDS = frozenset({
+    "CREATE", "DROP", "ALTER", "TRUNCATE", "GRANT", "REVOKE", "COMMENT", "VACUUM", "REINDEX", "CLUSTER",
+})
+# Functions with side effects outside the statement's rows, refused even inside a SELECT.
+_UNSAFE_FUNCTIONS = frozenset({"pg_terminate_backend", "pg_cancel_backend", "setval", "nextval"})
+_UNSAFE_FUNCTION_PREFIXES = ("lo_", "pg_advisory_", "dblink")
+
+
+class QueryRejected(ValueError):
+    """A statement refused by the execution policy, with a machine-readable reason."""
+
+    def __init__(self, reason, message, **details):
+        super().__init__(message)
+        self.reason = reason
+        self.details = details
+
+    def to_dict(self):
+        return {"error": "query_rejected", "reason": self.reason, "message": str(self), **self.details}
+
+
+def _statement_words(tokens):
+    """Upper-cased words that start a statement, plus the main statement's top-level words.
+
+    Returns (leading, top_level): leading holds the first word of the
+    statement, of every CTE body and of the statement that follows a WITH
+    list (the only places PostgreSQL accepts a data-modifying statement);
+    top_level holds the words of the main statement outside parentheses.
+    Identifiers elsewhere (a column named comment, an alias cluster) are
+    never taken for statement keywords.
+    """
+    leading, top_level = [], []
+    depth = 0
+    previous = None
+    in_with = cte_body = False
+    for kind, value in tokens:
+        word = value.upper() if kind == "word" else None
+        if value == "(":
+            cte_body = in_with and depth == 0 and previous in ("AS", "MATERIALIZED")
+            depth += 1
+        elif value == ")":
+            depth -= 1
+        elif word is not None:
+            if previous is None:
+                leading.append(word)
+                in_with = word == "WITH"
+            elif cte_body and previous == "(":
+                leading.append(word)
+            elif in_with and depth == 0 and previous == ")" and word != "AS":
+                # The statement after the last CTE body.
+                leading.append(word)
+                in_with = False
+            if depth == 0 and not in_with:
+                top_level.append(word)
+        previous = word or value
+    return leading, top_level
+
+
+def unsafe_functions(tokens):
+    """Names of deny-listed functions (pg_terminate_backend, setval, lo_*, dblink*...) the tokens call."""
+    called = set()
+    for (kind, value), following in zip(tokens, tokens[1:]):
+        if following == ("punct", "(") and kind in ("word", "quoted"):
+            name = value.strip('"').lower()
+            if name in _UNSAFE_FUNCTIONS or name.startswith(_UNSAFE_FUNCTION_PREFIXES):
+                called.add(name)
+    return sorted(called)
+
+
+def classify_statement(sql):
+    """Classify SQL as 'read', 'write', 'ddl', 'unsafe', 'multiple' (several statements) or 'other'.
+
+    SELECT ... INTO creates a table and counts as DDL; SELECT ... FOR UPDATE /
+    FOR SHARE locks rows and counts as a write. A statement calling a
+    deny-listed function (see unsafe_functions) is 'unsafe' whatever it is.
+    """
+    tokens = [(kind, value) for kind, value in tokenize(sql) if kind not in ("space", "comment")]
+    while tokens and tokens[-1] == ("punct", ";"):
+        tokens.pop()
+    if ("punct", ";") in tokens:
+        return "multiple"
+    if unsafe_functions(tokens):
+        return "unsafe"
+    leading, top_level = _statement_words(tokens)
+    if not leading:
+        return "other"
+    if _DDL_KEYWORDS.intersection(leading):
+        return "ddl"
+    if _WRITE_KEYWORDS.intersection(leading):
+        return "write"
+    if leading[0] in ("SELECT", "WITH"):
+        if "INTO" in top_level:
+            return "ddl"
+        locking = any(
+            word == "FOR" and following in ("UPDATE", "SHARE", "NO", "KEY")
+            for word, following in zip(top_level, top_level[1:])
+        )
+        return "write" if locking else "read"
+    return "other"
+
+
+class QueryPolicy:
+    """Guardrails applied to generated SQL before and while it runs.
+
+    Statements are classified first: several statements, other commands,
+    calls to deny-listed functions and (unless QUERY_ALLOW_DDL) DDL are
+    refused, and so are writes when QUERY_ALLOW_WRITES is off. On PostgreSQL
+    the statement then runs under SET LOCAL statement_timeout =
+    QUERY_TIMEOUT_MS (and reads under SET LOCAL transaction_read_only = on,
+    so a function with side effects cannot write either) and is EXPLAINed
+    (without ANALYZE, so nothing executes) in the same transaction; plans whose total
+    cost or row estimate exceed QUERY_MAX_COST / QUERY_MAX_PLAN_ROWS are
+    rejected. Fetches are capped at QUERY_MAX_ROWS rows (QUERY_EXPORT_MAX_ROWS
+    for Arrow exports). Every refusal raises QueryRejected.
+    """
+
+    def __init__(self, engine, max_cost=QUERY_MAX_COST, max_plan_rows=QUERY_MAX_PLAN_ROWS,
+                 timeout_ms=QUERY_TIMEOUT_MS, max_rows=QUERY_MAX_ROWS, export_max_rows=QUERY_EXPORT_MAX_ROWS,
+                 allow_writes=QUERY_ALLOW_WRITES, allow_ddl=QUERY_ALLOW_DDL):
+        self.postgres = engine.dialect.name == "postgresql"
+        self.max_cost = max_cost
+        self.max_plan_rows = max_plan_rows
+        self.timeout_ms = timeout_ms
+        self.max_rows = max_rows
+        self.export_max_rows = export_max_rows
+        self.allow_writes = allow_writes
+        self.allow_ddl = allow_ddl
+
+    def classify(self, sql):
+        """Return the statement kind, rejecting kinds the policy does not run."""
+        kind = classify_statement(sql)
+        if kind == "multiple":
+            self._reject("multiple_statements", "Only a single SQL statement can be executed.", kind=kind)
+        if kind == "other":
+            self._reject("unsupported_statement", "Only SELECT and data-modifying statements can be executed.", kind=kind)
+        if kind == "unsafe":
+            functions = unsafe_functions([(k, v) for k, v in tokenize(sql) if k not in ("space", "comment")])
+            self._reject(
+                "unsafe_function", f"Calling {', '.join(functions)} is not allowed.", kind=kind, functions=functions,
+            )
+        if kind == "ddl" and not self.allow_ddl:
+            self._reject("ddl_not_allowed", "Schema changes (CREATE, DROP, ALTER, TRUNCATE...) are not allowed.", kind=kind)
+        if kind == "write" and not self.allow_writes:
+            self._reject("writes_not_allowed", "Data-modifying statements are not allowed.", kind=kind)
+        return kind
+
+    def limit_sql(self):
+        """The SET LOCAL statement bounding the current transaction's run time, or None."""
+        if self.postgres and self.timeout_ms:
+            return f"SET LOCAL statement_timeout = {int(self.timeout_ms)}"
+        return None
+
+    def read_only_sql(self, kind):
+        """The SET LOCAL statement making a read's transaction read-only, or None."""
+        if self.postgres and kind == "read":
+            return "SET LOCAL transaction_read_only = on"
+        return None
+
+    def check(self, connection, sql, read_only=True):
+        """Classify, apply the timeout and gate on the plan within the caller's transaction; returns the estimate.
+
+        Pass read_only=False when the transaction writes the result of the
+        read itself (CREATE TABLE ... AS).
+        """
+        kind = self.classify(sql)
+        for statement in (self.limit_sql(), self.read_only_sql(kind) if read_only else None):
+            if statement is not None:
+                connection.execute(text(statement))
+        if not self.postgres or kind == "ddl":
+            return {"kind": kind}
+        plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+        return self.gate(kind, plan)
+
+    async def acheck(self, connection, sql):
+        """Async variant of check for an AsyncConnection."""
+        kind = self.classify(sql)
+        for statement in (self.limit_sql(), self.read_only_sql(kind)):
+            if statement is not None:
+                await connection.execute(text(statement))
+        if not self.postgres or kind == "ddl":
+            return {"kind": kind}
+        plan = (await connection.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"))).scalar()
+        return self.gate(kind, plan)
+
+    def gate(self, kind, plan):
+        """Reject an EXPLAIN (FORMAT JSON) plan whose estimates exceed the limits."""
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        root = plan[0]["Plan"]
+        estimate = {"kind": kind, "cost": root["Total Cost"], "rows": root["Plan Rows"]}
+        if estimate["cost"] > self.max_cost:
+            self._reject(
+                "cost_limit", f"Estimated query cost {estimate['cost']:.0f} exceeds the limit of {self.max_cost:.0f}.",
+                estimated_cost=estimate["cost"], estimated_rows=estimate["rows"], max_cost=self.max_cost,
+            )
+        if estimate["rows"] > self.max_plan_rows:
+            self._reject(
+                "row_estimate_limit",
+                f"Query is estimated to return {estimate['rows']:.0f} rows, above the limit of {self.max_plan_rows:.0f}.",
+                estimated_cost=estimate["cost"], estimated_rows=estimate["rows"], max_plan_rows=self.max_plan_rows,
+            )
+        return estimate
+
+    def check_fetched(self, row_count, max_rows=None):
+        """Reject a result that has more rows than the cap (fetch one row past the cap to detect it)."""
+        max_rows = self.max_rows if max_rows is None else max_rows
+        if row_count > max_rows:
+            self._reject(
+                "row_limit",
+                f"Query returned more than {max_rows} rows; request it page by page or save it as a table instead.",
+                max_rows=max_rows,
+            )
+
+    def raise_if_timeout(self, error):
+        """Turn a statement cancelled by the policy's statement_timeout into a QueryRejected."""
+        original = getattr(error, "orig", error)
+        if getattr(original, "pgcode", None) == "57014" or getattr(original, "sqlstate", None) == "57014":
+            self.raise_timeout(error)
+
+    def raise_timeout(self, error):
+        """Raise the QueryRejected for a statement cancelled after the policy's timeout."""
+        QUERY_REJECTIONS.labels("timeout").inc()
+        raise QueryRejected(
+            "timeout", f"Query was cancelled after the {self.timeout_ms} ms statement timeout.",
+            timeout_ms=self.timeout_ms,
+        ) from error
+
+    def capped(self, batches):
+        """Pass Arrow record batches through, rejecting the export once it exceeds QUERY_EXPORT_MAX_ROWS."""
+        total = 0
+        for batch in batches:
+            total += batch.num_rows
+            self.check_fetched(total, self.export_max_rows)
+            yield batch
+
+    @staticmethod
+    def _reject(reason, message, **details):
+        QUERY_REJECTIONS.labels(reason).inc()
+        logger.warning("Query rejected (%s): %s", reason, message)
+        raise QueryRejected(reason, message, **details)
@@ -0,0 +1,147 @@
+import copy
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from app.query_policy import classify_statement
+from app.sql_rewriter import tokenize
+
+_TABLE_REFERENCE = re.compile(
+    r'\b(?:FROM|JOIN|INTO|UPDATE|TABLE)\s+((?:"[^"]+"|\w+)(?:\.(?:"[^"]+"|\w+))?)',
+    re.IGNORECASE,
+)
+
+
+def normalize_sql(sql):
+    """Collapse whitespace and comments, uppercase bare words and drop a trailing semicolon."""
+    parts = []
+    for kind, value in tokenize(sql):
+        if kind in ("space", "comment"):
+            if parts and parts[-1] != " ":
+                parts.append(" ")
+        elif kind == "word":
+            parts.append(value.upper())
+        else:
+            parts.append(value)
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def is_read_query(sql):
+    """True for a single SELECT (including WITH ... SELECT) that neither modifies data nor creates a table."""
+    return classify_statement(sql) == "read"
+
+
+def referenced_tables(sql):
+    """Return the lowercase, unqualified table names a statement reads or writes."""
+    tables = set()
+    for reference in _TABLE_REFERENCE.findall(sql):
+        tables.add(reference.split(".")[-1].strip('"').lower())
+    return frozenset(tables)
+
+
+class TableVersions:
+    """Per-table write counters; every write to a table bumps its version."""
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def bump(self, table_name):
+        with self._lock:
+            key = table_name.lower()
+            self._versions[key] = self._versions.get(key, 0) + 1
+            return self._versions[key]
+
+    def snapshot(self, tables):
+        with self._lock:
+            return tuple(sorted((table, self._versions.get(table, 0)) for table in tables))
+
+
+class ResultCache:
+    """Byte-bounded LRU cache of query results keyed on normalized SQL.
+
+    Each entry remembers the versions of the tables it read. A lookup whose
+    table versions changed since the entry was stored is treated as a miss, so
+    writes through store_data_in_sql/store_dataframe_in_sql invalidate it.
+    The TTL bounds staleness from writes made outside this service.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl_seconds=300, max_entry_fraction=0.25):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.max_entry_bytes = int(max_bytes * max_entry_fraction)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, sql, table_versions):
+        """Return the cached rows for a query, or None on a miss."""
+        key = normalize_sql(sql)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                fresh = entry["expires_at"] > time.monotonic()
+                if fresh and entry["versions"] == table_versions.snapshot(entry["tables"]):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return copy.copy(entry["result"])
+                self._remove(key)
+                self.invalidations += 1
+            self.misses += 1
+            return None
+
+    def put(self, sql, table_versions, result):
+        """Cache the rows returned by a read query."""
+        key = normalize_sql(sql)
+        size = self._estimate_size(result)
+        if size > self.max_entry_bytes:
+            return
+        tables = referenced_tables(key)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                "result": copy.copy(result),
+                "tables": tables,
+                "versions": table_versions.snapshot(tables),
+                "size": size,
+                "expires_at": time.monotonic() + self.ttl_seconds,
+            }
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry["size"]
+
+    @staticmethod
+    def _estimate_size(value):
+        size = sys.getsizeof(value)
+        if isinstance(value, dict):
+            size += sum(ResultCache._estimate_size(k) + ResultCache._estimate_size(v) for k, v in value.items())
+        elif isinstance(value, (list, tuple)):
+            size += sum(ResultCache._estimate_size(item) for item in value)
+        return size
@@ -0,0 +1,169 @@
+import logging
+import os
+import numpy as np
+import pandas as pd
+from sqlalchemy import BigInteger, Date, Float
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_SAMPLE_ROWS = int(os.getenv("SCHEMA_SAMPLE_ROWS", "50000"))
+CATEGORY_MAX_DISTINCT = int(os.getenv("CATEGORY_MAX_DISTINCT", "1000"))
+DATE_FORMATS = ("%m/%d/%Y", "%Y-%m-%d", "%Y/%m/%d", "%d/%m/%Y", "%m-%d-%Y", "%d.%m.%Y")
+STRING_DTYPE = "string[pyarrow]"
+
+
+def _integer_dtype(low, high):
+    """Smallest nullable integer dtype holding twice the sampled range (PostgreSQL has no 1-byte int)."""
+    for dtype in ("Int16", "Int32"):
+        info = np.iinfo(dtype.lower())
+        if info.min <= min(low * 2, 0) and max(high * 2, 0) <= info.max:
+            return dtype
+    return "Int64"
+
+
+def _exact_in_float32(values):
+    return bool(np.array_equal(values.astype("float32").astype("float64"), values))
+
+
+def _date_format(values, require_all=False):
+    """The candidate format that parses the most sampled values (all of them with require_all), or None."""
+    values = values.dropna().astype(str).head(1000)
+    best, best_parsed = None, 0
+    for fmt in DATE_FORMATS:
+        parsed = pd.to_datetime(values, format=fmt, errors="coerce").notna().sum()
+        if parsed > best_parsed:
+            best, best_parsed = fmt, parsed
+        if best_parsed == len(values):
+            break
+    if require_all and (values.empty or best_parsed < len(values)):
+        return None
+    return best
+
+
+def _widened_dtype(dtype, values):
+    """The inferred numeric dtype, or the narrowest wider one that holds every value of a chunk."""
+    present = values.dropna()
+    if present.empty:
+        return dtype
+    if dtype == "float32":
+        return dtype if _exact_in_float32(present.to_numpy("float64")) else "float64"
+    if pd.api.types.is_float_dtype(values) and not np.array_equal(present, present.round()):
+        return "float64"
+    for candidate in ("Int16", "Int32", "Int64")[("Int16", "Int32", "Int64").index(dtype):]:
+        info = np.iinfo(candidate.lower())
+        if info.min <= present.min() and present.max() <= info.max:
+            return candidate
+    return "float64"
+
+
+class CsvSchema:
+    """Column dtypes inferred once from a CSV sample and applied to every chunk of the load.
+
+    Numeric columns are parsed at full width and narrowed per chunk (pandas
+    silently wraps values that overflow a narrow dtype at parse time). A
+    chunk with values the sampled width cannot hold (a larger or fractional
+    number past the sample) keeps a wider dtype instead, and the table's
+    numeric columns are always BIGINT or DOUBLE PRECISION, so the narrow
+    widths only save memory while loading.
+    """
+
+    def __init__(self, dtypes, date_formats):
+        self.dtypes = dtypes
+        self.date_formats = date_formats
+
+    def read_options(self, columns=None):
+        """Keyword arguments for pd.read_csv, restricted to the columns present in a file."""
+        present = set(columns) if columns is not None else None
+        keep = lambda column: present is None or column in present
+        return {
+            # Numeric columns are parsed natively (nullable Int64 parsing is much slower) and narrowed in prepare().
+            "dtype": {
+                column: dtype for column, dtype in self.dtypes.items()
+                if keep(column) and dtype not in ("Int16", "Int32", "Int64", "float32")
+            },
+        }
+
+    def prepare(self, chunk):
+        """Narrow a parsed chunk to the inferred dtypes and lowercase its column names."""
+        for column, fmt in self.date_formats.items():
+            if column in chunk.columns:
+                # Cheaper than read_csv's parse_dates once dtypes are given; bad values become NULL.
+                chunk[column] = pd.to_datetime(chunk[column], format=fmt, errors="coerce")
+        for column, dtype in self.dtypes.items():
+            if column not in chunk.columns or chunk[column].dtype == dtype:
+                continue
+            values = chunk[column]
+            if dtype in ("Int16", "Int32", "Int64", "float32"):
+                if not pd.api.types.is_numeric_dtype(values):
+                    raise ValueError(f"Column '{column}' has non-numeric values past the sampled rows.")
+                widened = _widened_dtype(dtype, values)
+                if widened != dtype:
+                    logger.debug("Column %s widened from %s to %s for one chunk.", column, dtype, widened)
+                    dtype = widened
+            chunk[column] = values.astype(dtype)
+        chunk.columns = [col.lower() for col in chunk.columns]
+        return chunk
+
+    def sql_types(self):
+        """SQLAlchemy column types that the chunk dtypes alone would not produce.
+
+        Numeric columns get BIGINT and DOUBLE PRECISION whatever width the
+        sample suggested, so rows appended later cannot overflow them.
+        """
+        types = {column.lower(): Date() for column in self.date_formats}
+        for column, dtype in self.dtypes.items():
+            if dtype in ("Int16", "Int32", "Int64"):
+                types[column.lower()] = BigInteger()
+            elif dtype in ("float32", "float64"):
+                types[column.lower()] = Float(precision=53)
+        return types
+
+    def describe(self):
+        described = {column.lower(): dtype for column, dtype in self.dtypes.items()}
+        described.update({column.lower(): f"date ({fmt})" for column, fmt in self.date_formats.items()})
+        return described
+
+
+def infer_schema(file_path, category_columns=(), date_columns=("Date",), detect_dates=False,
+                 sample_rows=SCHEMA_SAMPLE_ROWS):
+    """Sample the head of a CSV and derive compact dtypes for every column.
+
+    Integers get the smallest nullable width, floats become float32 only when
+    every sampled value is exact in it, date_columns are parsed with the best
+    matching format, category_columns and low-cardinality strings become
+    categoricals and remaining strings are pyarrow-backed. With detect_dates,
+    any other text column whose sampled values all match one date format is
+    parsed as a date too.
+    """
+    sample = pd.read_csv(file_path, nrows=sample_rows, low_memory=False)
+    category_columns = {col.lower() for col in category_columns}
+    date_columns = {col.lower() for col in date_columns}
+    dtypes, date_formats = {}, {}
+    for column in sample.columns:
+        values = sample[column]
+        present = values.dropna()
+        declared_date = column.lower() in date_columns
+        if (declared_date or detect_dates) and pd.api.types.is_object_dtype(values):
+            fmt = _date_format(values, require_all=not declared_date)
+            if fmt is not None:
+                date_formats[column] = fmt
+                continue
+        if present.empty:
+            dtypes[column] = STRING_DTYPE
+        elif pd.api.types.is_bool_dtype(values):
+            dtypes[column] = "boolean"
+        elif pd.api.types.is_integer_dtype(values) or (
+            pd.api.types.is_float_dtype(values) and np.array_equal(present, present.round())
+        ):
+            dtypes[column] = _integer_dtype(int(present.min()), int(present.max()))
+        elif pd.api.types.is_float_dtype(values):
+            dtypes[column] = "float32" if _exact_in_float32(present.to_numpy("float64")) else "float64"
+        elif column.lower() in category_columns or (
+            present.nunique() <= min(CATEGORY_MAX_DISTINCT, len(present) // 2)
+        ):
+            dtypes[column] = "category"
+        else:
+            dtypes[column] = STRING_DTYPE
+    schema = CsvSchema(dtypes, date_formats)
+    logger.info("Inferred schema for %s from %s rows: %s", file_path, len(sample), schema.describe())
+    return schema
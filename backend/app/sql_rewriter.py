@@ -0,0 +1,328 @@
+import re
+
+
+_TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+    | (?P<string>'(?:[^']|'')*')
+    | (?P<quoted>"(?:[^"]|"")*")
+    | (?P<number>\d+(?:\.\d+)?)
+    | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+    | (?P<space>\s+)
+    | (?P<op>::|<=|>=|<>|!=|\|\|)
+    | (?P<punct>.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+# Words that may be followed by "(" without being a function call.
+_KEYWORDS = frozenset({
+    "ALL", "AND", "ANY", "AS", "BETWEEN", "BY", "CASE", "DISTINCT", "ELSE", "EXCEPT",
+    "EXISTS", "FILTER", "FROM", "GROUP", "HAVING", "ILIKE", "IN", "INTERSECT", "INTO",
+    "IS", "JOIN", "LATERAL", "LIKE", "LIMIT", "NOT", "OFFSET", "ON", "OR", "ORDER",
+    "OVER", "RETURNING", "SELECT", "SET", "SOME", "TABLE", "THEN", "UNION", "USING",
+    "VALUES", "WHEN", "WHERE", "WITH", "WITHIN",
+})
+# Keywords that start a clause; comparisons are only rewritten inside the filtering ones,
+# never in SET assignments, VALUES lists or the select list.
+_CLAUSE_KEYWORDS = frozenset({
+    "SELECT", "FROM", "JOIN", "WHERE", "HAVING", "ON", "GROUP", "ORDER", "LIMIT", "OFFSET", "WINDOW",
+    "UPDATE", "SET", "INSERT", "INTO", "VALUES", "DELETE", "USING", "RETURNING", "WHEN", "THEN", "ELSE",
+})
+_FILTER_CLAUSES = frozenset({"WHERE", "HAVING", "ON", "WHEN"})
+_AGGREGATES = ("COUNT(", "SUM(", "AVG(", "MIN(", "MAX(")
+_DATE_PARTS = frozenset({"YEAR", "MONTH", "DAY"})
+_MYSQL_DATE_FORMAT = {"%Y": "YYYY", "%y": "YY", "%m": "MM", "%d": "DD", "%H": "HH24", "%i": "MI", "%s": "SS"}
+_MYSQL_DATE_FORMAT_PATTERN = re.compile("|".join(re.escape(spec) for spec in _MYSQL_DATE_FORMAT))
+_YEAR_LIKE = re.compile(r"(\d{4})%")
+_MONTH_LIKE = re.compile(r"(\d{4})[/-](\d{2})%")
+_NUMERIC_LITERAL = re.compile(r"-?\d+(?:\.\d+)?")
+_SIMPLE_COLUMN = re.compile(r'(?:\w+\.)?("[^"]+"|\w+)')
+
+
+def tokenize(query):
+    """Split SQL into (kind, text) tokens in a single regex scan."""
+    return [(match.lastgroup, match.group()) for match in _TOKEN_PATTERN.finditer(query)]
+
+
+def _match_parens(tokens):
+    """Map every "(" token index to its closing ")" index."""
+    matches, stack = {}, []
+    for idx, (kind, value) in enumerate(tokens):
+        if kind == "punct" and value == "(":
+            stack.append(idx)
+        elif kind == "punct" and value == ")" and stack:
+            matches[stack.pop()] = idx
+    return matches
+
+
+class SQLRewriter:
+    """Rewrite LLM-generated SQL into PostgreSQL for one dataset.
+
+    Column-quoting and dialect rules are compiled once from the dataset
+    metadata. A query is tokenized once and rewritten in a single pass:
+    column names are quoted, DATE_FORMAT becomes TO_CHAR, YEAR/MONTH/DAY
+    become EXTRACT, date LIKE patterns become ranges and string equality
+    becomes case-insensitive. The MAX-with-columns shape is then restructured
+    into a ROW_NUMBER() CTE over the same rewritten tokens. Equality and LIKE
+    are only rewritten in WHERE, HAVING, ON and WHEN, so UPDATE ... SET
+    assignments keep their plain `column = value` form.
+    """
+
+    def __init__(self, dataset_metadata):
+        self.columns = frozenset(col.lower() for col in dataset_metadata["columns"])
+        self.time_column = f'"{dataset_metadata.get("time_filter_column", "Date").lower()}"'
+
+    def rewrite(self, query):
+        """Return the PostgreSQL form of a generated query."""
+        tokens = tokenize(self._strip_code_fence(query))
+        items = self._rewrite_range(tokens, _match_parens(tokens), 0, len(tokens))
+        while items and (items[-1].isspace() or items[-1] == ";"):
+            items.pop()
+        return "".join(self._rank_max_with_columns(items)).strip()
+
+    @staticmethod
+    def _strip_code_fence(query):
+        if "```" in query:
+            query = query.split("```")[1]
+            if query[:3].lower() == "sql":
+                query = query[3:]
+        return query.strip()
+
+    def _rewrite_range(self, tokens, matches, start, end, clause=None):
+        out = []
+        # Clauses enclosing the current parenthesis group or CASE expression.
+        enclosing = []
+        idx = start
+        while idx < end:
+            kind, value = tokens[idx]
+            if kind == "word":
+                upper = value.upper()
+                following = self._next_significant(tokens, idx + 1, end)
+                if (
+                    upper not in _KEYWORDS
+                    and following is not None
+                    and tokens[following][1] == "("
+                    and following in matches
+                ):
+                    close = matches[following]
+                    out.append(self._rewrite_call(value, upper, tokens, matches, following + 1, close, clause))
+                    idx = close + 1
+                    continue
+                if upper in _CLAUSE_KEYWORDS:
+                    clause = upper
+                elif upper == "CASE":
+                    enclosing.append(clause)
+                elif upper == "END" and enclosing:
+                    clause = enclosing.pop()
+                if (upper == "LIKE" or upper == "ILIKE") and clause in _FILTER_CLAUSES:
+                    idx = self._rewrite_comparison(out, value, tokens, idx, end)
+                    continue
+                if value.lower() in self.columns and self._is_column_reference(out, tokens, following):
+                    out.append(f'"{value.lower()}"')
+                else:
+                    out.append(value)
+            elif kind == "quoted" and value[1:-1].lower() in self.columns:
+                out.append(f'"{value[1:-1].lower()}"')
+            elif kind == "punct" and value == "=" and clause in _FILTER_CLAUSES:
+                idx = self._rewrite_comparison(out, value, tokens, idx, end)
+                continue
+            else:
+                if kind == "punct" and value == "(":
+                    enclosing.append(clause)
+                elif kind == "punct" and value == ")" and enclosing:
+                    clause = enclosing.pop()
+                out.append(value)
+            idx += 1
+        return out
+
+    def _rewrite_call(self, name, upper, tokens, matches, start, close, clause=None):
+        args = self._split_args(tokens, matches, start, close)
+        rendered = ["".join(self._rewrite_range(tokens, matches, s, e, clause)).strip() for s, e in args]
+        if upper == "DATE_FORMAT" and len(args) == 2 and rendered[1][:1] == "'":
+            pg_format = _MYSQL_DATE_FORMAT_PATTERN.sub(lambda m: _MYSQL_DATE_FORMAT[m.group()], rendered[1])
+            return f"TO_CHAR({rendered[0]}, {pg_format})"
+        if upper in _DATE_PARTS and len(args) == 1:
+            return f"EXTRACT({upper} FROM {rendered[0]})"
+        if upper == "LOWER" and len(args) == 1 and rendered[0].upper().startswith("LOWER(") \
+                and self._is_single_call(rendered[0]):
+            return rendered[0]
+        return f"{name}({', '.join(rendered) if len(args) > 1 else ''.join(rendered)})"
+
+    def _rewrite_comparison(self, out, operator, tokens, idx, end):
+        """Rewrite `<lhs> = 'x'` / `<lhs> LIKE 'x'`; returns the next token index."""
+        literal_idx = self._next_significant(tokens, idx + 1, end)
+        rhs_end = literal_idx
+        if literal_idx is not None and tokens[literal_idx][1].upper() == "LOWER":
+            # Accept an already lowered literal: LOWER('x').
+            window = [i for i in range(literal_idx + 1, end) if tokens[i][0] not in ("space", "comment")][:3]
+            if len(window) == 3 and [tokens[i][1] for i in (window[0], window[2])] == ["(", ")"]:
+                literal_idx, rhs_end = window[1], window[2]
+        lhs_start, lhs_end = self._operand_span(out)
+        if literal_idx is None or tokens[literal_idx][0] != "string" or lhs_start is None:
+            out.append(operator)
+            return idx + 1
+        lhs = "".join(out[lhs_start:lhs_end])
+        column = out[lhs_end - 1]
+        literal = tokens[literal_idx][1]
+        value = literal[1:-1].replace("''", "'")
+        replacement = None
+        if operator.upper() in ("LIKE", "ILIKE") and column == self.time_column:
+            year, month = _YEAR_LIKE.fullmatch(value), _MONTH_LIKE.fullmatch(value)
+            if year:
+                start = f"'{year.group(1)}-01-01'"
+                replacement = f"{lhs} >= {start} AND {lhs} < {start}::date + interval '1 year'"
+            elif month:
+                start = f"'{month.group(1)}-{month.group(2)}-01'"
+                replacement = f"{lhs} >= {start} AND {lhs} < {start}::date + interval '1 month'"
+            else:
+                replacement = f"TO_CHAR({lhs}, 'YYYY/MM/DD') {operator} {literal}"
+        elif operator == "=" and column != self.time_column:
+            if _NUMERIC_LITERAL.fullmatch(value):
+                if lhs.upper().startswith("LOWER(EXTRACT(") and self._is_single_call(lhs):
+                    replacement = f"{lhs[6:-1]} = {value}"
+                elif lhs.upper().startswith("EXTRACT("):
+                    replacement = f"{lhs} = {value}"
+            elif lhs.upper().startswith("LOWER("):
+                replacement = f"{lhs} = LOWER({literal})"
+            elif column[:1] == '"' and column[1:-1] in self.columns:
+                replacement = f"LOWER({lhs}) = LOWER({literal})"
+        if replacement is None:
+            out.append(operator)
+            return idx + 1
+        del out[lhs_start:]
+        out.append(replacement)
+        return rhs_end + 1
+
+    def _rank_max_with_columns(self, items):
+        """Turn `SELECT MAX(x), a, b FROM ... WHERE ...` (no GROUP BY) into a ROW_NUMBER() CTE."""
+        clauses = self._top_level_positions(items)
+        if "SELECT" not in clauses or "FROM" not in clauses or "GROUP" in clauses or "UNION" in clauses:
+            return items
+        select_items = items[clauses["SELECT"] + 1:clauses["FROM"]]
+        if any(item.upper() == "DISTINCT" for item in select_items):
+            return items
+        entries = self._split_select_list(select_items)
+        aggregates = [e for e in entries if e["expr"].upper().startswith(_AGGREGATES)]
+        if len(entries) < 2 or len(aggregates) != 1 or not aggregates[0]["expr"].upper().startswith("MAX("):
+            return items
+        max_entry = aggregates[0]
+        if not self._is_single_call(max_entry["expr"]):
+            return items
+        max_arg = max_entry["expr"][4:-1].strip()
+        simple = _SIMPLE_COLUMN.fullmatch(max_arg)
+        max_entry["name"] = max_entry["alias"] or (simple.group(1) if simple else '"max"')
+        inner, outer = [], []
+        for entry in entries:
+            if entry is max_entry:
+                inner.append(max_arg if max_entry["name"] == max_arg else f"{max_arg} AS {max_entry['name']}")
+            else:
+                simple = _SIMPLE_COLUMN.fullmatch(entry["expr"])
+                if not entry["alias"] and not simple:
+                    return items
+                inner.append(entry["text"])
+                entry["name"] = entry["alias"] or simple.group(1)
+            outer.append(entry["name"])
+        body_end = min([clauses[c] for c in ("ORDER", "LIMIT") if c in clauses] + [len(items)])
+        body = "".join(items[clauses["FROM"]:body_end]).strip()
+        limit = "".join(items[clauses["LIMIT"]:]).strip() if "LIMIT" in clauses else ""
+        rewritten = (
+            f"WITH ranked AS (SELECT {', '.join(inner)}, "
+            f"ROW_NUMBER() OVER (ORDER BY {max_arg} DESC) AS max_rank {body}) "
+            f"SELECT {', '.join(outer)} FROM ranked WHERE max_rank = 1"
+        )
+        return [f"{rewritten} {limit}".strip()]
+
+    @staticmethod
+    def _top_level_positions(items):
+        positions, depth = {}, 0
+        for idx, item in enumerate(items):
+            if item == "(":
+                depth += 1
+            elif item == ")":
+                depth -= 1
+            elif depth == 0:
+                upper = item.upper()
+                if upper in ("SELECT", "FROM", "GROUP", "ORDER", "LIMIT", "UNION", "WITH") and upper not in positions:
+                    positions[upper] = idx
+        if positions.get("WITH", len(items)) < positions.get("SELECT", 0):
+            return {}
+        return positions
+
+    @staticmethod
+    def _split_select_list(select_items):
+        entries, current, depth = [], [], 0
+        for item in select_items + [","]:
+            if item == "(":
+                depth += 1
+            elif item == ")":
+                depth -= 1
+            if item == "," and depth == 0:
+                significant = [part for part in current if not part.isspace()]
+                alias = None
+                if len(significant) >= 3 and significant[-2].upper() == "AS":
+                    alias, significant = significant[-1], significant[:-2]
+                entries.append({
+                    "text": "".join(current).strip(),
+                    "expr": "".join(significant),
+                    "alias": alias,
+                })
+                current = []
+            else:
+                current.append(item)
+        return entries
+
+    @staticmethod
+    def _split_args(tokens, matches, start, close):
+        args, arg_start, idx = [], start, start
+        while idx < close:
+            value = tokens[idx][1]
+            if tokens[idx][0] == "punct" and value == "(" and idx in matches:
+                idx = matches[idx]
+            elif tokens[idx][0] == "punct" and value == ",":
+                args.append((arg_start, idx))
+                arg_start = idx + 1
+            idx += 1
+        args.append((arg_start, close))
+        return [arg for arg in args if arg[0] < arg[1]] if len(args) == 1 else args
+
+    @staticmethod
+    def _next_significant(tokens, start, end):
+        for idx in range(start, end):
+            if tokens[idx][0] not in ("space", "comment"):
+                return idx
+        return None
+
+    @staticmethod
+    def _operand_span(out):
+        """Return the [start, end) slice of the operand at the end of `out`."""
+        end = len(out)
+        while end > 0 and out[end - 1].isspace():
+            end -= 1
+        if end == 0:
+            return None, None
+        start = end - 1
+        # Include a table qualifier such as car_sales_data."date".
+        while start >= 2 and out[start - 1] == ".":
+            start -= 2
+        return start, end
+
+    @staticmethod
+    def _is_column_reference(out, tokens, following):
+        previous = next((item for item in reversed(out) if not item.isspace()), "")
+        if previous in ("::",) or previous.upper() == "AS":
+            return False
+        return following is None or tokens[following][0] != "string"
+
+    @staticmethod
+    def _is_single_call(expression):
+        """True when the expression is one call, e.g. LOWER(x) and not LOWER(x) || LOWER(y)."""
+        depth = 0
+        for idx, char in enumerate(expression):
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+                if depth == 0:
+                    return idx == len(expression) - 1
+        return False
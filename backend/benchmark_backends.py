@@ -0,0 +1,147 @@
+import argparse
+import contextlib
+import io
+import json
+import math
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from app.analytics_backend import AnalyticsBackend
+from app.ingest import prepare_chunk
+from app.llm_service import LLMService
+from benchmark_prompts import METADATA_PATH, StubChatModel, generate_car_sales, stand_in_database, summarize
+from test_prompt import prompts as TEST_PROMPTS
+
+# Compare query latency on the PostgreSQL and DuckDB execution backends.
+#
+# Generates SQL for every test_prompt.py question with the deterministic stub
+# model from benchmark_prompts.py, then runs each query --repeat times on
+# PostgreSQL and on the DuckDB snapshot (ANALYTICS_BACKEND=duckdb), with the
+# result cache cleared before every run. The report records per-query p50/p95
+# for both backends, the snapshot refresh time, queries DuckDB handed back to
+# PostgreSQL, and results that differ between the two. Rows are compared
+# unordered with numbers rounded; ORDER BY ... LIMIT queries only compare
+# their columns and row count, since ties may legitimately pick other rows:
+#
+#   python benchmark_backends.py --rows 200000 --output backends.json
+
+BACKENDS = ("postgres", "duckdb")
+
+
+def comparable(rows):
+    """Rows as a sorted list of tuples with numbers rounded, independent of backend number types."""
+    def value(item):
+        if isinstance(item, (Decimal, float, int)) and not isinstance(item, bool):
+            number = float(item)
+            return round(number, 6 - int(math.floor(math.log10(abs(number))))) if number else 0.0
+        return str(item)
+    return sorted(tuple(value(item) for item in row.values()) for row in rows)
+
+
+def results_match(sql, expected, actual):
+    if re.search(r"\bORDER\s+BY\b.*\bLIMIT\b", sql, re.IGNORECASE | re.DOTALL):
+        return len(expected) == len(actual) and all(a.keys() == b.keys() for a, b in zip(expected, actual))
+    return comparable(expected) == comparable(actual)
+
+
+def time_query(llm_service, sql, repeat):
+    """Return (seconds per run, rows of the last run)."""
+    samples = []
+    for _ in range(repeat):
+        llm_service.result_cache.clear()
+        start = time.perf_counter()
+        rows = llm_service.execute_query(sql)
+        samples.append(time.perf_counter() - start)
+    return samples, rows
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix="backend-bench-")
+    db_url, server = (args.db_url, None) if args.db_url else stand_in_database(workdir)
+    try:
+        return run_suite(args, db_url)
+    finally:
+        if server is not None:
+            server.cleanup()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_suite(args, db_url):
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        llm_service = LLMService(api_key="offline-benchmark", db_url=db_url, metadata_path=METADATA_PATH)
+        table = llm_service.dataset_metadata["dataset_name"]
+        llm_service.llm = StubChatModel(table)
+        llm_service.ingestor.load([prepare_chunk(generate_car_sales(args.rows))], table, if_exists="replace")
+    llm_service.analytics = AnalyticsBackend(llm_service.engine, llm_service.table_versions, llm_service.policy,
+                                             backend="duckdb")
+    snapshot = llm_service.analytics.refresh(table)
+
+    samples = {backend: [] for backend in BACKENDS}
+    results = []
+    for question in TEST_PROMPTS:
+        item = {"prompt": question}
+        try:
+            with contextlib.redirect_stdout(log):
+                sql = llm_service.generate_sql_for_question(question)
+                item["sql"] = sql
+                rows = {}
+                for backend in BACKENDS:
+                    llm_service.analytics.enabled = backend == "duckdb"
+                    served = llm_service.analytics.served
+                    backend_samples, rows[backend] = time_query(llm_service, sql, args.repeat)
+                    samples[backend].extend(backend_samples)
+                    item[backend] = summarize(backend_samples)
+                    if backend == "duckdb":
+                        item["duckdb_served"] = llm_service.analytics.served > served
+            item["speedup"] = round(item["postgres"]["p50_ms"] / max(item["duckdb"]["p50_ms"], 1e-6), 2)
+            item["results_match"] = results_match(sql, rows["postgres"], rows["duckdb"])
+            item["error"] = None
+        except Exception as e:
+            item["error"] = str(e)
+        results.append(item)
+
+    summary = {backend: summarize(values) for backend, values in samples.items() if values}
+    report = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "database": llm_service.engine.dialect.name,
+            "rows": args.rows,
+            "repeat": args.repeat,
+            "snapshot_seconds": snapshot["seconds"],
+            "prompts": len(results),
+            "errors": sum(1 for item in results if item["error"]),
+            "fallbacks": sum(1 for item in results if not item["error"] and not item["duckdb_served"]),
+            "mismatches": [item["prompt"] for item in results if not item["error"] and not item["results_match"]],
+        },
+        "summary": summary,
+        "prompts": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2, default=str)
+
+    meta = report["meta"]
+    print(f"{meta['prompts']} queries x {args.repeat} runs, {args.rows} rows "
+          f"(snapshot {meta['snapshot_seconds']}s, {meta['fallbacks']} PostgreSQL fallbacks, {meta['errors']} errors)")
+    for backend, stats in summary.items():
+        print(f"  {backend:<9} p50={stats['p50_ms']:.3f}ms p95={stats['p95_ms']:.3f}ms mean={stats['mean_ms']:.3f}ms")
+    for prompt in meta["mismatches"]:
+        print(f"RESULTS DIFFER {prompt}")
+    print(f"Results saved to {args.output}")
+    llm_service.engine.dispose()
+    return 1 if meta["mismatches"] else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare test_prompt.py query latency on PostgreSQL and DuckDB.")
+    parser.add_argument("--db-url", help="SQLAlchemy URL of the PostgreSQL database (default: a temporary embedded one)")
+    parser.add_argument("--rows", type=int, default=200000, help="generated car sales rows")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per query and backend")
+    parser.add_argument("--output", default="benchmark_backends.json")
+    sys.exit(main(parser.parse_args()))
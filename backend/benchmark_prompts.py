@@ -0,0 +1,408 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta, timezone
+from types import SimpleNamespace
+import pandas as pd
+import yaml
+from app.ingest import prepare_chunk
+from app.llm_service import LLMService
+from app.prompt_builder import column_category
+from test_prompt import prompts as TEST_PROMPTS
+
+# Offline benchmark and regression suite for the prompt -> SQL -> rows path.
+#
+# Replays the prompts from test_prompt.py and the prompts.yaml categories
+# through a deterministic stub chat model against generated car sales data,
+# timing every stage (prompt build, generation, _clean_sql_query, execution,
+# serialization) and tracing its memory. Results are written as JSON; pass a
+# previous run as --baseline to flag latency regressions and changed results:
+#
+#   python benchmark_prompts.py --output bench.json
+#   python benchmark_prompts.py --output bench_new.json --baseline bench.json
+#
+# By default the data lives in a throwaway embedded PostgreSQL (the optional
+# `pgserver` package) so the rewritten, PostgreSQL-flavoured SQL runs as in
+# production. Without it the suite falls back to SQLite, where queries that
+# rely on PostgreSQL syntax are recorded as errors. --db-url points the suite
+# at any other database.
+
+METADATA_PATH = os.path.join(os.getcwd(), "Datasets", "dataset_metadata.json")
+EXAMPLES_PATH = os.path.join(os.getcwd(), "prompts.yaml")
+STAGES = ("prompt_build", "generation", "clean_sql", "execution", "serialization")
+
+SALESPEOPLE = [
+    "Lee Wilson", "Jason Jackson", "Stephanie Barber", "Christopher Cline", "Brenda Wilson", "Jessica Wong",
+    "April Clarke", "Heather Sutton", "Angela Mcclain", "Scott Gutierrez", "Wesley Snow", "Tina Zimmerman",
+]
+CUSTOMERS = ["David Smith", "David Lee", "Maria Garcia", "John Brown", "Linda Davis", "James Miller", "Susan Moore"]
+CARS = {
+    "Chevrolet": ["Silverado", "Malibu", "Equinox"],
+    "Ford": ["F-150", "Focus", "Explorer"],
+    "Honda": ["Civic", "Accord", "CR-V"],
+    "Nissan": ["Altima", "Sentra", "Rogue"],
+    "Toyota": ["Corolla", "Camry", "RAV4"],
+}
+MODEL_MAKES = {model: make for make, models in CARS.items() for model in models}
+MONTHS = {
+    name: number for number, name in enumerate(
+        ["january", "february", "march", "april", "may", "june", "july",
+         "august", "september", "october", "november", "december"], start=1)
+}
+
+
+def generate_car_sales(rows, seed=7):
+    """Generate car sales rows in the raw upload format (MM/DD/YYYY dates, CamelCase headers)."""
+    rng = random.Random(seed)
+    start = date(2015, 1, 1)
+    span = (date(2023, 12, 31) - start).days
+    records = []
+    for _ in range(rows):
+        make = rng.choice(list(CARS))
+        price = rng.randint(10000, 50000)
+        rate = round(rng.uniform(0.02, 0.15), 6)
+        records.append({
+            "Date": (start + timedelta(days=rng.randint(0, span))).strftime("%m/%d/%Y"),
+            "Salesperson": rng.choice(SALESPEOPLE),
+            "CustomerName": rng.choice(CUSTOMERS),
+            "CarMake": make,
+            "CarModel": rng.choice(CARS[make]),
+            "CarYear": rng.randint(2010, 2022),
+            "SalePrice": price,
+            "CommissionRate": rate,
+            "CommissionEarned": round(price * rate, 2),
+        })
+    return pd.DataFrame.from_records(records)
+
+
+def stub_sql(question, table):
+    """Deterministically map a question to the kind of SQL the LLM returns, fences included."""
+    q = question.lower()
+    if "commission rate" in q:
+        measure = "CommissionRate"
+    elif "commission" in q:
+        measure = "CommissionEarned"
+    else:
+        measure = "SalePrice"
+
+    filters = []
+    manufactured = re.search(r"manufactured in (\d{4})", q)
+    if manufactured:
+        filters.append(f"CarYear = {manufactured.group(1)}")
+        q = q.replace(manufactured.group(0), "manufactured")
+    years = re.findall(r"\b(20\d\d)\b", q)
+    month = next((number for name, number in MONTHS.items() if re.search(rf"\b{name}\b", q)), None)
+    if years and month:
+        filters.append(f"Date LIKE '{years[0]}/{month:02d}%'")
+    elif years:
+        filters.append(f"Date LIKE '{years[0]}%'")
+    for make in CARS:
+        if make.lower() in q:
+            filters.append(f"CarMake = '{make}'")
+    for model in MODEL_MAKES:
+        if re.search(rf"\b{re.escape(model.lower())}\b", q):
+            filters.append(f"CarModel = '{model}'")
+    for person in SALESPEOPLE:
+        if person.lower() in q:
+            filters.append(f"Salesperson = '{person}'")
+    threshold = re.search(r"greater than ([\d,]+)", q)
+    if threshold:
+        filters.append(f"{measure} > {threshold.group(1).replace(',', '')}")
+    named = re.search(r"named '(\w+)'", question)
+    if named:
+        filters.append(f"CustomerName LIKE '{named.group(1)}%'")
+    where = f" WHERE {' AND '.join(filters)}" if filters else ""
+
+    if "how many" in q or "number of" in q or "count" in q:
+        aggregate = "COUNT(DISTINCT CustomerName)" if "unique" in q else "COUNT(*)"
+    elif "average" in q:
+        aggregate = f"AVG({measure})"
+    elif "total" in q or "sum" in q or "revenue" in q:
+        aggregate = f"SUM({measure})"
+    elif "highest" in q or "maximum" in q:
+        aggregate = f"MAX({measure})"
+    elif "lowest" in q or "least" in q or "minimum" in q:
+        aggregate = f"MIN({measure})"
+    else:
+        aggregate = None
+
+    group = None
+    if "salesperson" in q and ("which" in q or "each" in q):
+        group = "Salesperson"
+    elif "car model" in q and "which" in q or "popular car model" in q:
+        group = "CarModel"
+    elif "car make" in q and ("which" in q or "popular" in q):
+        group = "CarMake"
+
+    if aggregate is None and not group:
+        sql = f"SELECT * FROM {table}{where} ORDER BY Date LIMIT 100"
+    elif group:
+        aggregate = aggregate or "COUNT(*)"
+        order = "ASC" if "least" in q or "lowest" in q else "DESC"
+        limit = "" if "each" in q else " LIMIT 1"
+        sql = f"SELECT {group}, {aggregate} AS value FROM {table}{where} GROUP BY {group} ORDER BY value {order}{limit}"
+    elif aggregate.startswith("MAX") and "car" in q:
+        # Aggregate alongside plain columns: exercises the MAX -> ROW_NUMBER rewrite.
+        sql = f"SELECT {aggregate}, Salesperson, CarModel FROM {table}{where}"
+    else:
+        sql = f"SELECT {aggregate} FROM {table}{where}"
+    return f"```sql\n{sql};\n```"
+
+
+class StubChatModel:
+    """Deterministic stand-in for ChatOpenAI that answers from the 'User query:' line."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def invoke(self, prompt):
+        question = prompt.split("User query:", 1)[-1].split("\n", 1)[0].strip()
+        return SimpleNamespace(content=stub_sql(question, self.table))
+
+    async def ainvoke(self, prompt):
+        return self.invoke(prompt)
+
+
+def yaml_category_prompts(path, dataset):
+    """Render every prompts.yaml category template against the dataset's columns."""
+    with open(path, "r") as file:
+        templates = (yaml.safe_load(file) or {}).get("prompts", {})
+    by_category = {}
+    for column in dataset["columns"]:
+        by_category.setdefault(column_category(dataset, column), []).append(column)
+    columns = list(dataset["columns"])
+    rendered = []
+    for category, questions in templates.items():
+        candidates = by_category.get(category, columns)
+        for index, template in enumerate(questions):
+            column = candidates[index % len(candidates)]
+            rendered.append((f"yaml:{category}", template.format(
+                column=column, column1=columns[1], column2=columns[3]
+            )))
+    return rendered
+
+
+def result_digest(rows):
+    return hashlib.sha256(json.dumps(rows, default=str, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def run_prompt(llm_service, question):
+    """Run one question through every stage; returns (timings in seconds, sql, rows, payload)."""
+    timings = {}
+    start = time.perf_counter()
+    prompt = llm_service.generate_dynamic_prompt(question)
+    timings["prompt_build"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    raw_query = llm_service.llm.invoke(prompt).content.strip()
+    timings["generation"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sql = llm_service._clean_sql_query(raw_query)
+    timings["clean_sql"] = time.perf_counter() - start
+
+    # Measure the database, not the result cache.
+    llm_service.result_cache.clear()
+    start = time.perf_counter()
+    rows = llm_service.execute_query(sql)
+    timings["execution"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    payload = json.dumps({"generated_sql": sql, "results": rows}, default=str)
+    timings["serialization"] = time.perf_counter() - start
+    return timings, sql, rows, payload
+
+
+def trace_memory(llm_service, question):
+    """Peak traced allocation per stage, in KiB, for one run of a question."""
+    peaks = {}
+    wrapped = {
+        "prompt_build": (llm_service, "generate_dynamic_prompt"),
+        "generation": (llm_service.llm, "invoke"),
+        "clean_sql": (llm_service, "_clean_sql_query"),
+        "execution": (llm_service, "execute_query"),
+    }
+
+    def traced(stage, func):
+        def wrapper(*args, **kwargs):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            try:
+                return func(*args, **kwargs)
+            finally:
+                peaks[stage] = (tracemalloc.get_traced_memory()[1] - baseline) / 1024
+        return wrapper
+
+    tracemalloc.start()
+    try:
+        for stage, (owner, name) in wrapped.items():
+            setattr(owner, name, traced(stage, getattr(owner, name)))
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        run_prompt(llm_service, question)
+        # serialization is the only stage not wrapped; the whole-run peak bounds it.
+        peaks["serialization"] = (tracemalloc.get_traced_memory()[1] - baseline) / 1024
+    finally:
+        for owner, name in wrapped.values():
+            # Drop the instance attribute so the class method is visible again.
+            vars(owner).pop(name, None)
+        tracemalloc.stop()
+    return {stage: round(peaks.get(stage, 0.0), 1) for stage in STAGES}
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        "p50_ms": round(statistics.median(ordered) * 1000, 4),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 4),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 4),
+    }
+
+
+def compare(report, baseline, threshold):
+    """Return regressions: stage p50 slower than threshold x baseline, or changed results."""
+    regressions = []
+    for stage, current in report["summary"].items():
+        previous = baseline.get("summary", {}).get(stage)
+        if previous and previous["p50_ms"] and current["p50_ms"] > previous["p50_ms"] * threshold:
+            regressions.append(
+                f"{stage}: p50 {previous['p50_ms']}ms -> {current['p50_ms']}ms "
+                f"({current['p50_ms'] / previous['p50_ms']:.2f}x)"
+            )
+    previous_results = {item["prompt"]: item for item in baseline.get("prompts", [])}
+    for item in report["prompts"]:
+        previous = previous_results.get(item["prompt"])
+        if previous and (previous.get("result_hash"), previous.get("error")) != (item.get("result_hash"), item.get("error")):
+            regressions.append(f"results changed: {item['prompt']}")
+    return regressions
+
+
+def stand_in_database(workdir):
+    """Return (database URL, server handle) for a temporary embedded PostgreSQL, else SQLite."""
+    try:
+        import pgserver
+    except ImportError:
+        print("pgserver is not installed; benchmarking against SQLite (PostgreSQL-only SQL will fail).")
+        return f"sqlite:///{os.path.join(workdir, 'bench.db')}", None
+    server = pgserver.get_server(os.path.join(workdir, "pgdata"), cleanup_mode="stop")
+    return server.get_uri(), server
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix="llm-bench-")
+    db_url, server = (args.db_url, None) if args.db_url else stand_in_database(workdir)
+    try:
+        return run_suite(args, db_url)
+    finally:
+        if server is not None:
+            server.cleanup()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_suite(args, db_url):
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        llm_service = LLMService(api_key="offline-benchmark", db_url=db_url, metadata_path=METADATA_PATH)
+        dataset = llm_service.dataset_metadata
+        table = dataset["dataset_name"]
+        llm_service.llm = StubChatModel(table)
+        load_start = time.perf_counter()
+        llm_service.ingestor.load([prepare_chunk(generate_car_sales(args.rows))], table, if_exists="replace")
+        load_seconds = time.perf_counter() - load_start
+
+    questions = [("test_prompt", prompt) for prompt in TEST_PROMPTS]
+    questions += yaml_category_prompts(EXAMPLES_PATH, dataset)
+
+    samples = {stage: [] for stage in STAGES}
+    memory = {stage: [] for stage in STAGES}
+    results = []
+    for source, question in questions:
+        item = {"source": source, "prompt": question}
+        stage_samples = {stage: [] for stage in STAGES}
+        try:
+            with contextlib.redirect_stdout(log):
+                for _ in range(args.repeat):
+                    timings, sql, rows, payload = run_prompt(llm_service, question)
+                    for stage, seconds in timings.items():
+                        stage_samples[stage].append(seconds)
+                item["memory_kib"] = trace_memory(llm_service, question) if args.memory else None
+            item.update({
+                "sql": sql,
+                "rows": len(rows) if isinstance(rows, list) else None,
+                "result_hash": result_digest(rows),
+                "payload_bytes": len(payload),
+                "error": None,
+            })
+        except Exception as e:
+            item.update({"sql": None, "rows": None, "result_hash": None, "error": str(e)})
+        item["stages"] = {stage: summarize(values) for stage, values in stage_samples.items() if values}
+        for stage, values in stage_samples.items():
+            samples[stage].extend(values)
+        for stage, kib in (item.get("memory_kib") or {}).items():
+            memory[stage].append(kib)
+        results.append(item)
+
+    summary = {}
+    for stage in STAGES:
+        if samples[stage]:
+            summary[stage] = summarize(samples[stage])
+            if memory[stage]:
+                summary[stage]["peak_kib_max"] = max(memory[stage])
+    report = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "database": llm_service.engine.dialect.name,
+            "rows": args.rows,
+            "repeat": args.repeat,
+            "load_seconds": round(load_seconds, 4),
+            "prompts": len(results),
+            "errors": sum(1 for item in results if item["error"]),
+        },
+        "summary": summary,
+        "prompts": results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            regressions = compare(report, json.load(file), args.threshold)
+        report["regressions"] = regressions
+
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2, default=str)
+
+    print(f"{len(results)} prompts x {args.repeat} runs on {report['meta']['database']} "
+          f"({args.rows} rows, {report['meta']['errors']} errors)")
+    for stage, stats in summary.items():
+        print(f"  {stage:<14} p50={stats['p50_ms']:.3f}ms p95={stats['p95_ms']:.3f}ms"
+              + (f" peak={stats['peak_kib_max']:.1f}KiB" if "peak_kib_max" in stats else ""))
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"Results saved to {args.output}")
+    llm_service.engine.dispose()
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline prompt -> SQL benchmark with a stub LLM.")
+    parser.add_argument("--db-url", help="SQLAlchemy URL to benchmark against (default: a temporary SQLite file)")
+    parser.add_argument("--rows", type=int, default=20000, help="generated car sales rows")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per prompt")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip the tracemalloc pass")
+    parser.add_argument("--output", default="benchmark_prompts.json")
+    parser.add_argument("--baseline", help="previous JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="p50 slowdown ratio that counts as a regression")
+    sys.exit(main(parser.parse_args()))
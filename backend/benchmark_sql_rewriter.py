@@ -0,0 +1,165 @@
+import json
+import os
+import re
+import timeit
+from app.sql_rewriter import SQLRewriter
+
+# Micro-benchmark: per-query latency of SQLRewriter against the previous
+# regex chain from LLMService._clean_sql_query, on the real metadata and on a
+# wide variant of it. The rewrites in `expected` are checked before timing.
+
+METADATA_PATH = os.path.join(os.getcwd(), "Datasets", "dataset_metadata.json")
+REPEAT = 2000
+
+queries = [
+    "```sql\nSELECT COUNT(*) FROM car_sales_data WHERE Date LIKE '2023/05%';\n```",
+    "SELECT SUM(SalePrice) FROM car_sales_data WHERE Salesperson = 'Lee Wilson';",
+    "SELECT COUNT(*) FROM car_sales_data WHERE CarMake = 'Chevrolet' AND YEAR(Date) = 2022;",
+    "SELECT AVG(CommissionEarned) FROM car_sales_data WHERE Date LIKE '2023%';",
+    "SELECT MAX(CommissionEarned), Salesperson, CustomerName FROM car_sales_data WHERE YEAR(Date) = 2023;",
+    "SELECT Salesperson, COUNT(*) FROM car_sales_data WHERE YEAR(Date) = 2023 GROUP BY Salesperson;",
+    "SELECT DATE_FORMAT(Date, '%Y/%m') AS month, SUM(SalePrice) FROM car_sales_data GROUP BY month;",
+    "UPDATE car_sales_data SET CarMake = 'Toyota' WHERE CarModel = 'Camry';",
+]
+
+expected = {
+    "SELECT SUM(SalePrice) FROM car_sales_data WHERE Salesperson = 'Lee Wilson';":
+        "SELECT SUM(\"saleprice\") FROM car_sales_data WHERE LOWER(\"salesperson\") = LOWER('Lee Wilson')",
+    # SET assignments are not comparisons; only the WHERE clause is made case-insensitive.
+    "UPDATE car_sales_data SET CarMake = 'Toyota' WHERE CarModel = 'Camry';":
+        "UPDATE car_sales_data SET \"carmake\" = 'Toyota' WHERE LOWER(\"carmodel\") = LOWER('Camry')",
+    "INSERT INTO car_sales_data (CarMake, CarModel) VALUES ('Ford', 'Focus');":
+        "INSERT INTO car_sales_data(\"carmake\", \"carmodel\") VALUES ('Ford', 'Focus')",
+}
+
+
+def legacy_clean_sql_query(query, dataset_metadata):
+    # Remove SQL code block delimiters (```sql ... ```)
+    if "```sql" in query:
+        query = query.split("```sql")[-1].split("```")[0].strip()
+
+    # Quote all column names to preserve case sensitivity
+    column_names = [col.lower() for col in dataset_metadata["columns"].keys()]
+    for column in column_names:
+        query = re.sub(
+            rf"(?<!\")\b{column}\b(?!\")",
+            f'"{column}"',
+            query,
+            flags=re.IGNORECASE
+        )
+
+    # Replace MySQL DATE_FORMAT with PostgreSQL TO_CHAR
+    query = re.sub(
+        r"DATE_FORMAT\((.+?),\s*'%Y/%m'\)",
+        r"TO_CHAR(\1, 'YYYY/MM')",
+        query,
+        flags=re.IGNORECASE
+    )
+
+    # Define time_filter_column
+    time_filter_column = dataset_metadata.get("time_filter_column", "Date").lower()
+
+    # Replace LIKE patterns for dates with range comparisons
+    query = re.sub(
+        rf"\"{time_filter_column}\" LIKE '(\d{{4}})%%'",
+        rf"\"{time_filter_column}\" >= '\1-01-01' AND \"{time_filter_column}\" < '\1-01-01'::date + interval '1 year'",
+        query,
+        flags=re.IGNORECASE,
+    )
+    query = re.sub(
+        rf"\"{time_filter_column}\" LIKE '(\d{{4}})/(\d{{2}})%%'",
+        rf"\"{time_filter_column}\" >= '\1-\2-01' AND \"{time_filter_column}\" < '\1-\2-01'::date + interval '1 month'",
+        query,
+        flags=re.IGNORECASE,
+    )
+    # Catch-all for unhandled LIKE with date columns
+    query = re.sub(
+        rf"\"{time_filter_column}\" LIKE '(.+?)%'",
+        lambda match: f"TO_CHAR(\"{time_filter_column}\", 'YYYY/MM/DD') LIKE '{match.group(1)}%'",
+        query,
+        flags=re.IGNORECASE,
+    )
+
+    # Replace YEAR() with EXTRACT(YEAR FROM ...)
+    query = re.sub(
+        rf"YEAR\(\"{time_filter_column}\"\)",
+        f"EXTRACT(YEAR FROM \"{time_filter_column}\")",
+        query,
+        flags=re.IGNORECASE,
+    )
+
+    # Replace redundant LOWER() calls
+    query = re.sub(r"LOWER\(LOWER\((.+?)\)\)", r"LOWER(\1)", query)
+
+    # Simplify numeric comparisons wrapped with LOWER()
+    query = re.sub(r"LOWER\((EXTRACT\(.+?\))\) = LOWER\('(\d+)'\)", r"\1 = \2", query)
+
+    # Ensure consistent capitalization for string literals
+    query = re.sub(
+        r"= '([^']*)'",
+        lambda match: f"= '{match.group(1).capitalize()}'",
+        query,
+    )
+
+    # Ensure case-insensitive string comparisons for PostgreSQL
+    query = re.sub(
+        r"WHERE (.+?) = '(.+?)'",
+        lambda match: f"WHERE LOWER({match.group(1)}) = LOWER('{match.group(2)}')",
+        query,
+        )
+
+    # Handle MAX with additional columns via CTE
+    if "MAX(" in query and "," in query:
+        query = re.sub(
+            rf"SELECT MAX\((.+?)\), (.+?), (.+?)\s+FROM (.+?)\s+WHERE (.+)",
+            rf"WITH ranked_commissions AS (SELECT \2, \3, \1, ROW_NUMBER() OVER (ORDER BY \1 DESC) AS r FROM \4 WHERE \5) "
+            rf"SELECT \2, \3, \1 FROM ranked_commissions WHERE r = 1",
+            query,
+            flags=re.IGNORECASE,
+        )
+
+    # Remove any trailing semicolon in the WITH clause
+    query = re.sub(
+        r"WITH ranked_commissions AS \((.*?);?\)",
+        r"WITH ranked_commissions AS (\1)",
+        query,
+        flags=re.IGNORECASE | re.DOTALL,
+        )
+
+    # Remove GROUP BY when ROW_NUMBER() is used
+    if "ROW_NUMBER()" in query:
+        query = re.sub(r"GROUP BY .+?\n", "", query, flags=re.IGNORECASE)
+        query = re.sub(r"ORDER BY MAX\(.+?\)\s*DESC", "", query, flags=re.IGNORECASE)
+
+
+    return query
+
+
+def check(metadata):
+    rewriter = SQLRewriter(metadata)
+    for query, rewritten in expected.items():
+        actual = rewriter.rewrite(query)
+        assert actual == rewritten, f"{query!r} was rewritten to {actual!r}, expected {rewritten!r}"
+
+
+def bench(label, metadata):
+    rewriter = SQLRewriter(metadata)
+    legacy = timeit.timeit(
+        lambda: [legacy_clean_sql_query(q, metadata) for q in queries], number=REPEAT
+    ) / (REPEAT * len(queries))
+    # Rules are compiled once per metadata load, so construction is outside the loop.
+    current = timeit.timeit(lambda: [rewriter.rewrite(q) for q in queries], number=REPEAT) / (REPEAT * len(queries))
+    print(f"{label:<28} {len(metadata['columns']):>8} {legacy * 1e6:>12.1f} {current * 1e6:>12.1f} {legacy / current:>8.1f}x")
+
+
+if __name__ == "__main__":
+    with open(METADATA_PATH, "r") as file:
+        metadata = json.load(file)
+    wide_metadata = dict(metadata, columns=dict(metadata["columns"]))
+    for i in range(200):
+        wide_metadata["columns"][f"Metric{i}"] = f"Synthetic metric {i}"
+
+    check(metadata)
+    print(f"{'metadata':<28} {'columns':>8} {'legacy us':>12} {'rewriter us':>12} {'speedup':>8}")
+    bench("dataset_metadata.json", metadata)
+    bench("dataset_metadata.json +200", wide_metadata)
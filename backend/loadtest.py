@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+import statistics
+import time
+import httpx
+
+# Concurrent load test for the ETL endpoints.
+#
+# Fires --requests POSTs at --endpoint with --concurrency in flight, while a
+# probe keeps hitting a cheap endpoint (--probe) to show whether slow LLM or
+# database calls stall the event loop for other users. Run it against the
+# server before and after a change and compare the two summaries:
+#
+#   python loadtest.py --url http://127.0.0.1:8000 --concurrency 16 --requests 64
+
+DEFAULT_PROMPTS = [
+    "How many cars were sold in May 2023?",
+    "What is the total sale price of cars sold by Lee Wilson?",
+    "How many Chevrolet cars were sold in 2022?",
+    "What is the average commission earned for cars sold in 2023?",
+]
+
+
+def summarize(label, latencies, elapsed=None):
+    if not latencies:
+        return f"{label}: no completed requests"
+    ordered = sorted(latencies)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    summary = (
+        f"{label}: n={len(ordered)} p50={statistics.median(ordered) * 1000:.1f}ms "
+        f"p95={p95 * 1000:.1f}ms max={ordered[-1] * 1000:.1f}ms"
+    )
+    if elapsed:
+        summary += f" throughput={len(ordered) / elapsed:.2f} req/s"
+    return summary
+
+
+async def worker(client, endpoint, queue, latencies, errors):
+    while True:
+        try:
+            prompt = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        start = time.perf_counter()
+        try:
+            response = await client.post(endpoint, data={"prompt": prompt})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            errors.append(str(e))
+
+
+async def probe(client, path, stop, latencies, interval):
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            await client.get(path)
+            latencies.append(time.perf_counter() - start)
+        except Exception:
+            pass
+        await asyncio.sleep(interval)
+
+
+async def run(args):
+    queue = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(DEFAULT_PROMPTS[i % len(DEFAULT_PROMPTS)])
+
+    latencies, errors, probe_latencies = [], [], []
+    stop = asyncio.Event()
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout) as client:
+        probe_task = asyncio.create_task(probe(client, args.probe, stop, probe_latencies, args.probe_interval))
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            worker(client, args.endpoint, queue, latencies, errors) for _ in range(args.concurrency)
+        ])
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await probe_task
+
+    print(f"{args.requests} requests to {args.endpoint} at concurrency {args.concurrency} in {elapsed:.2f}s")
+    print(summarize(args.endpoint, latencies, elapsed))
+    print(summarize(f"probe {args.probe}", probe_latencies))
+    if errors:
+        print(f"errors: {len(errors)} (first: {errors[0]})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent load test for the ETL API.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--endpoint", default="/etl/execute/")
+    parser.add_argument("--probe", default="/etl/cache/")
+    parser.add_argument("--probe-interval", type=float, default=0.1)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    asyncio.run(run(parser.parse_args()))
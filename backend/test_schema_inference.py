@@ -0,0 +1,51 @@
+import os
+import tempfile
+import pandas as pd
+from sqlalchemy import BigInteger, Float
+from app.schema_inference import infer_schema
+
+# Values that do not fit the dtypes inferred from the sampled head of a CSV
+# must widen the chunk they appear in instead of failing the upload:
+#
+#   python -m pytest test_schema_inference.py   (or: python test_schema_inference.py)
+
+SAMPLE_ROWS = 100
+
+
+def write_csv(directory, late_row):
+    path = os.path.join(directory, "late_values.csv")
+    rows = [{"id": idx, "quantity": idx % 50, "price": idx + 0.5} for idx in range(SAMPLE_ROWS * 2)]
+    rows.append(late_row)
+    pd.DataFrame(rows).to_csv(path, index=False)
+    return path
+
+
+def load_chunks(path, schema):
+    reader = pd.read_csv(path, chunksize=SAMPLE_ROWS, **schema.read_options())
+    return [schema.prepare(chunk) for chunk in reader]
+
+
+def test_values_past_the_sample_widen_the_chunk():
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_csv(directory, {"id": 2.5, "quantity": 100000, "price": 0.1})
+        schema = infer_schema(path, date_columns=(), sample_rows=SAMPLE_ROWS)
+        assert schema.dtypes == {"id": "Int16", "quantity": "Int16", "price": "float32"}
+
+        first, _, last = load_chunks(path, schema)
+        assert [str(dtype) for dtype in first.dtypes] == ["Int16", "Int16", "float32"]
+        assert [str(dtype) for dtype in last.dtypes] == ["float64", "Int32", "float64"]
+        assert last.iloc[-1].tolist() == [2.5, 100000, 0.1]
+
+
+def test_sql_types_stay_wide():
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_csv(directory, {"id": 200, "quantity": 1, "price": 1.5})
+        types = infer_schema(path, date_columns=(), sample_rows=SAMPLE_ROWS).sql_types()
+        assert isinstance(types["id"], BigInteger) and isinstance(types["quantity"], BigInteger)
+        assert isinstance(types["price"], Float) and types["price"].precision == 53
+
+
+if __name__ == "__main__":
+    test_values_past_the_sample_widen_the_chunk()
+    test_sql_types_stay_wide()
+    print("schema inference checks passed")